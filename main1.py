@@ -6,12 +6,17 @@
 # Checks: multi-use (type 1: max claims) + password + description
 # Giveaways: inline UI (buttons)
 #
+# Python 3.11+
 # pip install aiogram==3.* python-dotenv
 # .env: BOT_TOKEN=...
 # ============================================================
 
-import os, re, shlex, uuid, sqlite3, hashlib, asyncio, secrets
-from datetime import datetime, timedelta
+import os, re, json, math, time, shlex, uuid, base64, sqlite3, hashlib, asyncio, logging, secrets
+from datetime import datetime
+from functools import lru_cache
+from contextlib import asynccontextmanager, aclosing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from dotenv import load_dotenv
 
 from aiogram import Bot, Dispatcher, Router, F
@@ -23,6 +28,9 @@ from aiogram.types import (
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+log = logging.getLogger("uwallet")
 
 # -------------------- CONFIG --------------------
 load_dotenv()
@@ -42,9 +50,17 @@ DEFAULT_RATE_RUB_PER_UWT = 10.0
 MAX_DESC_LEN = 140
 MAX_PASS_LEN = 32
 
-GIVEAWAY_POLL_SEC = 20
+DB_POOL_SIZE = max(1, int(os.getenv("DB_POOL_SIZE", "4")))  # read-only connections
+
+SEND_RATE = 30  # Telegram's bot-wide broadcast limit, messages per second
+RECIPIENT_BATCH = 1000  # recipient rows pulled from SQLite per fetchmany
+BROADCAST_QUEUE = 256  # recipients buffered ahead of the senders
+GIVEAWAY_BATCH = 256  # due giveaways settled per worker pass
+SUPERVISE_RESET_SEC = 300  # a worker that ran this long before crashing restarts without backoff
 
-BOT_USERNAME: str | None = None  # set in main()
+BOT_USERNAME: str | None = None  # resolved once in main() before polling starts
+START_URL = ""  # "https://t.me/<bot>?start=", set together with BOT_USERNAME
+HELP_TEXT = ""
 
 # -------------------- HELPERS --------------------
 def utcnow() -> datetime:
@@ -56,10 +72,34 @@ def iso(dt: datetime) -> str:
 def now_iso() -> str:
     return iso(utcnow())
 
+def now_ts() -> int:
+    return int(time.time())
+
+def ts_iso(ts: int) -> str:
+    return iso(datetime.utcfromtimestamp(ts))
+
 def sha256(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
+def _tag(s: str) -> str:
+    # passhash is a lookup tag, not a stored credential: 128-bit blake2s is plenty
+    return hashlib.blake2s(s.encode("utf-8"), digest_size=16).hexdigest()
+
+def pass_ok(password: str, passhash: str) -> bool:
+    # checks created before the switch still carry a 64-char sha256 hex tag
+    if len(passhash) == 64:
+        return sha256(password) == passhash
+    return _tag(password) == passhash
+
+def _ids() -> tuple[str, str]:
+    """(row id, url token) from a single urandom read."""
+    b = secrets.token_bytes(24)
+    return (b[:16].hex(), base64.urlsafe_b64encode(b[16:]).rstrip(b"=").decode("ascii"))
+
 def fmt_num(x: float) -> str:
+    # whole amounts (the usual case) skip the format + rstrip path; int() can't take inf/nan
+    if math.isfinite(x) and (i := int(x)) == x:
+        return str(i)
     s = f"{x:.8f}".rstrip("0").rstrip(".")
     return s if s else "0"
 
@@ -90,16 +130,105 @@ def require_username_text() -> str:
     )
 
 # -------------------- DB --------------------
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+def _tune(con: sqlite3.Connection):
+    # per-connection settings; journal_mode=WAL is persistent and set once in init_db()
+    con.execute("PRAGMA synchronous=NORMAL")  # WAL: sync at checkpoint, not at every commit
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-64000")
+
 def db():
     con = sqlite3.connect(DB_PATH)
     con.row_factory = sqlite3.Row
+    _tune(con)
+    return con
+
+# Long-lived connections for the background worker: one writer plus a queue of
+# read-only connections, opened once by init_pool() and never closed per call.
+_WRITER: sqlite3.Connection | None = None
+_POOL: asyncio.Queue = asyncio.Queue()
+
+def _connect(readonly: bool = False) -> sqlite3.Connection:
+    # autocommit (isolation_level=None): transactions are opened explicitly with BEGIN IMMEDIATE;
+    # a roomy statement cache keeps the worker's fixed SQL texts prepared across polls
+    if readonly:
+        con = sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True,
+                              check_same_thread=False, isolation_level=None, cached_statements=256)
+    else:
+        con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+    # default tuple rows: worker code unpacks positionally, no sqlite3.Row per row
+    _tune(con)
     return con
 
+def init_pool():
+    global _WRITER
+    _WRITER = _connect()
+    for _ in range(DB_POOL_SIZE):
+        _POOL.put_nowait(_connect(readonly=True))
+
+def writer() -> sqlite3.Connection:
+    return _WRITER
+
+# every use of the writer connection goes through this one thread, so the
+# event loop never blocks on it and writes never contend with each other
+_WRITER_EXEC = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+async def on_writer(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_WRITER_EXEC, fn, *args)
+
+def close_pool():
+    _WRITER_EXEC.shutdown(wait=True)
+    if _WRITER is not None:
+        _WRITER.close()
+    while not _POOL.empty():
+        _POOL.get_nowait().close()
+
+@asynccontextmanager
+async def pooled():
+    con = await _POOL.get()
+    try:
+        yield con
+    finally:
+        _POOL.put_nowait(con)
+
+def _plain(con: sqlite3.Connection) -> sqlite3.Cursor:
+    # tuple rows: no sqlite3.Row wrapper for probes read by position
+    cur = con.cursor()
+    cur.row_factory = None
+    return cur
+
+SCHEMA_VERSION = 1  # 1: giveaway timestamps as unix seconds
+
+# giveaways was declared with TEXT timestamps before version 1; CREATE TABLE IF NOT EXISTS
+# keeps that declaration (and its text affinity), so the table has to be rebuilt.
+# Values are either ISO strings or unix seconds already stored as text.
+_GW_TS = "CASE WHEN {c} GLOB '*-*' THEN CAST(strftime('%s', {c}) AS INTEGER) ELSE CAST({c} AS INTEGER) END"
+SQL_GIVEAWAYS_REBUILD = f"""
+    CREATE TABLE giveaways_new(
+        id TEXT PRIMARY KEY,
+        creator_tg_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT NOT NULL,
+        end_at INTEGER NOT NULL,   -- unix seconds (UTC)
+        winner_tg_id INTEGER,
+        created_at INTEGER NOT NULL
+    );
+    INSERT INTO giveaways_new(id, creator_tg_id, amount, status, end_at, winner_tg_id, created_at)
+        SELECT id, creator_tg_id, amount, status, {_GW_TS.format(c="end_at")}, winner_tg_id,
+               {_GW_TS.format(c="created_at")}
+        FROM giveaways;
+    DROP TABLE giveaways;
+    ALTER TABLE giveaways_new RENAME TO giveaways;
+"""
+
 def init_db():
     con = db()
     cur = con.cursor()
     cur.executescript("""
     PRAGMA journal_mode=WAL;
+    PRAGMA wal_autocheckpoint=1000;
 
     CREATE TABLE IF NOT EXISTS users(
         tg_id INTEGER PRIMARY KEY,
@@ -137,7 +266,7 @@ def init_db():
         max_claims INTEGER NOT NULL,
         claimed_count INTEGER NOT NULL DEFAULT 0,
         description TEXT,
-        passhash TEXT,
+        passhash TEXT,             -- blake2s-128 hex (32 chars); legacy rows: sha256 hex
         status TEXT NOT NULL,      -- active / finished / cancelled
         created_at TEXT NOT NULL
     );
@@ -166,9 +295,9 @@ def init_db():
         creator_tg_id INTEGER NOT NULL,
         amount REAL NOT NULL,
         status TEXT NOT NULL,
-        end_at TEXT NOT NULL,
+        end_at INTEGER NOT NULL,   -- unix seconds (UTC)
         winner_tg_id INTEGER,
-        created_at TEXT NOT NULL
+        created_at INTEGER NOT NULL
     );
 
     CREATE TABLE IF NOT EXISTS giveaway_participants(
@@ -177,22 +306,42 @@ def init_db():
         PRIMARY KEY(giveaway_id, user_tg_id)
     );
     """)
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] < SCHEMA_VERSION:
+        cur.execute("SELECT type FROM pragma_table_info('giveaways') WHERE name='end_at'")
+        rebuild = SQL_GIVEAWAYS_REBUILD if cur.fetchone()[0].upper() != "INTEGER" else ""
+        cur.executescript("BEGIN IMMEDIATE;\n" + rebuild + f"PRAGMA user_version={SCHEMA_VERSION};\nCOMMIT;")
+    # partial index: only live giveaways, ordered by deadline (worker's MIN(end_at) and due scan).
+    # giveaway_participants needs none: its (giveaway_id, user_tg_id) primary key
+    # already serves the participant lookups as a covering index.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_active_end ON giveaways(end_at) WHERE status='active'")
     cur.execute("INSERT OR IGNORE INTO settings(k,v) VALUES('rate_rub_per_uwt', ?)", (str(DEFAULT_RATE_RUB_PER_UWT),))
     for a in DEFAULT_ADMINS:
         cur.execute("INSERT OR IGNORE INTO admins(username) VALUES(?)", (a,))
     con.commit()
     con.close()
+    init_pool()
+
+# tg_id -> username already written this process; skips the write on repeat calls
+_SEEN_USERS: dict[int, str] = {}
+SEEN_USERS_MAX = 10000
 
 def ensure_user(tg_id: int, username: str):
+    u = username.lower()
+    if _SEEN_USERS.get(tg_id) == u:
+        return
     con = db()
     cur = con.cursor()
     cur.execute(
         "INSERT OR IGNORE INTO users(tg_id, username, uwt, rub, created_at) VALUES(?,?,?,?,?)",
-        (tg_id, username.lower(), 0.0, 0.0, now_iso())
+        (tg_id, u, 0.0, 0.0, now_iso())
     )
-    cur.execute("UPDATE users SET username=? WHERE tg_id=?", (username.lower(), tg_id))
+    cur.execute("UPDATE users SET username=? WHERE tg_id=? AND username IS NOT ?", (u, tg_id, u))
     con.commit()
     con.close()
+    if len(_SEEN_USERS) >= SEEN_USERS_MAX:
+        del _SEEN_USERS[next(iter(_SEEN_USERS))]
+    _SEEN_USERS[tg_id] = u
 
 def get_balances(tg_id: int) -> tuple[float, float]:
     con = db()
@@ -242,9 +391,8 @@ def create_check_multi(creator_id: int, total_amount: float, per_claim: float, m
     if uwt + 1e-12 < total_amount:
         return (False, "❌ Недостаточно UWT")
 
-    token = secrets.token_urlsafe(8)
-    check_id = str(uuid.uuid4())
-    ph = sha256(password) if password else None
+    check_id, token = _ids()
+    ph = _tag(password) if password else None
 
     con = db()
     cur = con.cursor()
@@ -261,13 +409,14 @@ def create_check_multi(creator_id: int, total_amount: float, per_claim: float, m
     con.close()
     return (True, token)
 
-def check_info(token: str):
+def check_passhash(token: str) -> tuple[bool, str | None]:
+    """(exists, passhash) for the /start precheck."""
     con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM checks WHERE token=?", (token,))
+    cur = _plain(con)
+    cur.execute("SELECT passhash FROM checks WHERE token=?", (token,))
     row = cur.fetchone()
     con.close()
-    return row
+    return (row is not None, row[0] if row else None)
 
 def claim_check_by_token(token: str, user_id: int, password: str | None) -> tuple[bool, str, dict | None]:
     con = db()
@@ -285,41 +434,40 @@ def claim_check_by_token(token: str, user_id: int, password: str | None) -> tupl
         if not password:
             con.close()
             return (False, "__NEED_PASS__", {"need_pass": True, "token": token})
-        if sha256(password) != row["passhash"]:
+        if not pass_ok(password, row["passhash"]):
             con.close()
             return (False, "❌ Неверный пароль", None)
 
+    pc = _plain(con)
     cur.execute("BEGIN IMMEDIATE")
-    cur.execute("SELECT 1 FROM check_claims WHERE check_id=? AND user_tg_id=?", (row["id"], user_id))
-    if cur.fetchone():
+    pc.execute("SELECT 1 FROM check_claims WHERE check_id=? AND user_tg_id=?", (row["id"], user_id))
+    if pc.fetchone():
         con.rollback(); con.close()
         return (False, "⚠️ Вы уже получали из этого чека", None)
 
-    cur.execute("SELECT claimed_count, max_claims, per_claim FROM checks WHERE token=? AND status='active'", (token,))
-    r2 = cur.fetchone()
+    pc.execute("SELECT claimed_count, max_claims, per_claim FROM checks WHERE token=? AND status='active'", (token,))
+    r2 = pc.fetchone()
     if not r2:
         con.rollback(); con.close()
         return (False, "❌ Чек недоступен", None)
 
-    claimed = int(r2["claimed_count"])
-    maxc = int(r2["max_claims"])
+    claimed, maxc, per = int(r2[0]), int(r2[1]), float(r2[2])
     if claimed >= maxc:
         cur.execute("UPDATE checks SET status='finished' WHERE token=?", (token,))
         con.commit(); con.close()
         return (False, "❌ Чек закончился", None)
 
-    per = float(r2["per_claim"])
     cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (per, user_id))
     cur.execute("INSERT INTO check_claims(check_id, user_tg_id, claimed_at) VALUES(?,?,?)",
                 (row["id"], user_id, now_iso()))
     cur.execute("UPDATE checks SET claimed_count=claimed_count+1 WHERE token=?", (token,))
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
                 (user_id, "UWT", per, "check_claim", f"token={token}", now_iso()))
-    cur.execute("SELECT claimed_count, max_claims FROM checks WHERE token=?", (token,))
-    rr = cur.fetchone()
+    pc.execute("SELECT claimed_count, max_claims FROM checks WHERE token=?", (token,))
+    rr = pc.fetchone()
     left = 0
     if rr:
-        left = int(rr["max_claims"]) - int(rr["claimed_count"])
+        left = int(rr[1]) - int(rr[0])
         if left <= 0:
             cur.execute("UPDATE checks SET status='finished' WHERE token=?", (token,))
     con.commit()
@@ -330,8 +478,7 @@ def claim_check_by_token(token: str, user_id: int, password: str | None) -> tupl
 def create_bill_uwt_by_token(creator_id: int, amount: float, desc: str | None) -> tuple[bool, str]:
     if amount <= 0:
         return (False, "Сумма должна быть > 0")
-    token = secrets.token_urlsafe(8)
-    bill_id = str(uuid.uuid4())
+    bill_id, token = _ids()
     con = db()
     cur = con.cursor()
     cur.execute(
@@ -383,50 +530,79 @@ def pay_bill_by_token(token: str, payer_id: int) -> tuple[bool, str]:
     return (True, f"✅ Оплачено {fmt_num(amount)} UWT")
 
 # -------------------- Giveaways --------------------
+# Worker statements: fixed texts so pooled connections reuse the prepared plans.
+SQL_FINISH_DUE = (
+    "UPDATE giveaways SET status='finished', winner_tg_id=("
+    "  SELECT user_tg_id FROM giveaway_participants WHERE giveaway_id=giveaways.id ORDER BY RANDOM() LIMIT 1"
+    ") WHERE id IN ("
+    "  SELECT id FROM giveaways WHERE status='active' AND end_at<=? ORDER BY end_at LIMIT ?"
+    ") RETURNING id, creator_tg_id, amount, winner_tg_id"
+)
+SQL_PAYOUT = "UPDATE users SET uwt=uwt+? WHERE tg_id=?"
+SQL_INSERT_TX = "INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)"
+# ids are passed as one JSON array so the text does not change with the batch size
+SQL_RECIPIENTS = (
+    "SELECT giveaway_id, user_tg_id FROM giveaway_participants WHERE giveaway_id IN (SELECT value FROM json_each(?1)) "
+    "UNION SELECT id, creator_tg_id FROM giveaways WHERE id IN (SELECT value FROM json_each(?1))"
+)
+SQL_NEXT_END = "SELECT MIN(end_at) FROM giveaways WHERE status='active'"
+
 def finish_due_giveaways() -> list[tuple[str, int | None, float]]:
-    con = db()
+    con = writer()
     cur = con.cursor()
-    cur.execute("SELECT * FROM giveaways WHERE status='active'")
-    rows = cur.fetchall()
-    finished = []
-    for g in rows:
-        try:
-            end_at = datetime.fromisoformat(g["end_at"])
-        except:
-            continue
-        if end_at > utcnow():
-            continue
-
-        gid = g["id"]
-        amount = float(g["amount"])
-        creator = int(g["creator_tg_id"])
-
-        cur.execute("SELECT user_tg_id FROM giveaway_participants WHERE giveaway_id=?", (gid,))
-        ps = [int(r["user_tg_id"]) for r in cur.fetchall()]
-        winner = secrets.choice(ps) if ps else None
-
-        if winner is None:
-            cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, creator))
-            cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                        (creator, "UWT", amount, "giveaway_refund", f"gid={gid}", now_iso()))
-        else:
-            cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, winner))
-            cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                        (winner, "UWT", amount, "giveaway_win", f"gid={gid}", now_iso()))
-
-        cur.execute("UPDATE giveaways SET status='finished', winner_tg_id=? WHERE id=?", (winner, gid))
-        con.commit()
-        finished.append((gid, winner, amount))
-    con.close()
+    ts = now_iso()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        # one statement: pick due rows, draw a winner in SQL, mark finished
+        cur.execute(SQL_FINISH_DUE, (now_ts(), GIVEAWAY_BATCH))
+        rows = cur.fetchall()
+        finished = []
+        payouts: dict[int, float] = {}  # one balance UPDATE per user, even if they won several
+        tx_rows = []
+        for gid, creator, amount, winner in rows:
+            amount = float(amount)
+            if winner is None:
+                payouts[creator] = payouts.get(creator, 0.0) + amount
+                tx_rows.append((creator, "UWT", amount, "giveaway_refund", f"gid={gid}", ts))
+            else:
+                payouts[winner] = payouts.get(winner, 0.0) + amount
+                tx_rows.append((winner, "UWT", amount, "giveaway_win", f"gid={gid}", ts))
+            finished.append((gid, winner, amount))
+        if payouts:
+            # all payouts share the BEGIN IMMEDIATE above: one commit, one WAL sync
+            cur.executemany(SQL_PAYOUT, [(delta, uid) for uid, delta in payouts.items()])
+            cur.executemany(SQL_INSERT_TX, tx_rows)
+    except:
+        # autocommit connection: leave no half-open transaction behind
+        con.rollback()
+        raise
+    con.commit()
     return finished
 
+async def stream_recipients(gids: list[str]):
+    """Yield distinct (giveaway_id, user_tg_id) pairs for the given giveaways,
+    RECIPIENT_BATCH rows at a time, without materializing the whole list."""
+    async with pooled() as con:
+        # UNION dedupes (giveaway, user) pairs, so a creator who also joined is listed once
+        cur = await asyncio.to_thread(con.execute, SQL_RECIPIENTS, (json.dumps(gids),))
+        while rows := await asyncio.to_thread(cur.fetchmany, RECIPIENT_BATCH):
+            for row in rows:
+                yield row
+
+def next_giveaway_end() -> int | None:
+    row = writer().execute(SQL_NEXT_END).fetchone()
+    # int(): rows written before the schema migration may still come back as text
+    return int(row[0]) if row and row[0] is not None else None
+
 # -------------------- INLINE MENU UI --------------------
-def nav_kb() -> InlineKeyboardMarkup:
-    def b(text, key): return InlineKeyboardButton(text=text, callback_data=f"nav:{key}")
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [b("👛 Кошелёк", "wallet"), b("🧾 История", "history")],
-        [b("🎁 Розыгрыши", "giveaways"), b("⚙️ Помощь", "help")],
-    ])
+# Static keyboards are built once at import; aiogram only serializes them per send.
+def _nav_btn(text: str, key: str) -> InlineKeyboardButton:
+    return InlineKeyboardButton(text=text, callback_data=f"nav:{key}")
+
+NAV_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [_nav_btn("👛 Кошелёк", "wallet"), _nav_btn("🧾 История", "history")],
+    [_nav_btn("🎁 Розыгрыши", "giveaways"), _nav_btn("⚙️ Помощь", "help")],
+])
 
 def home_text(uid: int) -> str:
     uwt, rub = get_balances(uid)
@@ -439,29 +615,32 @@ def home_text(uid: int) -> str:
     )
 
 # Giveaways inline UI
-def gw_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Создать", callback_data="gw:new"),
-         InlineKeyboardButton(text="📄 Активные", callback_data="gw:active")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
-    ])
-
-def gw_prize_kb() -> InlineKeyboardMarkup:
+GW_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Создать", callback_data="gw:new"),
+     InlineKeyboardButton(text="📄 Активные", callback_data="gw:active")],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
+])
+
+GW_PRIZE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="50", callback_data="gw:p:50"),
+     InlineKeyboardButton(text="100", callback_data="gw:p:100"),
+     InlineKeyboardButton(text="500", callback_data="gw:p:500")],
+    [InlineKeyboardButton(text="1000", callback_data="gw:p:1000")],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:giveaways")],
+])
+
+GW_TIME_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="30 минут", callback_data="gw:t:30"),
+     InlineKeyboardButton(text="1 час", callback_data="gw:t:60"),
+     InlineKeyboardButton(text="6 часов", callback_data="gw:t:360")],
+    [InlineKeyboardButton(text="24 часа", callback_data="gw:t:1440")],
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:giveaways")],
+])
+
+@lru_cache(maxsize=256)
+def gw_join_kb(gid: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="50", callback_data="gw:p:50"),
-         InlineKeyboardButton(text="100", callback_data="gw:p:100"),
-         InlineKeyboardButton(text="500", callback_data="gw:p:500")],
-        [InlineKeyboardButton(text="1000", callback_data="gw:p:1000")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:giveaways")],
-    ])
-
-def gw_time_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="30 минут", callback_data="gw:t:30"),
-         InlineKeyboardButton(text="1 час", callback_data="gw:t:60"),
-         InlineKeyboardButton(text="6 часов", callback_data="gw:t:360")],
-        [InlineKeyboardButton(text="24 часа", callback_data="gw:t:1440")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:giveaways")],
+        [InlineKeyboardButton(text="✅ Участвовать", callback_data=f"gw:join:{gid}")]
     ])
 
 # -------------------- FSM --------------------
@@ -485,10 +664,10 @@ async def cmd_start(m: Message, state: FSMContext):
 
     if payload.startswith("c_"):
         token = payload[2:]
-        info = check_info(token)
-        if not info:
+        found, ph = check_passhash(token)
+        if not found:
             await m.answer("❌ Чек не найден."); return
-        if info["passhash"]:
+        if ph:
             await state.set_state(ClaimPassFlow.waiting_pass)
             await state.update_data(token=token, tries=0)
             await m.answer("🔐 Этот чек защищён паролем. Введите пароль сообщением:")
@@ -501,7 +680,7 @@ async def cmd_start(m: Message, state: FSMContext):
         ok, msg = pay_bill_by_token(token, m.from_user.id)
         await m.answer(msg); return
 
-    await m.answer(home_text(m.from_user.id), parse_mode="Markdown", reply_markup=nav_kb())
+    await m.answer(home_text(m.from_user.id), parse_mode="Markdown", reply_markup=NAV_KB)
 
 @router.message(ClaimPassFlow.waiting_pass)
 async def claim_pass(m: Message, state: FSMContext):
@@ -521,13 +700,12 @@ async def claim_pass(m: Message, state: FSMContext):
         await state.clear(); return
     await m.answer(msg)
 
-@router.callback_query(F.data.startswith("nav:"))
-async def nav(cb: CallbackQuery):
+async def nav(cb: CallbackQuery, state: FSMContext):
     key = cb.data.split(":", 1)[1]
     uid = cb.from_user.id
 
     if key == "home":
-        await cb.message.edit_text(home_text(uid), parse_mode="Markdown", reply_markup=nav_kb())
+        await cb.message.edit_text(home_text(uid), parse_mode="Markdown", reply_markup=NAV_KB)
         await cb.answer(); return
 
     if key == "wallet":
@@ -535,7 +713,7 @@ async def nav(cb: CallbackQuery):
         await cb.message.edit_text(
             f"👛 *Кошелёк*\n\n• UWT: *{fmt_num(uwt)}*\n• RUB: *{rub:g}*",
             parse_mode="Markdown",
-            reply_markup=nav_kb()
+            reply_markup=NAV_KB
         )
         await cb.answer(); return
 
@@ -544,49 +722,33 @@ async def nav(cb: CallbackQuery):
         if not rows:
             txt = "🧾 История пуста."
         else:
-            txt = "🧾 *Последние операции:*\n\n"
-            for r in rows:
-                txt += f"{r['created_at']} | {r['asset']} {float(r['delta']):+g} | {r['kind']}\n"
-        await cb.message.edit_text(txt, parse_mode="Markdown", reply_markup=nav_kb())
+            lines = [f"{r['created_at']} | {r['asset']} {float(r['delta']):+g} | {r['kind']}\n" for r in rows]
+            txt = "🧾 *Последние операции:*\n\n" + "".join(lines)
+        await cb.message.edit_text(txt, parse_mode="Markdown", reply_markup=NAV_KB)
         await cb.answer(); return
 
     if key == "help":
-        un = BOT_USERNAME or (await cb.bot.me()).username
-        await cb.message.edit_text(
-            "⚙️ *Помощь*\n\n"
-            "*Inline команды:*\n"
-            f"• `@{un} 100` → чек/счёт\n"
-            f"• `@{un} check 100 \"описание\" пароль` → одноразовый чек\n"
-            f"• `@{un} mcheck 1000 100 10 \"описание\" пароль` → многоразовый чек\n"
-            f"• `@{un} bill 250 \"описание\"` → счёт\n\n"
-            "Чеки/счета публикуются с *URL-кнопками*.\n"
-            "Розыгрыши — через inline-меню.",
-            parse_mode="Markdown",
-            reply_markup=nav_kb()
-        )
+        await cb.message.edit_text(HELP_TEXT, parse_mode="Markdown", reply_markup=NAV_KB)
         await cb.answer(); return
 
     if key == "giveaways":
-        await cb.message.edit_text("🎁 *Розыгрыши*", parse_mode="Markdown", reply_markup=gw_menu_kb())
+        await cb.message.edit_text("🎁 *Розыгрыши*", parse_mode="Markdown", reply_markup=GW_MENU_KB)
         await cb.answer(); return
 
     await cb.answer()
 
 # -------------------- Giveaways callbacks --------------------
-@router.callback_query(F.data == "gw:new")
 async def gw_new(cb: CallbackQuery, state: FSMContext):
     await state.update_data(gw_prize=None)
-    await cb.message.edit_text("🎁 Создание розыгрыша\n\nВыберите приз (UWT):", reply_markup=gw_prize_kb())
+    await cb.message.edit_text("🎁 Создание розыгрыша\n\nВыберите приз (UWT):", reply_markup=GW_PRIZE_KB)
     await cb.answer()
 
-@router.callback_query(F.data.startswith("gw:p:"))
 async def gw_pick_prize(cb: CallbackQuery, state: FSMContext):
     prize = float(cb.data.split(":")[2])
     await state.update_data(gw_prize=prize)
-    await cb.message.edit_text(f"🎁 Приз: {fmt_num(prize)} UWT\n\nВыберите длительность:", reply_markup=gw_time_kb())
+    await cb.message.edit_text(f"🎁 Приз: {fmt_num(prize)} UWT\n\nВыберите длительность:", reply_markup=GW_TIME_KB)
     await cb.answer()
 
-@router.callback_query(F.data.startswith("gw:t:"))
 async def gw_pick_time(cb: CallbackQuery, state: FSMContext):
     minutes = int(cb.data.split(":")[2])
     data = await state.get_data()
@@ -597,30 +759,30 @@ async def gw_pick_time(cb: CallbackQuery, state: FSMContext):
     if uwt < prize:
         await cb.answer("Недостаточно UWT", show_alert=True); return
 
-    gid = str(uuid.uuid4())
-    end_at = iso(utcnow() + timedelta(minutes=minutes))
+    gid, _ = _ids()
+    end_at = now_ts() + minutes * 60
 
     con = db()
     cur = con.cursor()
     cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (prize, cb.from_user.id))
     cur.execute("INSERT INTO giveaways(id, creator_tg_id, amount, status, end_at, created_at) VALUES(?,?,?,?,?,?)",
-                (gid, cb.from_user.id, prize, "active", end_at, now_iso()))
+                (gid, cb.from_user.id, prize, "active", end_at, now_ts()))
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
                 (cb.from_user.id, "UWT", -prize, "giveaway_create", f"gid={gid}", now_iso()))
     con.commit(); con.close()
+    GW_WAKE.set()
 
     join_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Участвовать", callback_data=f"gw:join:{gid}")],
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:giveaways")],
     ])
     await cb.message.edit_text(
-        f"🎁 Розыгрыш создан!\n\nПриз: {fmt_num(prize)} UWT\nДо: {end_at}\nID: {gid}",
+        f"🎁 Розыгрыш создан!\n\nПриз: {fmt_num(prize)} UWT\nДо: {ts_iso(end_at)}\nID: {gid}",
         reply_markup=join_kb
     )
     await cb.answer()
 
-@router.callback_query(F.data == "gw:active")
-async def gw_active(cb: CallbackQuery):
+async def gw_active(cb: CallbackQuery, state: FSMContext):
     con = db()
     cur = con.cursor()
     cur.execute("SELECT * FROM giveaways WHERE status='active' ORDER BY created_at DESC LIMIT 10")
@@ -630,24 +792,23 @@ async def gw_active(cb: CallbackQuery):
         await cb.message.answer("Активных розыгрышей нет.")
         await cb.answer()
         return
-    for g in rows:
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Участвовать", callback_data=f"gw:join:{g['id']}")]
-        ])
-        await cb.message.answer(
-            f"🎁 Розыгрыш\nПриз: {fmt_num(float(g['amount']))} UWT\nДо: {g['end_at']}\nID: {g['id']}",
-            reply_markup=kb
+    # at most 10 messages to one chat: well under the flood limit, send them concurrently
+    await asyncio.gather(*[
+        cb.message.answer(
+            f"🎁 Розыгрыш\nПриз: {fmt_num(float(g['amount']))} UWT\nДо: {ts_iso(int(g['end_at']))}\nID: {g['id']}",
+            reply_markup=gw_join_kb(g["id"])
         )
+        for g in rows
+    ])
     await cb.answer()
 
-@router.callback_query(F.data.startswith("gw:join:"))
-async def gw_join(cb: CallbackQuery):
+async def gw_join(cb: CallbackQuery, state: FSMContext):
     gid = cb.data.split(":", 2)[2]
     con = db()
-    cur = con.cursor()
+    cur = _plain(con)
     cur.execute("SELECT status FROM giveaways WHERE id=?", (gid,))
     g = cur.fetchone()
-    if not g or g["status"] != "active":
+    if not g or g[0] != "active":
         con.close()
         await cb.answer("Розыгрыш недоступен", show_alert=True)
         return
@@ -659,13 +820,39 @@ async def gw_join(cb: CallbackQuery):
         con.close()
         await cb.answer("⚠️ Уже участвуете", show_alert=True)
 
+# -------------------- Callback dispatch --------------------
+# One registered callback handler; the prefix ("nav", "gw:join", ...) picks the
+# function with a dict lookup instead of aiogram testing every filter in turn.
+CALLBACK_ROUTES = {
+    "nav": nav,
+    "gw:new": gw_new,
+    "gw:p": gw_pick_prize,
+    "gw:t": gw_pick_time,
+    "gw:active": gw_active,
+    "gw:join": gw_join,
+}
+
+@router.callback_query()
+async def on_callback(cb: CallbackQuery, state: FSMContext):
+    head, _, rest = (cb.data or "").partition(":")
+    handler = CALLBACK_ROUTES.get(head) or CALLBACK_ROUTES.get(f"{head}:{rest.partition(':')[0]}")
+    if handler is None:
+        await cb.answer(); return
+    await handler(cb, state)
+
 # -------------------- Inline Mode --------------------
+def _amount(s: str) -> float | None:
+    # a long enough digit string overflows to inf
+    v = float(s.replace(",", "."))
+    return v if math.isfinite(v) else None
+
 def parse_inline_query(q: str):
     q = q.strip()
     if not q:
         return None
     if re.fullmatch(r"\d+([.,]\d+)?", q):
-        return {"kind": "simple", "amount": float(q.replace(",", "."))}
+        amount = _amount(q)
+        return {"kind": "simple", "amount": amount} if amount is not None else None
     try:
         parts = shlex.split(q)
     except:
@@ -676,7 +863,8 @@ def parse_inline_query(q: str):
 
     if cmd == "bill":
         if len(parts) < 2 or not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        amount = float(parts[1].replace(",", "."))
+        amount = _amount(parts[1])
+        if amount is None: return None
         desc = safe_desc(parts[2]) if len(parts) >= 3 else None
         return {"kind": "bill", "amount": amount, "desc": desc}
 
@@ -685,8 +873,8 @@ def parse_inline_query(q: str):
         if not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
         if not re.fullmatch(r"\d+([.,]\d+)?", parts[2]): return None
         if not re.fullmatch(r"\d+", parts[3]): return None
-        total = float(parts[1].replace(",", "."))
-        per = float(parts[2].replace(",", "."))
+        total, per = _amount(parts[1]), _amount(parts[2])
+        if total is None or per is None: return None
         maxc = int(parts[3])
         desc = safe_desc(parts[4]) if len(parts) >= 5 else None
         pwd = safe_pass(parts[5]) if len(parts) >= 6 else None
@@ -694,7 +882,8 @@ def parse_inline_query(q: str):
 
     if cmd == "check":
         if len(parts) < 2 or not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        amount = float(parts[1].replace(",", "."))
+        amount = _amount(parts[1])
+        if amount is None: return None
         desc = safe_desc(parts[2]) if len(parts) >= 3 else None
         pwd = safe_pass(parts[3]) if len(parts) >= 4 else None
         return {"kind": "mcheck", "total": amount, "per": amount, "maxc": 1, "desc": desc, "pwd": pwd}
@@ -702,31 +891,29 @@ def parse_inline_query(q: str):
     return None
 
 def make_check_text(total: float, per: float, maxc: int, desc: str | None, has_pass: bool) -> str:
-    text = "🎁 *Чек UWT*\n\n"
+    parts = ["🎁 *Чек UWT*\n\n"]
     if maxc > 1:
-        text += f"💰 За раз: *{fmt_num(per)} UWT*\n"
-        text += f"👥 Лимит: *{maxc}*\n"
-        text += f"📦 Общая сумма: *{fmt_num(total)} UWT*\n"
+        parts.append(f"💰 За раз: *{fmt_num(per)} UWT*\n"
+                     f"👥 Лимит: *{maxc}*\n"
+                     f"📦 Общая сумма: *{fmt_num(total)} UWT*\n")
     else:
-        text += f"💰 Сумма: *{fmt_num(per)} UWT*\n"
+        parts.append(f"💰 Сумма: *{fmt_num(per)} UWT*\n")
     if desc:
-        text += f"\n📝 {desc}\n"
+        parts.append(f"\n📝 {desc}\n")
     if has_pass:
-        text += "\n🔐 Защищён паролем\n"
-    text += "\nНажмите кнопку ниже 👇"
-    return text
+        parts.append("\n🔐 Защищён паролем\n")
+    parts.append("\nНажмите кнопку ниже 👇")
+    return "".join(parts)
 
 def make_bill_text(amount: float, desc: str | None) -> str:
-    text = "📩 *Счёт UWT*\n\n"
-    text += f"💰 Сумма: *{fmt_num(amount)} UWT*\n"
+    parts = ["📩 *Счёт UWT*\n\n", f"💰 Сумма: *{fmt_num(amount)} UWT*\n"]
     if desc:
-        text += f"\n📝 {desc}\n"
-    text += "\nНажмите кнопку ниже 👇"
-    return text
+        parts.append(f"\n📝 {desc}\n")
+    parts.append("\nНажмите кнопку ниже 👇")
+    return "".join(parts)
 
 @router.inline_query()
 async def inline_handler(i: InlineQuery):
-    global BOT_USERNAME
     if not i.from_user.username:
         await i.answer([], cache_time=1); return
     ensure_user(i.from_user.id, i.from_user.username)
@@ -735,8 +922,7 @@ async def inline_handler(i: InlineQuery):
     if not parsed:
         await i.answer([], cache_time=1); return
 
-    bot_user = BOT_USERNAME or (await i.bot.me()).username
-    BOT_USERNAME = bot_user
+    start_url = START_URL
 
     results = []
     kind = parsed["kind"]
@@ -746,7 +932,7 @@ async def inline_handler(i: InlineQuery):
         # Single check
         ok, token = create_check_multi(i.from_user.id, amount, amount, 1, None, None)
         if ok:
-            url = f"https://t.me/{bot_user}?start=c_{token}"
+            url = f"{start_url}c_{token}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🎁 Забрать чек", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -757,7 +943,7 @@ async def inline_handler(i: InlineQuery):
         # Bill
         ok, tokenb = create_bill_uwt_by_token(i.from_user.id, amount, None)
         if ok:
-            url = f"https://t.me/{bot_user}?start=b_{tokenb}"
+            url = f"{start_url}b_{tokenb}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💳 Оплатить", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -774,7 +960,7 @@ async def inline_handler(i: InlineQuery):
         pwd = parsed.get("pwd")
         ok, token = create_check_multi(i.from_user.id, total, per, maxc, desc, pwd)
         if ok:
-            url = f"https://t.me/{bot_user}?start=c_{token}"
+            url = f"{start_url}c_{token}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🎁 Забрать чек", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -796,7 +982,7 @@ async def inline_handler(i: InlineQuery):
         desc = parsed.get("desc")
         ok, token = create_bill_uwt_by_token(i.from_user.id, amount, desc)
         if ok:
-            url = f"https://t.me/{bot_user}?start=b_{token}"
+            url = f"{start_url}b_{token}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💳 Оплатить", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -809,42 +995,142 @@ async def inline_handler(i: InlineQuery):
     await i.answer(results, cache_time=0, is_personal=True)
 
 # -------------------- WORKER --------------------
+# Broadcasts: at most SEND_RATE requests in flight, started no faster than SEND_RATE/s.
+_SEND_SEM = asyncio.Semaphore(SEND_RATE)
+_next_send_at = 0.0
+
+async def _send_slot():
+    global _next_send_at
+    now = time.monotonic()
+    at = max(now, _next_send_at)
+    _next_send_at = at + 1 / SEND_RATE
+    if at > now:
+        await asyncio.sleep(at - now)
+
+async def _send(bot: Bot, uid: int, text: str):
+    async with _SEND_SEM:
+        await _send_slot()
+        try:
+            await bot.send_message(uid, text)
+        except TelegramRetryAfter as e:
+            # flood control: wait as told and retry once instead of dropping the message
+            await asyncio.sleep(e.retry_after)
+            try:
+                await bot.send_message(uid, text)
+            except Exception as e2:
+                log.warning("send to %s failed after retry: %s", uid, e2)
+        except TelegramForbiddenError:
+            pass  # user blocked the bot
+        except Exception as e:
+            log.warning("send to %s failed: %s", uid, e)
+
+async def broadcast(bot: Bot, items, texts: dict[str, str]):
+    """Send texts[gid] to every (gid, uid) from the async iterator `items`.
+    A bounded queue sits between the DB reader and SEND_RATE sender tasks, so
+    reading and sending overlap and the reader pauses when Telegram throttles."""
+    q: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_QUEUE)
+
+    async def sender():
+        while (item := await q.get()) is not None:
+            gid, uid = item
+            await _send(bot, uid, texts[gid])
+
+    senders = [asyncio.create_task(sender()) for _ in range(SEND_RATE)]
+    try:
+        async with aclosing(items):
+            async for item in items:
+                await q.put(item)
+        for _ in senders:
+            await q.put(None)
+        await asyncio.gather(*senders)
+    finally:
+        for t in senders:
+            t.cancel()
+
+# set by gw_pick_time so the worker re-reads the nearest end_at right away
+GW_WAKE = asyncio.Event()
+
+GW_RESULT_REFUND = "Участников не было. Приз возвращён создателю."
+
+def giveaway_result_text(gid: str, winner: int | None, amount: float) -> str:
+    if winner is None:
+        return f"🎁 Розыгрыш {gid} завершён. {GW_RESULT_REFUND}"
+    return f"🎁 Розыгрыш {gid} завершён. Победитель: {winner}. Приз: {fmt_num(amount)} UWT"
+
 async def giveaways_worker(bot: Bot):
     while True:
-        finished = finish_due_giveaways()
-        for gid, winner, amount in finished:
-            con = db()
-            cur = con.cursor()
-            cur.execute("SELECT creator_tg_id FROM giveaways WHERE id=?", (gid,))
-            g = cur.fetchone()
-            cur.execute("SELECT user_tg_id FROM giveaway_participants WHERE giveaway_id=?", (gid,))
-            ps = [int(r["user_tg_id"]) for r in cur.fetchall()]
-            con.close()
-
-            creator = int(g["creator_tg_id"]) if g else None
-            msg = f"🎁 Розыгрыш {gid} завершён. "
-            msg += "Участников не было. Приз возвращён создателю." if winner is None else f"Победитель: {winner}. Приз: {fmt_num(amount)} UWT"
+        finished = await on_writer(finish_due_giveaways)
+        if finished:
+            # one text per giveaway, built once and shared by every send
+            texts = {gid: giveaway_result_text(gid, winner, amount) for gid, winner, amount in finished}
+            await broadcast(bot, stream_recipients(list(texts)), texts)
+            if len(finished) == GIVEAWAY_BATCH:
+                continue  # a full batch means more may be due: drain before sleeping
+
+        # sleep until the nearest deadline, or with nothing active until
+        # gw_pick_time signals a new giveaway; no periodic polling
+        GW_WAKE.clear()
+        end_at = await on_writer(next_giveaway_end)
+        delay = None if end_at is None else max(0.0, end_at - time.time())
+        try:
+            await asyncio.wait_for(GW_WAKE.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
-            for uid in set(ps + ([creator] if creator else [])):
-                try:
-                    await bot.send_message(uid, msg)
-                except:
-                    pass
-        await asyncio.sleep(GIVEAWAY_POLL_SEC)
+async def supervise(name: str, factory):
+    """Run factory() forever, restarting it with exponential backoff if it crashes."""
+    delay = 1
+    while True:
+        started = time.monotonic()
+        try:
+            await factory()
+            return
+        except Exception:
+            if time.monotonic() - started > SUPERVISE_RESET_SEC:
+                delay = 1  # ran fine for a while: an isolated crash, not a crash loop
+            log.exception("%s crashed, restarting in %ss", name, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+def set_bot_username(un: str):
+    # Everything derived from the username is built here once, so handlers only read finished strings
+    global BOT_USERNAME, START_URL, HELP_TEXT
+    BOT_USERNAME = un
+    START_URL = f"https://t.me/{un}?start="
+    HELP_TEXT = (
+        "⚙️ *Помощь*\n\n"
+        "*Inline команды:*\n"
+        f"• `@{un} 100` → чек/счёт\n"
+        f"• `@{un} check 100 \"описание\" пароль` → одноразовый чек\n"
+        f"• `@{un} mcheck 1000 100 10 \"описание\" пароль` → многоразовый чек\n"
+        f"• `@{un} bill 250 \"описание\"` → счёт\n\n"
+        "Чеки/счета публикуются с *URL-кнопками*.\n"
+        "Розыгрыши — через inline-меню."
+    )
 
 # -------------------- RUN --------------------
 async def main():
-    global BOT_USERNAME
     init_db()
     bot = Bot(BOT_TOKEN)
     me = await bot.me()
-    BOT_USERNAME = me.username
+    if not me.username:
+        raise RuntimeError("Bot has no username; inline mode needs one")
+    set_bot_username(me.username)
 
     dp = Dispatcher()
     dp.include_router(router)
 
-    asyncio.create_task(giveaways_worker(bot))
-    await dp.start_polling(bot)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            worker = tg.create_task(supervise("giveaways_worker", lambda: giveaways_worker(bot)))
+            try:
+                # start_polling handles SIGINT/SIGTERM and returns; stop the worker with it
+                await dp.start_polling(bot)
+            finally:
+                worker.cancel()
+    finally:
+        # the group has waited for the worker, so nothing uses the connections any more
+        close_pool()
 
 if __name__ == "__main__":
     asyncio.run(main())
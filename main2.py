@@ -23,13 +23,20 @@
 
 import os
 import re
+import hmac
+import time
 import shlex
 import uuid
 import sqlite3
 import hashlib
+import logging
+import queue
 import asyncio
 import secrets
+import threading
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from pathlib import Path
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
@@ -49,6 +56,8 @@ BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
 if not BOT_TOKEN:
     raise RuntimeError("Set BOT_TOKEN in .env (BOT_TOKEN=...)")
 
+log = logging.getLogger("uwallet")
+
 DB_PATH = (os.getenv("DB_PATH") or "uwallet.db").strip() or "uwallet.db"
 
 # Админы по username (без @)
@@ -57,15 +66,27 @@ DEFAULT_ADMINS = {"enzekoin", "motidevch"}
 DEFAULT_RATE_RUB_PER_UWT = 10.0
 MAX_DESC_LEN = 180
 MAX_PASS_LEN = 32
+PAGE_SIZE = 10  # items per list message (my orders, active giveaways, channels)
+
+# Read-mostly settings (the exchange rate) are cached this long
+SETTINGS_CACHE_TTL = 30
+
+MEMBER_CHECK_TIMEOUT = 2.0  # seconds per get_chat_member call in the required-channels gate
+MEMBER_CACHE_TTL = 60
+MEMBER_CACHE_MAX = 10000
+CLAIM_SUBS_TTL = 30  # a gate passed at the deep link also covers the password prompt this long
 
 # Background
 GIVEAWAY_POLL_SEC = 20
 SUBS_POLL_SEC = 120
+WAL_CHECKPOINT_SEC = 60
+WAL_WARN_BYTES = 64 * 1024 * 1024  # log a warning when the WAL grows past this between checkpoints
 
 # Business rules
 CHECK_REQUIRE_SUBS = True  # обязательные подписки для получения чеков (админы добавляют в список)
 
-BOT_USERNAME: str | None = None  # set in main()
+BOT_USERNAME = ""  # set once in main() via set_bot_username()
+START_URL = ""  # "https://t.me/<bot>?start="
 
 # -------------------- HELPERS --------------------
 def utcnow() -> datetime:
@@ -74,15 +95,57 @@ def utcnow() -> datetime:
 def iso(dt: datetime) -> str:
     return dt.replace(microsecond=0).isoformat()
 
+_now_cache: tuple[int, str] = (0, "")
+
 def now_iso() -> str:
-    return iso(utcnow())
+    # second resolution, same as iso(); the string is formatted once per second
+    global _now_cache
+    sec = int(time.time())
+    if sec != _now_cache[0]:
+        _now_cache = (sec, datetime.utcfromtimestamp(sec).isoformat())
+    return _now_cache[1]
 
 def sha256(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
-def fmt_num(x: float) -> str:
-    s = f"{x:.8f}".rstrip("0").rstrip(".")
-    return s if s else "0"
+def _pass_tag(password: str, salt: bytes) -> str:
+    return hashlib.blake2b(password.encode("utf-8"), salt=salt, digest_size=16).hexdigest()
+
+def hash_pass(password: str) -> str:
+    # "<salt hex>$<blake2b tag hex>", random salt per check
+    salt = secrets.token_bytes(16)
+    return f"{salt.hex()}${_pass_tag(password, salt)}"
+
+def pass_ok(password: str, passhash: str) -> bool:
+    salt_hex, sep, tag = passhash.partition("$")
+    if not sep:
+        # checks created before salting carry a bare sha256 hex
+        return hmac.compare_digest(sha256(password), passhash)
+    return hmac.compare_digest(_pass_tag(password, bytes.fromhex(salt_hex)), tag)
+
+# Money is kept as integer minor units: 1 UWT = 10**8, 1 RUB = 100 (kopeks).
+# Exchange prices are kopeks per 1 UWT. Floats only appear at the edges
+# (user input, the admin rate), converted with to_units/from_units.
+UNITS = {"UWT": 10**8, "RUB": 10**2}
+UWT_UNIT = UNITS["UWT"]
+
+def to_units(x: float, asset: str = "UWT") -> int:
+    return round(x * UNITS[asset])
+
+def from_units(i: int, asset: str = "UWT") -> float:
+    return i / UNITS[asset]
+
+def rub_cost(price: int, qty: int) -> int:
+    # kopeks for qty UWT units at price kopeks/UWT, rounded up (what a buy order locks)
+    return -(-price * qty // UWT_UNIT)
+
+def fmt_num(units: int, asset: str = "UWT") -> str:
+    scale = UNITS[asset]
+    whole, frac = divmod(abs(units), scale)
+    s = str(whole)
+    if frac:
+        s += "." + str(frac).rjust(len(str(scale)) - 1, "0").rstrip("0")
+    return "-" + s if units < 0 else s
 
 def clean_username(u: str) -> str:
     return (u or "").strip().lstrip("@").lower()
@@ -119,22 +182,96 @@ async def safe_edit(message, text: str, **kwargs):
         raise
 
 # -------------------- DB --------------------
-def db():
-    con = sqlite3.connect(DB_PATH)
+# Shared SQL texts: one string per statement keeps the per-connection statement cache hitting
+SQL_INSERT_TX = "INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)"
+SQL_CREDIT = {col: f"UPDATE users SET {col}={col}+? WHERE tg_id=?" for col in ("uwt", "rub")}
+# guarded debit: params (amount, tg_id, amount); no row back means the balance is too low
+SQL_DEBIT = {col: f"UPDATE users SET {col}={col}-? WHERE tg_id=? AND {col}>=? RETURNING {col}" for col in ("uwt", "rub")}
+# book_levels keeps SUM(remaining) of open orders per (side, price) for top_book
+SQL_BOOK_ADD = ("INSERT INTO book_levels(side, price, qty_sum) VALUES(?,?,?) "
+                "ON CONFLICT(side, price) DO UPDATE SET qty_sum=qty_sum+excluded.qty_sum")
+SQL_BOOK_REBUILD = ("DELETE FROM book_levels;\n"
+                    "INSERT INTO book_levels(side, price, qty_sum) "
+                    "SELECT side, price, SUM(remaining) FROM orders WHERE status='open' GROUP BY side, price;\n")
+SQL_CHECK_BY_TOKEN = "SELECT * FROM checks WHERE token=?"
+SQL_BILL_BY_TOKEN = "SELECT * FROM bills_uwt WHERE token=?"
+# join only while the giveaway is active; a repeat join is ignored by the PK
+SQL_GW_JOIN = ("INSERT OR IGNORE INTO giveaway_participants(giveaway_id, user_tg_id) "
+               "SELECT ?, ? WHERE EXISTS (SELECT 1 FROM giveaways WHERE id=? AND status='active')")
+SQL_GW_PICK_WINNER = "SELECT user_tg_id FROM giveaway_participants WHERE giveaway_id=? ORDER BY RANDOM() LIMIT 1"
+
+# One writer connection plus a small pool of readers, opened once in init_db()
+# and reused for the life of the process instead of connecting per call.
+DB_MAX_CONNS = max(1, int(os.getenv("DB_MAX_CONNS", "5")))
+
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+_WRITER: sqlite3.Connection | None = None
+_WRITE_LOCK = threading.Lock()
+_READERS: queue.SimpleQueue = queue.SimpleQueue()
+
+def _tune(con: sqlite3.Connection, readonly: bool = False):
+    # applied to every connection: apart from journal_mode these pragmas are per-connection
+    if not readonly:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA wal_autocheckpoint=0")  # checkpoints are done by wal_worker
+    con.execute("PRAGMA synchronous=NORMAL")  # WAL: fsync at checkpoint, not at every commit
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    con.execute("PRAGMA busy_timeout=30000")
+    con.execute("PRAGMA foreign_keys=ON")
+
+def _connect(readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        con = sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True,
+                              check_same_thread=False, cached_statements=256)
+    else:
+        con = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
     con.row_factory = sqlite3.Row
+    _tune(con, readonly)
     return con
 
-def init_db():
-    con = db()
-    cur = con.cursor()
-    cur.executescript("""
-    PRAGMA journal_mode=WAL;
+def init_pool():
+    global _WRITER
+    _WRITER = _connect()
+    for _ in range(DB_MAX_CONNS):
+        _READERS.put(_connect(readonly=True))
+
+def close_pool():
+    # on shutdown: closing the last connection checkpoints and removes the WAL
+    while not _READERS.empty():
+        _READERS.get().close()
+    if _WRITER is not None:
+        with _WRITE_LOCK:
+            _WRITER.close()
+
+@contextmanager
+def get_read_conn():
+    con = _READERS.get()
+    try:
+        yield con
+    finally:
+        _READERS.put(con)
+
+@contextmanager
+def get_write_conn():
+    # SQLite has a single writer anyway; the lock keeps callers from interleaving
+    # statements on the shared connection. Helpers commit explicitly; anything
+    # left open (an exception or a forgotten commit) is rolled back here.
+    with _WRITE_LOCK:
+        try:
+            yield _WRITER
+        finally:
+            if _WRITER.in_transaction:
+                _WRITER.rollback()
 
+SCHEMA = """
     CREATE TABLE IF NOT EXISTS users(
         tg_id INTEGER PRIMARY KEY,
         username TEXT UNIQUE,
-        uwt REAL NOT NULL DEFAULT 0,
-        rub REAL NOT NULL DEFAULT 0,
+        uwt INTEGER NOT NULL DEFAULT 0,
+        rub INTEGER NOT NULL DEFAULT 0,
         created_at TEXT NOT NULL
     );
 
@@ -151,7 +288,7 @@ def init_db():
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         tg_id INTEGER NOT NULL,
         asset TEXT NOT NULL,
-        delta REAL NOT NULL,
+        delta INTEGER NOT NULL,        -- minor units of asset
         kind TEXT NOT NULL,
         meta TEXT,
         created_at TEXT NOT NULL
@@ -162,8 +299,8 @@ def init_db():
         id TEXT PRIMARY KEY,
         token TEXT UNIQUE,
         creator_tg_id INTEGER NOT NULL,
-        total_amount REAL NOT NULL,
-        per_claim REAL NOT NULL,
+        total_amount INTEGER NOT NULL,
+        per_claim INTEGER NOT NULL,
         max_claims INTEGER NOT NULL,
         claimed_count INTEGER NOT NULL DEFAULT 0,
         description TEXT,
@@ -184,7 +321,7 @@ def init_db():
         id TEXT PRIMARY KEY,
         token TEXT UNIQUE,
         creator_tg_id INTEGER NOT NULL,
-        amount REAL NOT NULL,
+        amount INTEGER NOT NULL,
         description TEXT,
         status TEXT NOT NULL,      -- active / paid / cancelled
         paid_by_tg_id INTEGER,
@@ -196,7 +333,7 @@ def init_db():
     CREATE TABLE IF NOT EXISTS giveaways(
         id TEXT PRIMARY KEY,
         creator_tg_id INTEGER NOT NULL,
-        amount REAL NOT NULL,
+        amount INTEGER NOT NULL,
         status TEXT NOT NULL,      -- active / finished
         end_at TEXT NOT NULL,
         winner_tg_id INTEGER,
@@ -214,19 +351,26 @@ def init_db():
         id TEXT PRIMARY KEY,
         user_tg_id INTEGER NOT NULL,
         side TEXT NOT NULL,           -- buy / sell
-        price REAL NOT NULL,          -- RUB per 1 UWT
-        amount REAL NOT NULL,         -- total amount UWT
-        remaining REAL NOT NULL,
+        price INTEGER NOT NULL,       -- kopeks per 1 UWT
+        amount INTEGER NOT NULL,      -- total amount, UWT units
+        remaining INTEGER NOT NULL,
         status TEXT NOT NULL,         -- open / filled / cancelled
         created_at TEXT NOT NULL
     );
 
+    CREATE TABLE IF NOT EXISTS book_levels(
+        side TEXT NOT NULL,
+        price INTEGER NOT NULL,
+        qty_sum INTEGER NOT NULL,
+        PRIMARY KEY(side, price)
+    ) WITHOUT ROWID;
+
     CREATE TABLE IF NOT EXISTS trades(
         id TEXT PRIMARY KEY,
         buy_order_id TEXT NOT NULL,
         sell_order_id TEXT NOT NULL,
-        price REAL NOT NULL,
-        amount REAL NOT NULL,
+        price INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
         created_at TEXT NOT NULL
     );
 
@@ -237,7 +381,7 @@ def init_db():
         chat_id INTEGER NOT NULL UNIQUE,
         title TEXT,
         username TEXT,
-        price_uwt REAL NOT NULL,
+        price_uwt INTEGER NOT NULL,
         invite_link TEXT,
         created_at TEXT NOT NULL
     );
@@ -258,113 +402,235 @@ def init_db():
         username TEXT,
         added_at TEXT NOT NULL
     );
-    """)
+"""
+
+SCHEMA_INDEXES = """
+    -- Indexes for the hot lookups (history, order book, my orders, expiring subs)
+    CREATE INDEX IF NOT EXISTS ix_tx_user_id ON tx(tg_id, id);
+    CREATE INDEX IF NOT EXISTS ix_orders_open_buy ON orders(price DESC, created_at) WHERE status='open' AND side='buy';
+    CREATE INDEX IF NOT EXISTS ix_orders_open_sell ON orders(price, created_at) WHERE status='open' AND side='sell';
+    CREATE INDEX IF NOT EXISTS ix_orders_user ON orders(user_tg_id, created_at);
+    CREATE INDEX IF NOT EXISTS ix_channel_subs_expires ON channel_subs(expires_at);
+    -- due giveaways and the active list; channel_subs(channel_id, user_tg_id) and
+    -- giveaway_participants(giveaway_id, ...) are already covered by their UNIQUE/PK indexes
+    CREATE INDEX IF NOT EXISTS ix_giveaways_status_end ON giveaways(status, end_at);
+    CREATE INDEX IF NOT EXISTS ix_giveaways_status_created ON giveaways(status, created_at);
+"""
+
+# Money columns and their scale, for the one-time REAL -> INTEGER migration
+MONEY_COLUMNS = {
+    "users": {"uwt": UNITS["UWT"], "rub": UNITS["RUB"]},
+    "tx": {"delta": f"CASE asset WHEN 'RUB' THEN {UNITS['RUB']} ELSE {UNITS['UWT']} END"},
+    "checks": {"total_amount": UNITS["UWT"], "per_claim": UNITS["UWT"]},
+    "bills_uwt": {"amount": UNITS["UWT"]},
+    "giveaways": {"amount": UNITS["UWT"]},
+    "orders": {"price": UNITS["RUB"], "amount": UNITS["UWT"], "remaining": UNITS["UWT"]},
+    "trades": {"price": UNITS["RUB"], "amount": UNITS["UWT"]},
+    "channels": {"price_uwt": UNITS["UWT"]},
+}
+SCHEMA_VERSION = 2  # 1: money as integer units, 2: book_levels
+
+def _migrate_money(cur: sqlite3.Cursor) -> tuple[str, str]:
+    # Pre-v1 databases keep money as REAL: rename those tables aside, let SCHEMA
+    # recreate them, copy the rows over scaled to units and drop the old ones.
+    # Returns (before, after) script parts that init_db runs in its transaction.
+    cur.execute("SELECT type FROM pragma_table_info('users') WHERE name='uwt'")
+    row = cur.fetchone()
+    if not row or row["type"].upper() != "REAL":
+        return "", ""
+    renames = "".join(f"ALTER TABLE {t} RENAME TO {t}_real;\n" for t in MONEY_COLUMNS)
+    copies = ""
+    for t, cols in MONEY_COLUMNS.items():
+        cur.execute(f"SELECT name FROM pragma_table_info('{t}')")
+        names = [r["name"] for r in cur.fetchall()]
+        exprs = [f"CAST(ROUND({n}*{cols[n]}) AS INTEGER)" if n in cols else n for n in names]
+        copies += f"INSERT INTO {t}({', '.join(names)}) SELECT {', '.join(exprs)} FROM {t}_real;\nDROP TABLE {t}_real;\n"
+    return renames, copies
+
+def init_db():
+    con = _connect()
+    cur = con.cursor()
+    cur.execute("PRAGMA user_version")
+    version = cur.fetchone()[0]
+    renames, copies = _migrate_money(cur) if version < 1 else ("", "")
+    if version < 2:
+        copies += SQL_BOOK_REBUILD
+    cur.executescript("BEGIN IMMEDIATE;\n" + renames + SCHEMA + copies + SCHEMA_INDEXES + f"PRAGMA user_version={SCHEMA_VERSION};\nCOMMIT;")
 
     cur.execute("INSERT OR IGNORE INTO settings(k,v) VALUES('rate_rub_per_uwt', ?)", (str(DEFAULT_RATE_RUB_PER_UWT),))
     for a in DEFAULT_ADMINS:
         cur.execute("INSERT OR IGNORE INTO admins(username) VALUES(?)", (a,))
     con.commit()
     con.close()
+    init_pool()
+    reload_admins()
+    reload_req_channels()
+
+
+# tg_id -> username already written this process; skips the write on repeat calls
+_SEEN_USERS: dict[int, str] = {}
+SEEN_USERS_MAX = 10000
 
 def ensure_user(tg_id: int, username: str):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO users(tg_id, username, uwt, rub, created_at) VALUES(?,?,?,?,?)",
-        (tg_id, username.lower(), 0.0, 0.0, now_iso())
-    )
-    cur.execute("UPDATE users SET username=? WHERE tg_id=?", (username.lower(), tg_id))
-    con.commit()
-    con.close()
+    u = username.lower()
+    if _SEEN_USERS.get(tg_id) == u:
+        return
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(
+            "INSERT INTO users(tg_id, username, uwt, rub, created_at) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(tg_id) DO UPDATE SET username=excluded.username WHERE users.username IS NOT excluded.username",
+            (tg_id, u, 0, 0, now_iso())
+        )
+        con.commit()
+    if len(_SEEN_USERS) >= SEEN_USERS_MAX:
+        del _SEEN_USERS[next(iter(_SEEN_USERS))]
+    _SEEN_USERS[tg_id] = u
+
+# key -> (expires_at, epoch, value); writers bump the epoch so stale entries are ignored
+_settings_cache: dict[str, tuple[float, int, object]] = {}
+_cache_epoch = 0
+
+def _cached(key: str, load):
+    now = time.monotonic()
+    hit = _settings_cache.get(key)
+    if hit and hit[0] > now and hit[1] == _cache_epoch:
+        return hit[2]
+    val = load()
+    _settings_cache[key] = (now + SETTINGS_CACHE_TTL, _cache_epoch, val)
+    return val
+
+def invalidate_settings_cache():
+    global _cache_epoch
+    _cache_epoch += 1
+
+# admins table is tiny and only changes through admin_add/admin_remove:
+# keep it in memory, loaded at startup and reloaded after every change
+_ADMINS: frozenset[str] = frozenset()
+
+def reload_admins():
+    global _ADMINS
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT username FROM admins")
+        _ADMINS = frozenset(r["username"] for r in cur.fetchall())
+
+def admin_add(username: str):
+    with get_write_conn() as con:
+        con.execute("INSERT OR IGNORE INTO admins(username) VALUES(?)", (clean_username(username),))
+        con.commit()
+    reload_admins()
+
+def admin_remove(username: str):
+    with get_write_conn() as con:
+        con.execute("DELETE FROM admins WHERE username=?", (clean_username(username),))
+        con.commit()
+    reload_admins()
 
 def is_admin(username: str | None) -> bool:
     u = clean_username(username or "")
     if not u:
         return False
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT 1 FROM admins WHERE username=?", (u,))
-    ok = cur.fetchone() is not None
-    con.close()
-    return ok
+    return u in _ADMINS
 
-def get_rate() -> float:
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT v FROM settings WHERE k='rate_rub_per_uwt'")
-    row = cur.fetchone()
-    con.close()
+def _load_rate() -> float:
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT v FROM settings WHERE k='rate_rub_per_uwt'")
+        row = cur.fetchone()
     try:
         return float(row["v"]) if row else DEFAULT_RATE_RUB_PER_UWT
     except Exception:
         return DEFAULT_RATE_RUB_PER_UWT
 
+def get_rate() -> float:
+    return _cached("rate", _load_rate)
+
 def set_rate(v: float):
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE settings SET v=? WHERE k='rate_rub_per_uwt'", (str(v),))
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("UPDATE settings SET v=? WHERE k='rate_rub_per_uwt'", (str(v),))
+        con.commit()
+    invalidate_settings_cache()
 
-def get_balances(tg_id: int) -> tuple[float, float]:
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT uwt, rub FROM users WHERE tg_id=?", (tg_id,))
-    row = cur.fetchone()
-    con.close()
+def get_balances(tg_id: int) -> tuple[int, int]:
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT uwt, rub FROM users WHERE tg_id=?", (tg_id,))
+        row = cur.fetchone()
     if not row:
-        return (0.0, 0.0)
-    return (float(row["uwt"]), float(row["rub"]))
+        return (0, 0)
+    return (row["uwt"], row["rub"])
 
-def add_asset(tg_id: int, asset: str, delta: float, kind: str, meta: str = ""):
-    con = db()
-    cur = con.cursor()
-    if asset == "UWT":
-        cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (delta, tg_id))
-    elif asset == "RUB":
-        cur.execute("UPDATE users SET rub=rub+? WHERE tg_id=?", (delta, tg_id))
-    else:
-        con.close()
-        raise ValueError("Bad asset")
+def add_asset(tg_id: int, asset: str, delta: int, kind: str, meta: str = ""):
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        if asset == "UWT":
+            cur.execute(SQL_CREDIT["uwt"], (delta, tg_id))
+        elif asset == "RUB":
+            cur.execute(SQL_CREDIT["rub"], (delta, tg_id))
+        else:
+            raise ValueError("Bad asset")
 
-    cur.execute(
-        "INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-        (tg_id, asset, float(delta), kind, meta, now_iso())
-    )
-    con.commit()
-    con.close()
+        cur.execute(
+            SQL_INSERT_TX,
+            (tg_id, asset, int(delta), kind, meta, now_iso())
+        )
+        con.commit()
 
 def last_txs(tg_id: int, limit: int = 15):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM tx WHERE tg_id=? ORDER BY id DESC LIMIT ?", (tg_id, limit))
-    rows = cur.fetchall()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT * FROM tx WHERE tg_id=? ORDER BY id DESC LIMIT ?", (tg_id, limit))
+        rows = cur.fetchall()
     return rows
 
+def _emit_tx(cur: sqlite3.Cursor, rows: list[tuple]):
+    # rows: (tg_id, asset, delta, kind, meta, created_at)
+    cur.executemany(SQL_INSERT_TX, rows)
+
+def _credit_users(cur: sqlite3.Cursor, col: str, deltas: dict[int, int]):
+    # one UPDATE for several users: col = col + CASE tg_id WHEN ? THEN ? ... END
+    if not deltas:
+        return
+    whens = " ".join("WHEN ? THEN ?" for _ in deltas)
+    marks = ",".join("?" * len(deltas))
+    cur.execute(f"UPDATE users SET {col}={col}+CASE tg_id {whens} END WHERE tg_id IN ({marks})",
+                [x for item in deltas.items() for x in item] + list(deltas))
+
 # -------------------- REQUIRED CHANNELS (checks gate) --------------------
+# same for the handful of required channels: in memory, reloaded on add/remove
+_REQ_CHANNELS: list[sqlite3.Row] = []
+
+def reload_req_channels():
+    global _REQ_CHANNELS
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT * FROM required_channels ORDER BY added_at DESC")
+        _REQ_CHANNELS = cur.fetchall()
+
 def req_channels_list():
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM required_channels ORDER BY added_at DESC")
-    rows = cur.fetchall()
-    con.close()
-    return rows
+    return _REQ_CHANNELS
 
 def req_channels_add(chat_id: int, title: str | None, username: str | None):
-    con = db()
-    cur = con.cursor()
-    cur.execute("INSERT OR REPLACE INTO required_channels(chat_id, title, username, added_at) VALUES(?,?,?,?)",
-                (chat_id, title, username, now_iso()))
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("INSERT OR REPLACE INTO required_channels(chat_id, title, username, added_at) VALUES(?,?,?,?)",
+                    (chat_id, title, username, now_iso()))
+        con.commit()
+    reload_req_channels()
 
 def req_channels_remove(chat_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("DELETE FROM required_channels WHERE chat_id=?", (chat_id,))
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("DELETE FROM required_channels WHERE chat_id=?", (chat_id,))
+        con.commit()
+    reload_req_channels()
+
+# (chat_id, user_id) -> (expires_at, status) for get_chat_member results
+_membership_cache: dict[tuple[int, int], tuple[float, str]] = {}
 
 async def user_in_required_channels(bot: Bot, user_id: int) -> tuple[bool, list[str]]:
     """
@@ -373,223 +639,218 @@ async def user_in_required_channels(bot: Bot, user_id: int) -> tuple[bool, list[
     if not CHECK_REQUIRE_SUBS:
         return True, []
     rows = req_channels_list()
+    now = time.monotonic()
+    chats = [int(r["chat_id"]) for r in rows]
+    statuses = {}
+    for chat_id in chats:
+        hit = _membership_cache.get((chat_id, user_id))
+        if hit and hit[0] > now:
+            statuses[chat_id] = hit[1]
+    todo = [c for c in chats if c not in statuses]
+    # the rest are checked concurrently; one slow chat can't hold up the others
+    results = await asyncio.gather(
+        *(asyncio.wait_for(bot.get_chat_member(c, user_id), timeout=MEMBER_CHECK_TIMEOUT) for c in todo),
+        return_exceptions=True
+    )
+    if len(_membership_cache) > MEMBER_CACHE_MAX:
+        _membership_cache.clear()
+    for chat_id, cm in zip(todo, results):
+        # if bot can't check (error/timeout) -> treat as missing
+        status = "left" if isinstance(cm, BaseException) else cm.status
+        statuses[chat_id] = status
+        # only memberships are cached: a user told to subscribe is re-checked on the next try
+        if status not in ("left", "kicked"):
+            _membership_cache[(chat_id, user_id)] = (now + MEMBER_CACHE_TTL, status)
     missing = []
-    for r in rows:
-        chat_id = int(r["chat_id"])
-        title = r["title"] or (f"@{r['username']}" if r["username"] else str(chat_id))
-        try:
-            cm = await bot.get_chat_member(chat_id, user_id)
-            # statuses: creator, administrator, member, restricted, left, kicked
-            if cm.status in ("left", "kicked"):
-                missing.append(title)
-        except Exception:
-            # if bot can't check -> treat as missing
-            missing.append(title)
+    for r, chat_id in zip(rows, chats):
+        # statuses: creator, administrator, member, restricted, left, kicked
+        if statuses[chat_id] in ("left", "kicked"):
+            missing.append(r["title"] or (f"@{r['username']}" if r["username"] else str(chat_id)))
     return (len(missing) == 0), missing
 
 # -------------------- CHECKS --------------------
-def create_check_multi(creator_id: int, total_amount: float, per_claim: float, max_claims: int,
+def create_check_multi(creator_id: int, total_amount: int, per_claim: int, max_claims: int,
                        desc: str | None, password: str | None) -> tuple[bool, str]:
     if total_amount <= 0 or per_claim <= 0 or max_claims <= 0:
         return (False, "Суммы и количество должны быть > 0")
     required = per_claim * max_claims
-    if total_amount + 1e-12 < required:
+    if total_amount < required:
         return (False, f"❌ Общая сумма меньше чем per_claim*max_claims ({fmt_num(required)})")
 
-    uwt, _ = get_balances(creator_id)
-    if uwt + 1e-12 < total_amount:
-        return (False, "❌ Недостаточно UWT")
-
     token = secrets.token_urlsafe(8)
     check_id = str(uuid.uuid4())
-    ph = sha256(password) if password else None
+    ph = hash_pass(password) if password else None
 
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (total_amount, creator_id))
-    cur.execute(
-        "INSERT INTO checks(id, token, creator_tg_id, total_amount, per_claim, max_claims, claimed_count, description, passhash, status, created_at) "
-        "VALUES(?,?,?,?,?,?,0,?,?,'active',?)",
-        (check_id, token, creator_id, total_amount, per_claim, int(max_claims), desc, ph, now_iso())
-    )
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (creator_id, "UWT", -total_amount, "check_create", f"token={token};total={total_amount};per={per_claim};max={max_claims}", now_iso()))
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        cur.execute(SQL_DEBIT["uwt"],
+                    (total_amount, creator_id, total_amount))
+        if cur.fetchone() is None:
+            return (False, "❌ Недостаточно UWT")
+        cur.execute(
+            "INSERT INTO checks(id, token, creator_tg_id, total_amount, per_claim, max_claims, claimed_count, description, passhash, status, created_at) "
+            "VALUES(?,?,?,?,?,?,0,?,?,'active',?)",
+            (check_id, token, creator_id, total_amount, per_claim, int(max_claims), desc, ph, ts)
+        )
+        cur.execute(SQL_INSERT_TX,
+                    (creator_id, "UWT", -total_amount, "check_create", f"token={token};total={fmt_num(total_amount)};per={fmt_num(per_claim)};max={max_claims}", ts))
+        con.commit()
     return (True, token)
 
 def check_info(token: str):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM checks WHERE token=?", (token,))
-    row = cur.fetchone()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute(SQL_CHECK_BY_TOKEN, (token,))
+        row = cur.fetchone()
     return row
 
 def claim_check_by_token(token: str, user_id: int, password: str | None) -> tuple[bool, str, dict | None]:
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM checks WHERE token=?", (token,))
-    row = cur.fetchone()
-    if not row:
-        con.close()
-        return (False, "❌ Чек не найден", None)
-    if row["status"] != "active":
-        con.close()
-        return (False, "❌ Чек недоступен", None)
-
-    if row["passhash"]:
-        if not password:
-            con.close()
-            return (False, "__NEED_PASS__", {"need_pass": True, "token": token})
-        if sha256(password) != row["passhash"]:
-            con.close()
-            return (False, "❌ Неверный пароль", None)
-
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("SELECT 1 FROM check_claims WHERE check_id=? AND user_tg_id=?", (row["id"], user_id))
-    if cur.fetchone():
-        con.rollback(); con.close()
-        return (False, "⚠️ Вы уже получали из этого чека", None)
-
-    cur.execute("SELECT claimed_count, max_claims, per_claim FROM checks WHERE token=? AND status='active'", (token,))
-    r2 = cur.fetchone()
-    if not r2:
-        con.rollback(); con.close()
-        return (False, "❌ Чек недоступен", None)
-
-    claimed = int(r2["claimed_count"])
-    maxc = int(r2["max_claims"])
-    if claimed >= maxc:
-        cur.execute("UPDATE checks SET status='finished' WHERE token=?", (token,))
-        con.commit(); con.close()
-        return (False, "❌ Чек закончился", None)
-
-    per = float(r2["per_claim"])
-    cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (per, user_id))
-    cur.execute("INSERT INTO check_claims(check_id, user_tg_id, claimed_at) VALUES(?,?,?)",
-                (row["id"], user_id, now_iso()))
-    cur.execute("UPDATE checks SET claimed_count=claimed_count+1 WHERE token=?", (token,))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (user_id, "UWT", per, "check_claim", f"token={token}", now_iso()))
-
-    cur.execute("SELECT claimed_count, max_claims FROM checks WHERE token=?", (token,))
-    rr = cur.fetchone()
-    left = 0
-    if rr:
-        left = int(rr["max_claims"]) - int(rr["claimed_count"])
-        if left <= 0:
-            cur.execute("UPDATE checks SET status='finished' WHERE token=?", (token,))
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        # take one claim atomically; the last one also finishes the check
+        cur.execute(
+            "UPDATE checks SET claimed_count=claimed_count+1, "
+            "status=CASE WHEN claimed_count+1>=max_claims THEN 'finished' ELSE status END "
+            "WHERE token=? AND status='active' AND claimed_count<max_claims "
+            "RETURNING id, per_claim, max_claims-claimed_count AS left, passhash",
+            (token,)
+        )
+        row = cur.fetchone()
+        if not row:
+            cur.execute("SELECT status FROM checks WHERE token=?", (token,))
+            r = cur.fetchone()
+            if not r:
+                return (False, "❌ Чек не найден", None)
+            if r["status"] == "active":
+                # exhausted but never marked (checks from before the CASE above)
+                cur.execute("UPDATE checks SET status='finished' WHERE token=?", (token,))
+                con.commit()
+                return (False, "❌ Чек закончился", None)
+            return (False, "❌ Чек недоступен", None)
+
+        # nothing is committed until the password and the duplicate check pass
+        if row["passhash"]:
+            if not password:
+                return (False, "__NEED_PASS__", {"need_pass": True, "token": token})
+            if not pass_ok(password, row["passhash"]):
+                return (False, "❌ Неверный пароль", None)
+
+        cur.execute("INSERT OR IGNORE INTO check_claims(check_id, user_tg_id, claimed_at) VALUES(?,?,?)",
+                    (row["id"], user_id, ts))
+        if cur.rowcount != 1:
+            return (False, "⚠️ Вы уже получали из этого чека", None)
+
+        per = row["per_claim"]
+        left = row["left"]
+        cur.execute(SQL_CREDIT["uwt"], (per, user_id))
+        cur.execute(SQL_INSERT_TX,
+                    (user_id, "UWT", per, "check_claim", f"token={token}", ts))
+        con.commit()
     return (True, f"✅ Вы получили {fmt_num(per)} UWT. Осталось получений: {left}", None)
 
 # -------------------- BILLS --------------------
-def create_bill_uwt_by_token(creator_id: int, amount: float, desc: str | None) -> tuple[bool, str]:
+def create_bill_uwt_by_token(creator_id: int, amount: int, desc: str | None) -> tuple[bool, str]:
     if amount <= 0:
         return (False, "Сумма должна быть > 0")
     token = secrets.token_urlsafe(8)
     bill_id = str(uuid.uuid4())
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO bills_uwt(id, token, creator_tg_id, amount, description, status, created_at) "
-        "VALUES(?,?,?,?,?,'active',?)",
-        (bill_id, token, creator_id, amount, desc, now_iso())
-    )
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute(
+            "INSERT INTO bills_uwt(id, token, creator_tg_id, amount, description, status, created_at) "
+            "VALUES(?,?,?,?,?,'active',?)",
+            (bill_id, token, creator_id, amount, desc, now_iso())
+        )
+        con.commit()
     return (True, token)
 
 def bill_info(token: str):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM bills_uwt WHERE token=?", (token,))
-    row = cur.fetchone()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute(SQL_BILL_BY_TOKEN, (token,))
+        row = cur.fetchone()
     return row
 
 def pay_bill_by_token(token: str, payer_id: int) -> tuple[bool, str]:
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM bills_uwt WHERE token=?", (token,))
-    b = cur.fetchone()
-    if not b:
-        con.close()
-        return (False, "❌ Счёт не найден")
-    if b["status"] != "active":
-        con.close()
-        return (False, "❌ Счёт недоступен")
-    creator = int(b["creator_tg_id"])
-    if creator == payer_id:
-        con.close()
-        return (False, "❌ Нельзя оплатить самому себе")
-
-    amount = float(b["amount"])
-    uwt, _ = get_balances(payer_id)
-    if uwt + 1e-12 < amount:
-        con.close()
-        return (False, "❌ Недостаточно UWT")
-
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE bills_uwt SET status='paid', paid_by_tg_id=?, paid_at=? WHERE token=? AND status='active'",
-                (payer_id, now_iso(), token))
-    if cur.rowcount != 1:
-        con.rollback(); con.close()
-        return (False, "❌ Уже оплачено/недоступно")
-
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (amount, payer_id))
-    cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, creator))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (payer_id, "UWT", -amount, "bill_pay", f"token={token}", now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (creator, "UWT", amount, "bill_receive", f"token={token}", now_iso()))
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        cur.execute(SQL_BILL_BY_TOKEN, (token,))
+        b = cur.fetchone()
+        if not b:
+            return (False, "❌ Счёт не найден")
+        if b["status"] != "active":
+            return (False, "❌ Счёт недоступен")
+        creator = int(b["creator_tg_id"])
+        if creator == payer_id:
+            return (False, "❌ Нельзя оплатить самому себе")
+
+        amount = b["amount"]
+        cur.execute(SQL_DEBIT["uwt"], (amount, payer_id, amount))
+        if cur.fetchone() is None:
+            return (False, "❌ Недостаточно UWT")
+
+        cur.execute("UPDATE bills_uwt SET status='paid', paid_by_tg_id=?, paid_at=? WHERE token=? AND status='active'",
+                    (payer_id, ts, token))
+        if cur.rowcount != 1:
+            return (False, "❌ Уже оплачено/недоступно")
+
+        cur.execute(SQL_CREDIT["uwt"], (amount, creator))
+        _emit_tx(cur, [
+            (payer_id, "UWT", -amount, "bill_pay", f"token={token}", ts),
+            (creator, "UWT", amount, "bill_receive", f"token={token}", ts),
+        ])
+        con.commit()
     return (True, f"✅ Оплачено {fmt_num(amount)} UWT")
 
 # -------------------- EXCHANGE (AUTO) --------------------
-def exchange_buy(uid: int, rub_amount: float) -> tuple[bool, str]:
+def exchange_buy(uid: int, rub_amount: int) -> tuple[bool, str]:
     if rub_amount <= 0:
         return False, "Сумма должна быть > 0"
     rate = get_rate()
-    uwt, rub = get_balances(uid)
-    if rub + 1e-12 < rub_amount:
-        return False, "❌ Недостаточно RUB"
-    uwt_get = rub_amount / rate
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET rub=rub-?, uwt=uwt+? WHERE tg_id=?", (rub_amount, uwt_get, uid))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (uid, "RUB", -rub_amount, "exchange_buy", f"rate={rate}", now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (uid, "UWT", uwt_get, "exchange_buy", f"rate={rate}", now_iso()))
-    con.commit(); con.close()
-    return True, f"✅ Куплено {fmt_num(uwt_get)} UWT за {rub_amount:g} ₽ (курс {rate:g} ₽/UWT)"
-
-def exchange_sell(uid: int, uwt_amount: float) -> tuple[bool, str]:
+    uwt_get = to_units(from_units(rub_amount, "RUB") / rate)
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        cur.execute("UPDATE users SET rub=rub-?, uwt=uwt+? WHERE tg_id=? AND rub>=? RETURNING rub",
+                    (rub_amount, uwt_get, uid, rub_amount))
+        if cur.fetchone() is None:
+            return False, "❌ Недостаточно RUB"
+        _emit_tx(cur, [
+            (uid, "RUB", -rub_amount, "exchange_buy", f"rate={rate}", ts),
+            (uid, "UWT", uwt_get, "exchange_buy", f"rate={rate}", ts),
+        ])
+        con.commit()
+    return True, f"✅ Куплено {fmt_num(uwt_get)} UWT за {fmt_num(rub_amount, 'RUB')} ₽ (курс {rate:g} ₽/UWT)"
+
+def exchange_sell(uid: int, uwt_amount: int) -> tuple[bool, str]:
     if uwt_amount <= 0:
         return False, "Сумма должна быть > 0"
     rate = get_rate()
-    uwt, rub = get_balances(uid)
-    if uwt + 1e-12 < uwt_amount:
-        return False, "❌ Недостаточно UWT"
-    rub_get = uwt_amount * rate
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-?, rub=rub+? WHERE tg_id=?", (uwt_amount, rub_get, uid))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (uid, "UWT", -uwt_amount, "exchange_sell", f"rate={rate}", now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (uid, "RUB", rub_get, "exchange_sell", f"rate={rate}", now_iso()))
-    con.commit(); con.close()
-    return True, f"✅ Продано {fmt_num(uwt_amount)} UWT за {rub_get:g} ₽ (курс {rate:g} ₽/UWT)"
+    rub_get = to_units(from_units(uwt_amount) * rate, "RUB")
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        cur.execute("UPDATE users SET uwt=uwt-?, rub=rub+? WHERE tg_id=? AND uwt>=? RETURNING uwt",
+                    (uwt_amount, rub_get, uid, uwt_amount))
+        if cur.fetchone() is None:
+            return False, "❌ Недостаточно UWT"
+        _emit_tx(cur, [
+            (uid, "UWT", -uwt_amount, "exchange_sell", f"rate={rate}", ts),
+            (uid, "RUB", rub_get, "exchange_sell", f"rate={rate}", ts),
+        ])
+        con.commit()
+    return True, f"✅ Продано {fmt_num(uwt_amount)} UWT за {fmt_num(rub_get, 'RUB')} ₽ (курс {rate:g} ₽/UWT)"
 
 # -------------------- P2P TRANSFER --------------------
-def p2p_transfer(from_id: int, to_username: str, asset: str, amount: float) -> tuple[bool, str, int | None]:
+def p2p_transfer(from_id: int, to_username: str, asset: str, amount: int) -> tuple[bool, str, int | None]:
     asset = asset.upper()
     if asset not in ("UWT", "RUB"):
         return False, "Актив должен быть UWT или RUB", None
@@ -597,70 +858,69 @@ def p2p_transfer(from_id: int, to_username: str, asset: str, amount: float) -> t
         return False, "Сумма должна быть > 0", None
 
     to_u = clean_username(to_username)
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT tg_id FROM users WHERE username=?", (to_u,))
-    row = cur.fetchone()
-    if not row:
-        con.close()
-        return False, "❌ Пользователь не найден (он должен хоть раз нажать /start у бота)", None
-    to_id = int(row["tg_id"])
-
-    uwt, rub = get_balances(from_id)
-    bal = uwt if asset == "UWT" else rub
-    if bal + 1e-12 < amount:
-        con.close()
-        return False, f"❌ Недостаточно {asset}", None
-
-    cur.execute("BEGIN IMMEDIATE")
-    if asset == "UWT":
-        cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (amount, from_id))
-        cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, to_id))
-    else:
-        cur.execute("UPDATE users SET rub=rub-? WHERE tg_id=?", (amount, from_id))
-        cur.execute("UPDATE users SET rub=rub+? WHERE tg_id=?", (amount, to_id))
-
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (from_id, asset, -amount, "p2p_send", f"to={to_u}", now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (to_id, asset, amount, "p2p_recv", f"from={from_id}", now_iso()))
-    con.commit(); con.close()
-    return True, f"✅ Отправлено {fmt_num(amount)} {asset} пользователю @{to_u}", to_id
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        # sender balance and recipient resolved in one lookup
+        cur.execute("SELECT tg_id, username, uwt, rub FROM users WHERE tg_id IN (?, (SELECT tg_id FROM users WHERE username=?))",
+                    (from_id, to_u))
+        rows = cur.fetchall()
+        to_row = next((r for r in rows if r["username"] == to_u), None)
+        if not to_row:
+            return False, "❌ Пользователь не найден (он должен хоть раз нажать /start у бота)", None
+        to_id = int(to_row["tg_id"])
+
+        col = "uwt" if asset == "UWT" else "rub"
+        from_row = next((r for r in rows if r["tg_id"] == from_id), None)
+        if not from_row or from_row[col] < amount:
+            return False, f"❌ Недостаточно {asset}", None
+        cur.executemany(SQL_CREDIT[col], [(-amount, from_id), (amount, to_id)])
+
+        _emit_tx(cur, [
+            (from_id, asset, -amount, "p2p_send", f"to={to_u}", ts),
+            (to_id, asset, amount, "p2p_recv", f"from={from_id}", ts),
+        ])
+        con.commit()
+    return True, f"✅ Отправлено {fmt_num(amount, asset)} {asset} пользователю @{to_u}", to_id
 
 # -------------------- BIRZA (ORDERBOOK + MATCH) --------------------
-def _order_lock_funds(cur: sqlite3.Cursor, uid: int, side: str, price: float, amount: float):
+def _order_lock_funds(cur: sqlite3.Cursor, uid: int, side: str, price: int, amount: int, ts: str):
     if side == "buy":
-        cost = price * amount
-        cur.execute("SELECT rub FROM users WHERE tg_id=?", (uid,))
-        rub = float(cur.fetchone()["rub"])
-        if rub + 1e-12 < cost:
+        cost = rub_cost(price, amount)
+        cur.execute(SQL_DEBIT["rub"], (cost, uid, cost))
+        if cur.fetchone() is None:
             raise ValueError("Недостаточно RUB")
-        cur.execute("UPDATE users SET rub=rub-? WHERE tg_id=?", (cost, uid))
-        cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                    (uid, "RUB", -cost, "order_lock", f"buy cost={cost:g}", now_iso()))
+        cur.execute(SQL_INSERT_TX,
+                    (uid, "RUB", -cost, "order_lock", f"buy cost={fmt_num(cost, 'RUB')}", ts))
     else:
-        cur.execute("SELECT uwt FROM users WHERE tg_id=?", (uid,))
-        uwt = float(cur.fetchone()["uwt"])
-        if uwt + 1e-12 < amount:
+        cur.execute(SQL_DEBIT["uwt"], (amount, uid, amount))
+        if cur.fetchone() is None:
             raise ValueError("Недостаточно UWT")
-        cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (amount, uid))
-        cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                    (uid, "UWT", -amount, "order_lock", f"sell amt={amount:g}", now_iso()))
+        cur.execute(SQL_INSERT_TX,
+                    (uid, "UWT", -amount, "order_lock", f"sell amt={fmt_num(amount)}", ts))
 
-def _order_refund(cur: sqlite3.Cursor, uid: int, side: str, price: float, remaining: float):
+def _order_refund(cur: sqlite3.Cursor, uid: int, side: str, price: int, remaining: int, ts: str):
     if remaining <= 0:
         return
     if side == "buy":
-        refund = price * remaining
-        cur.execute("UPDATE users SET rub=rub+? WHERE tg_id=?", (refund, uid))
-        cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                    (uid, "RUB", refund, "order_refund", "", now_iso()))
+        refund = rub_cost(price, remaining)
+        cur.execute(SQL_CREDIT["rub"], (refund, uid))
+        cur.execute(SQL_INSERT_TX,
+                    (uid, "RUB", refund, "order_refund", "", ts))
     else:
-        cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (remaining, uid))
-        cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                    (uid, "UWT", remaining, "order_refund", "", now_iso()))
-
-def place_order(uid: int, side: str, price: float, amount: float) -> tuple[bool, str]:
+        cur.execute(SQL_CREDIT["uwt"], (remaining, uid))
+        cur.execute(SQL_INSERT_TX,
+                    (uid, "UWT", remaining, "order_refund", "", ts))
+
+def _book_add(cur: sqlite3.Cursor, rows: list[tuple]):
+    # rows: (side, price, qty delta); levels that drop to zero are removed
+    rows = [r for r in rows if r[2]]
+    cur.executemany(SQL_BOOK_ADD, rows)
+    cur.executemany("DELETE FROM book_levels WHERE side=? AND price=? AND qty_sum<=0",
+                    [(side, price) for side, price, d in rows if d < 0])
+
+def place_order(uid: int, side: str, price: int, amount: int) -> tuple[bool, str]:
     side = side.lower()
     if side not in ("buy", "sell"):
         return False, "side должен быть buy/sell"
@@ -668,312 +928,418 @@ def place_order(uid: int, side: str, price: float, amount: float) -> tuple[bool,
         return False, "Цена и количество должны быть > 0"
 
     oid = str(uuid.uuid4())
-    con = db()
-    cur = con.cursor()
-    try:
-        cur.execute("BEGIN IMMEDIATE")
-        _order_lock_funds(cur, uid, side, price, amount)
-        cur.execute("INSERT INTO orders(id,user_tg_id,side,price,amount,remaining,status,created_at) VALUES(?,?,?,?,?,?, 'open', ?)",
-                    (oid, uid, side, price, amount, amount, now_iso()))
-        con.commit()
-    except Exception as e:
-        con.rollback(); con.close()
-        return False, f"❌ {e}"
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            ts = now_iso()
+            _order_lock_funds(cur, uid, side, price, amount, ts)
+            cur.execute("INSERT INTO orders(id,user_tg_id,side,price,amount,remaining,status,created_at) VALUES(?,?,?,?,?,?, 'open', ?)",
+                        (oid, uid, side, price, amount, amount, ts))
+            _book_add(cur, [(side, price, amount)])
+            con.commit()
+        except Exception as e:
+            con.rollback()
+            return False, f"❌ {e}"
 
     # Match immediately
     match_orders()
-    return True, f"✅ Ордер создан: {side.upper()} {fmt_num(amount)} UWT по {price:g} ₽"
+    return True, f"✅ Ордер создан: {side.upper()} {fmt_num(amount)} UWT по {fmt_num(price, 'RUB')} ₽"
 
 def match_orders():
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-
-    # Buy orders: highest price first
-    cur.execute("SELECT * FROM orders WHERE status='open' AND side='buy' ORDER BY price DESC, created_at ASC")
-    buys = cur.fetchall()
-    # Sell orders: lowest price first
-    cur.execute("SELECT * FROM orders WHERE status='open' AND side='sell' ORDER BY price ASC, created_at ASC")
-    sells = cur.fetchall()
+    # Price-time priority: both books are read once and walked with two cursors.
+    # Inside the BEGIN IMMEDIATE transaction the local `remaining` values are
+    # authoritative, so nothing is re-read; all writes are flushed in bulk at the end.
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
 
-    def refresh_order(oid: str):
-        cur.execute("SELECT * FROM orders WHERE id=?", (oid,))
-        return cur.fetchone()
-
-    for b in buys:
-        b = refresh_order(b["id"])
-        if not b or b["status"] != "open" or float(b["remaining"]) <= 1e-12:
-            continue
-        for s in sells:
-            s = refresh_order(s["id"])
-            if not s or s["status"] != "open" or float(s["remaining"]) <= 1e-12:
-                continue
-            buy_price = float(b["price"])
-            sell_price = float(s["price"])
-            if buy_price + 1e-12 < sell_price:
-                break  # no more matches for this buy (since sells sorted ascending)
+        # Buy orders: highest price first
+        cur.execute("SELECT id, user_tg_id, price, remaining FROM orders WHERE status='open' AND side='buy' ORDER BY price DESC, created_at ASC")
+        buys = [[r["id"], int(r["user_tg_id"]), r["price"], r["remaining"]] for r in cur.fetchall()]
+        # Sell orders: lowest price first
+        cur.execute("SELECT id, user_tg_id, price, remaining FROM orders WHERE status='open' AND side='sell' ORDER BY price ASC, created_at ASC")
+        sells = [[r["id"], int(r["user_tg_id"]), r["price"], r["remaining"]] for r in cur.fetchall()]
+
+        ts = now_iso()
+        deltas: dict[int, list[int]] = {}  # uid -> [uwt, rub]
+        txs = []
+        trades = []
+        touched = {}  # order id -> order row (list), for the final remaining/status update
+        book: dict[tuple[str, int], int] = {}  # (side, price) -> filled qty, for book_levels
+        bi = si = 0
+        while bi < len(buys) and si < len(sells):
+            b, s = buys[bi], sells[si]
+            if b[3] <= 0:
+                bi += 1; continue
+            if s[3] <= 0:
+                si += 1; continue
+            buy_price, sell_price = b[2], s[2]
+            if buy_price < sell_price:
+                break  # best bid is below best ask: nothing else can cross
             # trade price = sell_price (maker = sell), simple rule
             trade_price = sell_price
-            qty = min(float(b["remaining"]), float(s["remaining"]))
-            if qty <= 1e-12:
-                continue
-
-            buy_uid = int(b["user_tg_id"])
-            sell_uid = int(s["user_tg_id"])
-
+            qty = min(b[3], s[3])
+            # RUB the buyer's lock releases for this qty: the order locked rub_cost(price, remaining),
+            # so releasing by difference keeps lock == payments + refunds to the kopek
+            released = rub_cost(buy_price, b[3]) - rub_cost(buy_price, b[3] - qty)
+            b[3] -= qty
+            s[3] -= qty
+            touched[b[0]] = b
+            touched[s[0]] = s
+            book[("buy", buy_price)] = book.get(("buy", buy_price), 0) + qty
+            book[("sell", sell_price)] = book.get(("sell", sell_price), 0) + qty
+
+            buy_uid, sell_uid = b[1], s[1]
             # Buyer gets UWT, Seller gets RUB
-            rub_amount = qty * trade_price
-            cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (qty, buy_uid))
-            cur.execute("UPDATE users SET rub=rub+? WHERE tg_id=?", (rub_amount, sell_uid))
-
-            cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                        (buy_uid, "UWT", qty, "trade_buy", f"price={trade_price:g}", now_iso()))
-            cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                        (sell_uid, "RUB", rub_amount, "trade_sell", f"price={trade_price:g}", now_iso()))
-
-            cur.execute("UPDATE orders SET remaining=remaining-? WHERE id=?", (qty, b["id"]))
-            cur.execute("UPDATE orders SET remaining=remaining-? WHERE id=?", (qty, s["id"]))
-
-            tid = str(uuid.uuid4())
-            cur.execute("INSERT INTO trades(id,buy_order_id,sell_order_id,price,amount,created_at) VALUES(?,?,?,?,?,?)",
-                        (tid, b["id"], s["id"], trade_price, qty, now_iso()))
-
-            # if filled, update status and refund remainder for BUY if trade executed at lower than buy price
-            b2 = refresh_order(b["id"])
-            s2 = refresh_order(s["id"])
-            if b2 and float(b2["remaining"]) <= 1e-12:
-                cur.execute("UPDATE orders SET status='filled', remaining=0 WHERE id=?", (b["id"],))
-                # Buyer locked RUB at buy_price; actual spent at trade_price. Refund difference for executed qty:
-                # Total lock = buy_price*amount; actual spent = sum(trade_price*qty). We don't track sum.
-                # Simplified: on each trade refund (buy_price - trade_price)*qty if positive.
-                diff = (buy_price - trade_price) * qty
-                if diff > 1e-12:
-                    cur.execute("UPDATE users SET rub=rub+? WHERE tg_id=?", (diff, buy_uid))
-                    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                                (buy_uid, "RUB", diff, "order_price_refund", "", now_iso()))
-            if s2 and float(s2["remaining"]) <= 1e-12:
-                cur.execute("UPDATE orders SET status='filled', remaining=0 WHERE id=?", (s["id"],))
-
-    con.commit()
-    con.close()
+            rub_amount = trade_price * qty // UWT_UNIT
+            deltas.setdefault(buy_uid, [0, 0])[0] += qty
+            deltas.setdefault(sell_uid, [0, 0])[1] += rub_amount
+            txs.append((buy_uid, "UWT", qty, "trade_buy", f"price={fmt_num(trade_price, 'RUB')}", ts))
+            txs.append((sell_uid, "RUB", rub_amount, "trade_sell", f"price={fmt_num(trade_price, 'RUB')}", ts))
+            trades.append((str(uuid.uuid4()), b[0], s[0], trade_price, qty, ts))
+
+            # Buyer locked RUB at buy_price; refund the difference for every trade done cheaper
+            diff = released - rub_amount
+            if diff > 0:
+                deltas[buy_uid][1] += diff
+                txs.append((buy_uid, "RUB", diff, "order_price_refund", "", ts))
+
+        if trades:
+            cur.executemany("UPDATE users SET uwt=uwt+?, rub=rub+? WHERE tg_id=?",
+                            [(d[0], d[1], uid) for uid, d in deltas.items()])
+            _emit_tx(cur, txs)
+            cur.executemany("INSERT INTO trades(id,buy_order_id,sell_order_id,price,amount,created_at) VALUES(?,?,?,?,?,?)", trades)
+            cur.executemany("UPDATE orders SET remaining=?, status=? WHERE id=?",
+                            [(0, "filled", o[0]) if o[3] <= 0 else (o[3], "open", o[0]) for o in touched.values()])
+            _book_add(cur, [(side, price, -qty) for (side, price), qty in book.items()])
+        con.commit()
 
 def cancel_order(uid: int, oid: str) -> tuple[bool, str]:
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM orders WHERE id=?", (oid,))
-    o = cur.fetchone()
-    if not o:
-        con.close()
-        return False, "❌ Ордер не найден"
-    if int(o["user_tg_id"]) != uid:
-        con.close()
-        return False, "❌ Это не ваш ордер"
-    if o["status"] != "open":
-        con.close()
-        return False, "❌ Ордер уже не активен"
-
-    side = o["side"]
-    price = float(o["price"])
-    remaining = float(o["remaining"])
-
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE orders SET status='cancelled' WHERE id=? AND status='open'", (oid,))
-    if cur.rowcount != 1:
-        con.rollback(); con.close()
-        return False, "❌ Не удалось отменить"
-
-    _order_refund(cur, uid, side, price, remaining)
-    con.commit()
-    con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT * FROM orders WHERE id=?", (oid,))
+        o = cur.fetchone()
+        if not o:
+            return False, "❌ Ордер не найден"
+        if int(o["user_tg_id"]) != uid:
+            return False, "❌ Это не ваш ордер"
+        if o["status"] != "open":
+            return False, "❌ Ордер уже не активен"
+
+        side = o["side"]
+        price = o["price"]
+        remaining = o["remaining"]
+
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("UPDATE orders SET status='cancelled' WHERE id=? AND status='open'", (oid,))
+        if cur.rowcount != 1:
+            con.rollback()
+            return False, "❌ Не удалось отменить"
+
+        _order_refund(cur, uid, side, price, remaining, now_iso())
+        _book_add(cur, [(side, price, -remaining)])
+        con.commit()
     return True, "✅ Ордер отменён (остаток возвращён)"
 
-def my_orders(uid: int, limit: int = 10):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM orders WHERE user_tg_id=? ORDER BY created_at DESC LIMIT ?", (uid, limit))
-    rows = cur.fetchall()
-    con.close()
+def my_orders(uid: int, limit: int = 10, offset: int = 0):
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT * FROM orders WHERE user_tg_id=? ORDER BY created_at DESC, rowid DESC LIMIT ? OFFSET ?", (uid, limit, offset))
+        rows = cur.fetchall()
     return rows
 
 def top_book(limit: int = 5):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT price, SUM(remaining) AS qty FROM orders WHERE status='open' AND side='buy' GROUP BY price ORDER BY price DESC LIMIT ?", (limit,))
-    buys = cur.fetchall()
-    cur.execute("SELECT price, SUM(remaining) AS qty FROM orders WHERE status='open' AND side='sell' GROUP BY price ORDER BY price ASC LIMIT ?", (limit,))
-    sells = cur.fetchall()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT price, qty_sum AS qty FROM book_levels WHERE side='buy' ORDER BY price DESC LIMIT ?", (limit,))
+        buys = cur.fetchall()
+        cur.execute("SELECT price, qty_sum AS qty FROM book_levels WHERE side='sell' ORDER BY price ASC LIMIT ?", (limit,))
+        sells = cur.fetchall()
     return buys, sells
 
 # -------------------- CHANNELS MARKET --------------------
-def channels_list(limit: int = 20):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM channels ORDER BY created_at DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    con.close()
+def channels_list(limit: int = 20, offset: int = 0):
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT * FROM channels ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?", (limit, offset))
+        rows = cur.fetchall()
     return rows
 
 def channel_get(cid: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM channels WHERE id=?", (cid,))
-    r = cur.fetchone()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT * FROM channels WHERE id=?", (cid,))
+        r = cur.fetchone()
     return r
 
 def channel_by_chat(chat_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM channels WHERE chat_id=?", (chat_id,))
-    r = cur.fetchone()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT * FROM channels WHERE chat_id=?", (chat_id,))
+        r = cur.fetchone()
     return r
 
-def channel_upsert(owner_id: int, chat_id: int, title: str | None, username: str | None, price_uwt: float, invite_link: str | None):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO channels(owner_tg_id,chat_id,title,username,price_uwt,invite_link,created_at) VALUES(?,?,?,?,?,?,?) "
-        "ON CONFLICT(chat_id) DO UPDATE SET owner_tg_id=excluded.owner_tg_id, title=excluded.title, username=excluded.username, price_uwt=excluded.price_uwt, invite_link=excluded.invite_link",
-        (owner_id, chat_id, title, username, price_uwt, invite_link, now_iso())
-    )
-    con.commit(); con.close()
+def channel_upsert(owner_id: int, chat_id: int, title: str | None, username: str | None, price_uwt: int, invite_link: str | None):
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute(
+            "INSERT INTO channels(owner_tg_id,chat_id,title,username,price_uwt,invite_link,created_at) VALUES(?,?,?,?,?,?,?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET owner_tg_id=excluded.owner_tg_id, title=excluded.title, username=excluded.username, price_uwt=excluded.price_uwt, invite_link=excluded.invite_link",
+            (owner_id, chat_id, title, username, price_uwt, invite_link, now_iso())
+        )
+        con.commit()
 
 def sub_get(channel_id: int, user_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM channel_subs WHERE channel_id=? AND user_tg_id=?", (channel_id, user_id))
-    r = cur.fetchone()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT id, channel_id, user_tg_id, expires_at FROM channel_subs WHERE channel_id=? AND user_tg_id=?", (channel_id, user_id))
+        r = cur.fetchone()
     return r
 
 def sub_upsert(channel_id: int, user_id: int, expires_at: str):
-    con = db()
-    cur = con.cursor()
-    sid = str(uuid.uuid4())
-    cur.execute(
-        "INSERT INTO channel_subs(id,channel_id,user_tg_id,expires_at,created_at) VALUES(?,?,?,?,?) "
-        "ON CONFLICT(channel_id,user_tg_id) DO UPDATE SET expires_at=excluded.expires_at",
-        (sid, channel_id, user_id, expires_at, now_iso())
-    )
-    con.commit(); con.close()
+    with get_write_conn() as con:
+        cur = con.cursor()
+        sid = str(uuid.uuid4())
+        cur.execute(
+            "INSERT INTO channel_subs(id,channel_id,user_tg_id,expires_at,created_at) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(channel_id,user_tg_id) DO UPDATE SET expires_at=excluded.expires_at",
+            (sid, channel_id, user_id, expires_at, now_iso())
+        )
+        con.commit()
+
+def channel_sub_buy(c: sqlite3.Row, user_id: int) -> tuple[bool, str]:
+    # pays the owner and extends the subscription in one transaction; returns the new expiry
+    cid = c["id"]
+    price = c["price_uwt"]
+    owner = int(c["owner_tg_id"])
+    expires = iso(utcnow() + timedelta(days=30))
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        cur.execute("SELECT uwt FROM users WHERE tg_id=?", (user_id,))
+        row = cur.fetchone()
+        if not row or row["uwt"] < price:
+            return False, "Недостаточно UWT"
+        deltas = {user_id: -price}
+        deltas[owner] = deltas.get(owner, 0) + price  # owner may subscribe to their own channel
+        _credit_users(cur, "uwt", deltas)
+        _emit_tx(cur, [
+            (user_id, "UWT", -price, "channel_sub_pay", f"channel_id={cid}", ts),
+            (owner, "UWT", price, "channel_sub_recv", f"channel_id={cid}", ts),
+        ])
+        cur.execute(
+            "INSERT INTO channel_subs(id,channel_id,user_tg_id,expires_at,created_at) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(channel_id,user_tg_id) DO UPDATE SET expires_at=excluded.expires_at",
+            (str(uuid.uuid4()), cid, user_id, expires, ts)
+        )
+        con.commit()
+    return True, expires
+
+def sub_delete(sub_id: str):
+    with get_write_conn() as con:
+        con.execute("DELETE FROM channel_subs WHERE id=?", (sub_id,))
+        con.commit()
 
 def due_subs():
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT cs.*, c.chat_id FROM channel_subs cs JOIN channels c ON c.id=cs.channel_id WHERE cs.expires_at<=?", (now_iso(),))
-    rows = cur.fetchall()
-    con.close()
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT cs.id, cs.channel_id, cs.user_tg_id, cs.expires_at, c.chat_id FROM channel_subs cs JOIN channels c ON c.id=cs.channel_id WHERE cs.expires_at<=?", (now_iso(),))
+        rows = cur.fetchall()
     return rows
 
 # -------------------- GIVEAWAYS --------------------
-def finish_due_giveaways() -> list[tuple[str, int | None, float, int]]:
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM giveaways WHERE status='active'")
-    rows = cur.fetchall()
-    finished = []
-    for g in rows:
-        try:
-            end_at = datetime.fromisoformat(g["end_at"])
-        except Exception:
-            continue
-        if end_at > utcnow():
-            continue
-
-        gid = g["id"]
-        amount = float(g["amount"])
-        creator = int(g["creator_tg_id"])
-
-        cur.execute("SELECT user_tg_id FROM giveaway_participants WHERE giveaway_id=?", (gid,))
-        ps = [int(r["user_tg_id"]) for r in cur.fetchall()]
-        winner = secrets.choice(ps) if ps else None
-
-        if winner is None:
-            cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, creator))
-            cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                        (creator, "UWT", amount, "giveaway_refund", f"gid={gid}", now_iso()))
-        else:
-            cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, winner))
-            cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                        (winner, "UWT", amount, "giveaway_win", f"gid={gid}", now_iso()))
+def create_giveaway(uid: int, prize: int, minutes: int) -> tuple[bool, str, str]:
+    # returns (ok, gid or error, end_at)
+    gid = str(uuid.uuid4())
+    end_at = iso(utcnow() + timedelta(minutes=minutes))
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()
+        cur.execute(SQL_DEBIT["uwt"], (prize, uid, prize))
+        if cur.fetchone() is None:
+            return False, "Недостаточно UWT", end_at
+        cur.execute("INSERT INTO giveaways(id, creator_tg_id, amount, status, end_at, created_at) VALUES(?,?,?,?,?,?)",
+                    (gid, uid, prize, "active", end_at, ts))
+        cur.execute(SQL_INSERT_TX,
+                    (uid, "UWT", -prize, "giveaway_create", f"gid={gid}", ts))
+        con.commit()
+    return True, gid, end_at
+
+def active_giveaways(limit: int = 10, offset: int = 0):
+    with get_read_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT id, amount, end_at FROM giveaways WHERE status='active' ORDER BY created_at DESC, rowid DESC LIMIT ? OFFSET ?", (limit, offset))
+        rows = cur.fetchall()
+    return rows
 
-        cur.execute("UPDATE giveaways SET status='finished', winner_tg_id=? WHERE id=?", (winner, gid))
+def giveaway_join(gid: str, uid: int) -> bool | None:
+    # None: no such active giveaway, False: already joined
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute(SQL_GW_JOIN, (gid, uid, gid))
+        con.commit()
+        if cur.rowcount:
+            return True
+        # nothing inserted: tell "already in" apart from "not active" only on this path
+        cur.execute("SELECT 1 FROM giveaways WHERE id=? AND status='active'", (gid,))
+        return False if cur.fetchone() else None
+
+def finish_due_giveaways() -> list[tuple[str, int | None, int, int]]:
+    # every due giveaway is settled in one transaction (one WAL commit per pass)
+    with get_write_conn() as con:
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        ts = now_iso()  # due-cutoff and tx timestamp of this pass
+        # end_at is written by iso(), so string order is time order and the index applies
+        cur.execute("SELECT id, amount, creator_tg_id FROM giveaways WHERE status='active' AND end_at<=?", (ts,))
+        due = cur.fetchall()
+        if not due:
+            return []
+
+        finished = []
+        credits: dict[int, int] = {}  # tg_id -> UWT units to credit
+        txs = []
+        for g in due:
+            gid = g["id"]
+            amount = g["amount"]
+            creator = int(g["creator_tg_id"])
+
+            # sample in SQLite instead of loading every participant; no row means nobody joined
+            cur.execute(SQL_GW_PICK_WINNER, (gid,))
+            w = cur.fetchone()
+            winner = int(w["user_tg_id"]) if w else None
+
+            if winner is None:
+                credits[creator] = credits.get(creator, 0) + amount
+                txs.append((creator, "UWT", amount, "giveaway_refund", f"gid={gid}", ts))
+            else:
+                credits[winner] = credits.get(winner, 0) + amount
+                txs.append((winner, "UWT", amount, "giveaway_win", f"gid={gid}", ts))
+            finished.append((gid, winner, amount, creator))
+
+        _credit_users(cur, "uwt", credits)
+        _emit_tx(cur, txs)
+        cur.executemany("UPDATE giveaways SET status='finished', winner_tg_id=? WHERE id=?",
+                        [(winner, gid) for gid, winner, _, _ in finished])
         con.commit()
-        finished.append((gid, winner, amount, creator))
-    con.close()
     return finished
 
 # -------------------- INLINE UI --------------------
-def main_menu_kb() -> InlineKeyboardMarkup:
-    def b(text, key): 
-        return InlineKeyboardButton(text=text, callback_data=f"nav:{key}")
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [b("👛 Кошелёк", "wallet"), b("🔄 Обмен", "exchange")],
-        [b("🤝 P2P", "p2p"), b("🐬 Биржа", "birza")],
-        [b("🎁 Чеки", "checks"), b("📩 Счета", "bills")],
-        [b("🎁 Розыгрыши", "giveaways"), b("📣 Каналы", "channels")],
-        [b("🧾 История", "history"), b("⚙️ Помощь", "help")],
-    ])
+# Menus carry no per-user state: built once at import, shared by every handler
+def _nav(text, key):
+    return InlineKeyboardButton(text=text, callback_data=f"nav:{key}")
 
-def home_text(uid: int) -> str:
-    uwt, rub = get_balances(uid)
-    return (
-        "👛 *UWallet*\n\n"
-        f"Баланс:\n"
-        f"• UWT: *{fmt_num(uwt)}*\n"
-        f"• RUB: *{rub:g}*\n\n"
-        "Выберите действие 👇"
-    )
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [_nav("👛 Кошелёк", "wallet"), _nav("🔄 Обмен", "exchange")],
+    [_nav("🤝 P2P", "p2p"), _nav("🐬 Биржа", "birza")],
+    [_nav("🎁 Чеки", "checks"), _nav("📩 Счета", "bills")],
+    [_nav("🎁 Розыгрыши", "giveaways"), _nav("📣 Каналы", "channels")],
+    [_nav("🧾 История", "history"), _nav("⚙️ Помощь", "help")],
+])
 
-def back_home_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")]])
+BACK_HOME_KB = InlineKeyboardMarkup(inline_keyboard=[[_nav("⬅️ Назад", "home")]])
 
-def exchange_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+def _build_exchange_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
     buttons = [
         [InlineKeyboardButton(text="Купить UWT (за RUB)", callback_data="ex:buy")],
         [InlineKeyboardButton(text="Продать UWT (за RUB)", callback_data="ex:sell")],
     ]
     if is_admin_user:
         buttons.append([InlineKeyboardButton(text="⚙️ Установить курс", callback_data="ex:setrate")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")])
+    buttons.append([_nav("⬅️ Назад", "home")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def p2p_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Отправить UWT", callback_data="p2p:send:UWT")],
-        [InlineKeyboardButton(text="Отправить RUB", callback_data="p2p:send:RUB")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
-    ])
-
-def birza_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Buy", callback_data="ob:new:buy"),
-         InlineKeyboardButton(text="➕ Sell", callback_data="ob:new:sell")],
-        [InlineKeyboardButton(text="📊 Стакан", callback_data="ob:book"),
-         InlineKeyboardButton(text="🧾 Мои ордера", callback_data="ob:mine")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
-    ])
-
-def giveaways_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Создать", callback_data="gw:new"),
-         InlineKeyboardButton(text="📄 Активные", callback_data="gw:active")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
-    ])
-
-def channels_menu_kb(is_admin_user: bool):
+EXCHANGE_KB_ADMIN = _build_exchange_kb(True)
+EXCHANGE_KB_USER = _build_exchange_kb(False)
+
+P2P_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Отправить UWT", callback_data="p2p:send:UWT")],
+    [InlineKeyboardButton(text="Отправить RUB", callback_data="p2p:send:RUB")],
+    [_nav("⬅️ Назад", "home")],
+])
+
+BIRZA_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Buy", callback_data="ob:new:buy"),
+     InlineKeyboardButton(text="➕ Sell", callback_data="ob:new:sell")],
+    [InlineKeyboardButton(text="📊 Стакан", callback_data="ob:book"),
+     InlineKeyboardButton(text="🧾 Мои ордера", callback_data="ob:mine")],
+    [_nav("⬅️ Назад", "home")],
+])
+
+GIVEAWAYS_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Создать", callback_data="gw:new"),
+     InlineKeyboardButton(text="📄 Активные", callback_data="gw:active")],
+    [_nav("⬅️ Назад", "home")],
+])
+
+def _build_channels_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(text="📣 Список каналов", callback_data="ch:list")],
         [InlineKeyboardButton(text="➕ Добавить мой канал", callback_data="ch:add")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
+        [_nav("⬅️ Назад", "home")],
     ]
     if is_admin_user:
         rows.insert(0, [InlineKeyboardButton(text="⚙️ Обяз. подписки (чеки)", callback_data="rch:menu")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+CHANNELS_MENU_KB_ADMIN = _build_channels_menu_kb(True)
+CHANNELS_MENU_KB_USER = _build_channels_menu_kb(False)
+
+def main_menu_kb() -> InlineKeyboardMarkup:
+    return MAIN_MENU_KB
+
+def back_home_kb() -> InlineKeyboardMarkup:
+    return BACK_HOME_KB
+
+def exchange_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+    return EXCHANGE_KB_ADMIN if is_admin_user else EXCHANGE_KB_USER
+
+def p2p_kb() -> InlineKeyboardMarkup:
+    return P2P_KB
+
+def birza_kb() -> InlineKeyboardMarkup:
+    return BIRZA_KB
+
+def giveaways_menu_kb() -> InlineKeyboardMarkup:
+    return GIVEAWAYS_MENU_KB
+
+def channels_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+    return CHANNELS_MENU_KB_ADMIN if is_admin_user else CHANNELS_MENU_KB_USER
+
+# Lists are sent as one message with a button row per item; "<prefix>:<offset>"
+# callbacks page through them by editing that message in place
+def page_offset(data: str, prefix: str) -> int | None:
+    # "ob:mine" -> None (first press), "ob:mine:10" -> 10
+    tail = data[len(prefix) + 1:]
+    return int(tail) if tail.isdigit() else None
+
+def page_kb(item_rows: list, prefix: str, offset: int, has_more: bool) -> InlineKeyboardMarkup:
+    nav_row = []
+    if offset > 0:
+        nav_row.append(InlineKeyboardButton(text="« Назад", callback_data=f"{prefix}:{max(0, offset - PAGE_SIZE)}"))
+    if has_more:
+        nav_row.append(InlineKeyboardButton(text="Далее »", callback_data=f"{prefix}:{offset + PAGE_SIZE}"))
+    return InlineKeyboardMarkup(inline_keyboard=item_rows + ([nav_row] if nav_row else []))
+
+async def send_page(cb: CallbackQuery, paged: bool, text: str, kb: InlineKeyboardMarkup):
+    if paged:
+        await safe_edit(cb.message, text, reply_markup=kb)
+    else:
+        await cb.message.answer(text, reply_markup=kb)
+
+async def home_text(uid: int) -> str:
+    uwt, rub = await asyncio.to_thread(get_balances, uid)
+    return (
+        "👛 *UWallet*\n\n"
+        f"Баланс:\n"
+        f"• UWT: *{fmt_num(uwt)}*\n"
+        f"• RUB: *{fmt_num(rub, 'RUB')}*\n\n"
+        "Выберите действие 👇"
+    )
+
 # -------------------- FSM --------------------
 class ClaimPassFlow(StatesGroup):
     waiting_pass = State()
@@ -1007,11 +1373,10 @@ router = Router()
 
 @router.message(F.text.startswith("/start"))
 async def cmd_start(m: Message, state: FSMContext):
-    global BOT_USERNAME
     if not m.from_user.username:
         await m.answer(require_username_text())
         return
-    ensure_user(m.from_user.id, m.from_user.username)
+    await asyncio.to_thread(ensure_user, m.from_user.id, m.from_user.username)
 
     parts = m.text.split(maxsplit=1)
     payload = parts[1].strip() if len(parts) > 1 else ""
@@ -1019,7 +1384,7 @@ async def cmd_start(m: Message, state: FSMContext):
     # deep link: check claim
     if payload.startswith("c_"):
         token = payload[2:]
-        info = check_info(token)
+        info = await asyncio.to_thread(check_info, token)
         if not info:
             await m.answer("❌ Чек не найден.")
             return
@@ -1031,22 +1396,21 @@ async def cmd_start(m: Message, state: FSMContext):
             return
         if info["passhash"]:
             await state.set_state(ClaimPassFlow.waiting_pass)
-            await state.update_data(token=token, tries=0)
+            await state.update_data(token=token, tries=0, subs_ok_at=time.time())
             await m.answer("🔐 Этот чек защищён паролем.\nВведите пароль сообщением:")
             return
-        ok, msg, _ = claim_check_by_token(token, m.from_user.id, None)
+        ok, msg, _ = await asyncio.to_thread(claim_check_by_token, token, m.from_user.id, None)
         await m.answer(msg)
         return
 
     # deep link: bill pay
     if payload.startswith("b_"):
         token = payload[2:]
-        ok, msg = pay_bill_by_token(token, m.from_user.id)
+        ok, msg = await asyncio.to_thread(pay_bill_by_token, token, m.from_user.id)
         await m.answer(msg)
         return
 
-    BOT_USERNAME = BOT_USERNAME or (await m.bot.me()).username
-    await m.answer(home_text(m.from_user.id), parse_mode="Markdown", reply_markup=main_menu_kb())
+    await m.answer(await home_text(m.from_user.id), parse_mode="Markdown", reply_markup=main_menu_kb())
 
 @router.message(ClaimPassFlow.waiting_pass)
 async def claim_pass(m: Message, state: FSMContext):
@@ -1055,13 +1419,15 @@ async def claim_pass(m: Message, state: FSMContext):
     tries = int(data.get("tries", 0))
     pwd = (m.text or "").strip()
 
-    ok_subs, missing = await user_in_required_channels(m.bot, m.from_user.id)
-    if not ok_subs:
-        await m.answer("❗ Сначала подпишитесь:\n" + "\n".join([f"• {x}" for x in missing]))
-        await state.clear()
-        return
+    # the deep link already ran the gate; re-check only once that result is stale
+    if time.time() - data.get("subs_ok_at", 0) >= CLAIM_SUBS_TTL:
+        ok_subs, missing = await user_in_required_channels(m.bot, m.from_user.id)
+        if not ok_subs:
+            await m.answer("❗ Сначала подпишитесь:\n" + "\n".join([f"• {x}" for x in missing]))
+            await state.clear()
+            return
 
-    ok, msg, _ = claim_check_by_token(token, m.from_user.id, pwd)
+    ok, msg, _ = await asyncio.to_thread(claim_check_by_token, token, m.from_user.id, pwd)
     if ok:
         await m.answer(msg)
         await state.clear()
@@ -1076,126 +1442,129 @@ async def claim_pass(m: Message, state: FSMContext):
     await m.answer(msg)
 
 # -------------------- NAVIGATION --------------------
-@router.callback_query(F.data.startswith("nav:"))
-async def nav(cb: CallbackQuery, state: FSMContext):
-    global BOT_USERNAME
-    BOT_USERNAME = BOT_USERNAME or (await cb.bot.me()).username
-
-    key = cb.data.split(":", 1)[1]
-    uid = cb.from_user.id
-    is_admin_user = is_admin(cb.from_user.username)
-
-    if key == "home":
-        await safe_edit(cb.message, home_text(uid), parse_mode="Markdown", reply_markup=main_menu_kb())
-        await cb.answer(); return
-
-    if key == "wallet":
-        uwt, rub = get_balances(uid)
-        text = (
-            "👛 *Кошелёк*\n\n"
-            f"• UWT: *{fmt_num(uwt)}*\n"
-            f"• RUB: *{rub:g}*\n"
-        )
-        await safe_edit(cb.message, text, parse_mode="Markdown", reply_markup=main_menu_kb())
-        await cb.answer(); return
-
-    if key == "exchange":
-        rate = get_rate()
-        uwt, rub = get_balances(uid)
-        text = (
-            "🔄 *Обмен*\n\n"
-            f"Курс: *1 UWT = {rate:g} ₽*\n\n"
-            f"Баланс: {fmt_num(uwt)} UWT | {rub:g} ₽\n"
-        )
-        await safe_edit(cb.message, text, parse_mode="Markdown", reply_markup=exchange_kb(is_admin_user))
-        await cb.answer(); return
-
-    if key == "p2p":
-        await safe_edit(cb.message, "🤝 *P2P*\n\nОтправляйте активы другим пользователям.", parse_mode="Markdown", reply_markup=p2p_kb())
-        await cb.answer(); return
-
-    if key == "birza":
-        await safe_edit(cb.message, "🐬 *Биржа UWT/RUB*\n\nЛимитные ордера и стакан.", parse_mode="Markdown", reply_markup=birza_kb())
-        await cb.answer(); return
+def _checks_text() -> str:
+    un = BOT_USERNAME
+    return (
+        "🎁 *Чеки*\n\n"
+        "Создание через inline-режим (в любом чате):\n"
+        f"• `@{un} 100` → быстрый чек и счёт\n"
+        f"• `@{un} check 100 \"описание\" пароль` → чек\n"
+        f"• `@{un} mcheck 1000 100 10 \"описание\" пароль` → многоразовый чек\n\n"
+        "Получение — по кнопке (URL deep-link)."
+    )
 
-    if key == "checks":
-        un = BOT_USERNAME
-        text = (
-            "🎁 *Чеки*\n\n"
-            "Создание через inline-режим (в любом чате):\n"
-            f"• `@{un} 100` → быстрый чек и счёт\n"
-            f"• `@{un} check 100 \"описание\" пароль` → чек\n"
-            f"• `@{un} mcheck 1000 100 10 \"описание\" пароль` → многоразовый чек\n\n"
-            "Получение — по кнопке (URL deep-link)."
-        )
-        await safe_edit(cb.message, text, parse_mode="Markdown", reply_markup=main_menu_kb())
-        await cb.answer(); return
+def _bills_text() -> str:
+    un = BOT_USERNAME
+    return (
+        "📩 *Счета*\n\n"
+        "Создание через inline:\n"
+        f"• `@{un} bill 250 \"описание\"`\n\n"
+        "Оплата — по кнопке (URL deep-link)."
+    )
 
-    if key == "bills":
-        un = BOT_USERNAME
-        text = (
-            "📩 *Счета*\n\n"
-            "Создание через inline:\n"
-            f"• `@{un} bill 250 \"описание\"`\n\n"
-            "Оплата — по кнопке (URL deep-link)."
-        )
-        await safe_edit(cb.message, text, parse_mode="Markdown", reply_markup=main_menu_kb())
-        await cb.answer(); return
+def _help_text() -> str:
+    un = BOT_USERNAME
+    return (
+        "⚙️ *Помощь*\n\n"
+        "*Inline команды:*\n"
+        f"• `@{un} 100`\n"
+        f"• `@{un} check 100 \"описание\" пароль`\n"
+        f"• `@{un} mcheck 1000 100 10 \"описание\" пароль`\n"
+        f"• `@{un} bill 250 \"описание\"`\n\n"
+        "*Обмен:* по курсу в разделе 🔄\n"
+        "*Биржа:* лимитные ордера в разделе 🐬\n"
+        "*Каналы:* добавьте свой канал и выставьте цену."
+    )
 
-    if key == "giveaways":
-        await safe_edit(cb.message, "🎁 *Розыгрыши*\n\nВсе действия — кнопками.", parse_mode="Markdown", reply_markup=giveaways_menu_kb())
-        await cb.answer(); return
+# pages that don't depend on the user: key -> (text, keyboard);
+# checks/bills/help mention the bot username and are added by set_bot_username()
+NAV_STATIC = {
+    "p2p": ("🤝 *P2P*\n\nОтправляйте активы другим пользователям.", P2P_KB),
+    "birza": ("🐬 *Биржа UWT/RUB*\n\nЛимитные ордера и стакан.", BIRZA_KB),
+    "giveaways": ("🎁 *Розыгрыши*\n\nВсе действия — кнопками.", GIVEAWAYS_MENU_KB),
+}
+
+def set_bot_username(un: str):
+    # everything derived from the username is built once here; handlers only read it
+    global BOT_USERNAME, START_URL
+    BOT_USERNAME = un
+    START_URL = f"https://t.me/{un}?start="
+    NAV_STATIC["checks"] = (_checks_text(), MAIN_MENU_KB)
+    NAV_STATIC["bills"] = (_bills_text(), MAIN_MENU_KB)
+    NAV_STATIC["help"] = (_help_text(), MAIN_MENU_KB)
+
+async def _nav_home(cb: CallbackQuery):
+    return await home_text(cb.from_user.id), MAIN_MENU_KB
+
+async def _nav_wallet(cb: CallbackQuery):
+    uwt, rub = await asyncio.to_thread(get_balances, cb.from_user.id)
+    text = (
+        "👛 *Кошелёк*\n\n"
+        f"• UWT: *{fmt_num(uwt)}*\n"
+        f"• RUB: *{fmt_num(rub, 'RUB')}*\n"
+    )
+    return text, MAIN_MENU_KB
 
-    if key == "channels":
-        await safe_edit(cb.message, "📣 *Каналы*\n\nПодписки на каналы пользователей на 30 дней (оплата UWT).",
-                        parse_mode="Markdown", reply_markup=channels_menu_kb(is_admin_user))
-        await cb.answer(); return
+async def _nav_exchange(cb: CallbackQuery):
+    rate = get_rate()
+    uwt, rub = await asyncio.to_thread(get_balances, cb.from_user.id)
+    text = (
+        "🔄 *Обмен*\n\n"
+        f"Курс: *1 UWT = {rate:g} ₽*\n\n"
+        f"Баланс: {fmt_num(uwt)} UWT | {fmt_num(rub, 'RUB')} ₽\n"
+    )
+    return text, exchange_kb(is_admin(cb.from_user.username))
 
-    if key == "history":
-        rows = last_txs(uid, 15)
-        if not rows:
-            text = "🧾 История пуста."
-        else:
-            text = "🧾 *Последние операции:*\n\n"
-            for r in rows:
-                text += f"{r['created_at']} | {r['asset']} {float(r['delta']):+g} | {r['kind']}\n"
-        await safe_edit(cb.message, text, parse_mode="Markdown", reply_markup=main_menu_kb())
-        await cb.answer(); return
+async def _nav_channels(cb: CallbackQuery):
+    return ("📣 *Каналы*\n\nПодписки на каналы пользователей на 30 дней (оплата UWT).",
+            channels_menu_kb(is_admin(cb.from_user.username)))
 
-    if key == "help":
-        un = BOT_USERNAME
-        text = (
-            "⚙️ *Помощь*\n\n"
-            "*Inline команды:*\n"
-            f"• `@{un} 100`\n"
-            f"• `@{un} check 100 \"описание\" пароль`\n"
-            f"• `@{un} mcheck 1000 100 10 \"описание\" пароль`\n"
-            f"• `@{un} bill 250 \"описание\"`\n\n"
-            "*Обмен:* по курсу в разделе 🔄\n"
-            "*Биржа:* лимитные ордера в разделе 🐬\n"
-            "*Каналы:* добавьте свой канал и выставьте цену."
-        )
-        await safe_edit(cb.message, text, parse_mode="Markdown", reply_markup=main_menu_kb())
-        await cb.answer(); return
+async def _nav_history(cb: CallbackQuery):
+    rows = await asyncio.to_thread(last_txs, cb.from_user.id, 15)
+    if not rows:
+        text = "🧾 История пуста."
+    else:
+        text = "🧾 *Последние операции:*\n\n"
+        for r in rows:
+            sign = "+" if r["delta"] >= 0 else ""
+            text += f"{r['created_at']} | {r['asset']} {sign}{fmt_num(r['delta'], r['asset'])} | {r['kind']}\n"
+    return text, MAIN_MENU_KB
+
+# per-user pages: key -> async (cb) -> (text, keyboard)
+NAV_DYN = {
+    "home": _nav_home,
+    "wallet": _nav_wallet,
+    "exchange": _nav_exchange,
+    "channels": _nav_channels,
+    "history": _nav_history,
+}
 
+async def nav(cb: CallbackQuery, state: FSMContext):
+    key = cb.data.split(":", 1)[1]
+    entry = NAV_STATIC.get(key)
+    if entry:
+        text, kb = entry
+    else:
+        render = NAV_DYN.get(key)
+        if not render:
+            await cb.answer(); return
+        text, kb = await render(cb)
+    await safe_edit(cb.message, text, parse_mode="Markdown", reply_markup=kb)
     await cb.answer()
 
 # -------------------- EXCHANGE FLOW --------------------
-@router.callback_query(F.data == "ex:buy")
 async def ex_buy(cb: CallbackQuery, state: FSMContext):
     await state.set_state(ExchangeAmountFlow.amount)
     await state.update_data(kind="buy")
     await cb.message.answer("Введите сумму RUB для покупки UWT (например 500):")
     await cb.answer()
 
-@router.callback_query(F.data == "ex:sell")
 async def ex_sell(cb: CallbackQuery, state: FSMContext):
     await state.set_state(ExchangeAmountFlow.amount)
     await state.update_data(kind="sell")
     await cb.message.answer("Введите сумму UWT для продажи (например 25):")
     await cb.answer()
 
-@router.callback_query(F.data == "ex:setrate")
 async def ex_setrate(cb: CallbackQuery, state: FSMContext):
     if not is_admin(cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
@@ -1214,7 +1583,7 @@ async def admin_rate(m: Message, state: FSMContext):
             raise ValueError
     except Exception:
         await m.answer("❌ Введите число > 0"); return
-    set_rate(v)
+    await asyncio.to_thread(set_rate, v)
     await m.answer(f"✅ Курс установлен: 1 UWT = {v:g} ₽")
     await state.clear()
 
@@ -1224,21 +1593,20 @@ async def ex_amount(m: Message, state: FSMContext):
     kind = data.get("kind")
     raw = (m.text or "").strip().replace(",", ".")
     try:
-        val = float(raw)
+        val = to_units(float(raw), "RUB" if kind == "buy" else "UWT")
         if val <= 0:
             raise ValueError
     except Exception:
         await m.answer("❌ Введите число > 0"); return
 
     if kind == "buy":
-        ok, msg = exchange_buy(m.from_user.id, val)
+        ok, msg = await asyncio.to_thread(exchange_buy, m.from_user.id, val)
     else:
-        ok, msg = exchange_sell(m.from_user.id, val)
+        ok, msg = await asyncio.to_thread(exchange_sell, m.from_user.id, val)
     await m.answer(msg)
     await state.clear()
 
 # -------------------- P2P FLOW --------------------
-@router.callback_query(F.data.startswith("p2p:send:"))
 async def p2p_send(cb: CallbackQuery, state: FSMContext):
     asset = cb.data.split(":")[2]
     await state.set_state(P2PSendFlow.to_user)
@@ -1262,22 +1630,21 @@ async def p2p_amount(m: Message, state: FSMContext):
     to_u = data.get("to_user", "")
     raw = (m.text or "").strip().replace(",", ".")
     try:
-        amt = float(raw)
+        amt = to_units(float(raw), asset)
         if amt <= 0:
             raise ValueError
     except Exception:
         await m.answer("❌ Введите число > 0"); return
-    ok, msg, to_id = p2p_transfer(m.from_user.id, to_u, asset, amt)
+    ok, msg, to_id = await asyncio.to_thread(p2p_transfer, m.from_user.id, to_u, asset, amt)
     await m.answer(msg)
     if ok and to_id:
         try:
-            await m.bot.send_message(to_id, f"📩 Вам пришло {fmt_num(amt)} {asset} от @{clean_username(m.from_user.username)}")
+            await m.bot.send_message(to_id, f"📩 Вам пришло {fmt_num(amt, asset)} {asset} от @{clean_username(m.from_user.username)}")
         except Exception:
             pass
     await state.clear()
 
 # -------------------- BIRZA FLOW --------------------
-@router.callback_query(F.data.startswith("ob:new:"))
 async def ob_new(cb: CallbackQuery, state: FSMContext):
     side = cb.data.split(":")[2]
     await state.set_state(OrderFlow.price)
@@ -1289,7 +1656,7 @@ async def ob_new(cb: CallbackQuery, state: FSMContext):
 async def ob_price(m: Message, state: FSMContext):
     raw = (m.text or "").strip().replace(",", ".")
     try:
-        price = float(raw)
+        price = to_units(float(raw), "RUB")
         if price <= 0:
             raise ValueError
     except Exception:
@@ -1302,58 +1669,58 @@ async def ob_price(m: Message, state: FSMContext):
 async def ob_amount(m: Message, state: FSMContext):
     data = await state.get_data()
     side = data.get("side")
-    price = float(data.get("price"))
+    price = int(data.get("price"))
     raw = (m.text or "").strip().replace(",", ".")
     try:
-        amt = float(raw)
+        amt = to_units(float(raw))
         if amt <= 0:
             raise ValueError
     except Exception:
         await m.answer("❌ Введите количество > 0"); return
-    ok, msg = place_order(m.from_user.id, side, price, amt)
+    ok, msg = await asyncio.to_thread(place_order, m.from_user.id, side, price, amt)
     await m.answer(msg)
     await state.clear()
 
-@router.callback_query(F.data == "ob:book")
-async def ob_book(cb: CallbackQuery):
-    buys, sells = top_book()
+async def ob_book(cb: CallbackQuery, state: FSMContext):
+    buys, sells = await asyncio.to_thread(top_book)
     txt = "📊 *Стакан UWT/RUB*\n\n*BUY:*\n"
     if buys:
         for r in buys:
-            txt += f"• {float(r['price']):g} ₽  |  {fmt_num(float(r['qty'] or 0))} UWT\n"
+            txt += f"• {fmt_num(r['price'], 'RUB')} ₽  |  {fmt_num(r['qty'] or 0)} UWT\n"
     else:
         txt += "—\n"
     txt += "\n*SELL:*\n"
     if sells:
         for r in sells:
-            txt += f"• {float(r['price']):g} ₽  |  {fmt_num(float(r['qty'] or 0))} UWT\n"
+            txt += f"• {fmt_num(r['price'], 'RUB')} ₽  |  {fmt_num(r['qty'] or 0)} UWT\n"
     else:
         txt += "—\n"
     await cb.message.answer(txt, parse_mode="Markdown")
     await cb.answer()
 
-@router.callback_query(F.data == "ob:mine")
-async def ob_mine(cb: CallbackQuery):
-    rows = my_orders(cb.from_user.id, 10)
+async def ob_mine(cb: CallbackQuery, state: FSMContext):
+    offset = page_offset(cb.data, "ob:mine")
+    paged = offset is not None
+    offset = offset or 0
+    rows = await asyncio.to_thread(my_orders, cb.from_user.id, PAGE_SIZE + 1, offset)
     if not rows:
-        await cb.message.answer("У вас нет ордеров.")
+        if not paged:
+            await cb.message.answer("У вас нет ордеров.")
         await cb.answer(); return
-    for o in rows:
-        kb = None
+    has_more = len(rows) > PAGE_SIZE
+    text = "🧾 Ваши ордера:\n\n"
+    buttons = []
+    for n, o in enumerate(rows[:PAGE_SIZE], offset + 1):
+        text += (f"{n}. {str(o['side']).upper()} | цена {fmt_num(o['price'], 'RUB')} ₽ | "
+                 f"остаток {fmt_num(o['remaining'])} UWT | статус {o['status']}\nID: {o['id']}\n\n")
         if o["status"] == "open":
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="❌ Отменить", callback_data=f"ob:cancel:{o['id']}")]
-            ])
-        await cb.message.answer(
-            f"🧾 Ордер\nID: {o['id']}\n{str(o['side']).upper()} | цена {float(o['price']):g} ₽ | остаток {fmt_num(float(o['remaining']))} UWT | статус {o['status']}",
-            reply_markup=kb
-        )
+            buttons.append([InlineKeyboardButton(text=f"❌ Отменить {n}", callback_data=f"ob:cancel:{o['id']}")])
+    await send_page(cb, paged, text, page_kb(buttons, "ob:mine", offset, has_more))
     await cb.answer()
 
-@router.callback_query(F.data.startswith("ob:cancel:"))
-async def ob_cancel(cb: CallbackQuery):
+async def ob_cancel(cb: CallbackQuery, state: FSMContext):
     oid = cb.data.split(":")[2]
-    ok, msg = cancel_order(cb.from_user.id, oid)
+    ok, msg = await asyncio.to_thread(cancel_order, cb.from_user.id, oid)
     await cb.message.answer(msg)
     await cb.answer()
 
@@ -1380,13 +1747,11 @@ def gw_time_kb() -> InlineKeyboardMarkup:
 class GiveawayCreateFlow(StatesGroup):
     prize_custom = State()
 
-@router.callback_query(F.data == "gw:new")
 async def gw_new(cb: CallbackQuery, state: FSMContext):
     await state.update_data(gw_prize=None)
     await cb.message.answer("🎁 Создание розыгрыша\nВыберите приз:", reply_markup=gw_prize_kb())
     await cb.answer()
 
-@router.callback_query(F.data.startswith("gw:p:"))
 async def gw_pick_prize(cb: CallbackQuery, state: FSMContext):
     val = cb.data.split(":")[2]
     if val == "custom":
@@ -1394,7 +1759,7 @@ async def gw_pick_prize(cb: CallbackQuery, state: FSMContext):
         await cb.message.answer("Введите приз в UWT (число):")
         await cb.answer()
         return
-    prize = float(val)
+    prize = to_units(float(val))
     await state.update_data(gw_prize=prize)
     await cb.message.answer(f"🎁 Приз: {fmt_num(prize)} UWT\nВыберите длительность:", reply_markup=gw_time_kb())
     await cb.answer()
@@ -1403,7 +1768,7 @@ async def gw_pick_prize(cb: CallbackQuery, state: FSMContext):
 async def gw_custom_prize(m: Message, state: FSMContext):
     raw = (m.text or "").strip().replace(",", ".")
     try:
-        prize = float(raw)
+        prize = to_units(float(raw))
         if prize <= 0:
             raise ValueError
     except Exception:
@@ -1412,29 +1777,15 @@ async def gw_custom_prize(m: Message, state: FSMContext):
     await state.clear()
     await m.answer(f"🎁 Приз: {fmt_num(prize)} UWT\nВыберите длительность:", reply_markup=gw_time_kb())
 
-@router.callback_query(F.data.startswith("gw:t:"))
 async def gw_pick_time(cb: CallbackQuery, state: FSMContext):
     minutes = int(cb.data.split(":")[2])
     data = await state.get_data()
-    prize = float(data.get("gw_prize") or 0)
+    prize = int(data.get("gw_prize") or 0)
     if prize <= 0:
         await cb.answer("Сначала выберите приз", show_alert=True); return
-    uwt, _ = get_balances(cb.from_user.id)
-    if uwt + 1e-12 < prize:
-        await cb.answer("Недостаточно UWT", show_alert=True); return
-
-    gid = str(uuid.uuid4())
-    end_at = iso(utcnow() + timedelta(minutes=minutes))
-
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (prize, cb.from_user.id))
-    cur.execute("INSERT INTO giveaways(id, creator_tg_id, amount, status, end_at, created_at) VALUES(?,?,?,?,?,?)",
-                (gid, cb.from_user.id, prize, "active", end_at, now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (cb.from_user.id, "UWT", -prize, "giveaway_create", f"gid={gid}", now_iso()))
-    con.commit(); con.close()
+    ok, gid, end_at = await asyncio.to_thread(create_giveaway, cb.from_user.id, prize, minutes)
+    if not ok:
+        await cb.answer(gid, show_alert=True); return
 
     join_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Участвовать", callback_data=f"gw:join:{gid}")],
@@ -1446,61 +1797,55 @@ async def gw_pick_time(cb: CallbackQuery, state: FSMContext):
     )
     await cb.answer()
 
-@router.callback_query(F.data == "gw:active")
-async def gw_active(cb: CallbackQuery):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM giveaways WHERE status='active' ORDER BY created_at DESC LIMIT 10")
-    rows = cur.fetchall()
-    con.close()
+async def gw_active(cb: CallbackQuery, state: FSMContext):
+    offset = page_offset(cb.data, "gw:active")
+    paged = offset is not None
+    offset = offset or 0
+    rows = await asyncio.to_thread(active_giveaways, PAGE_SIZE + 1, offset)
     if not rows:
-        await cb.message.answer("Активных розыгрышей нет.")
+        if not paged:
+            await cb.message.answer("Активных розыгрышей нет.")
         await cb.answer(); return
-    for g in rows:
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Участвовать", callback_data=f"gw:join:{g['id']}")]
-        ])
-        await cb.message.answer(
-            f"🎁 Розыгрыш\nПриз: {fmt_num(float(g['amount']))} UWT\nДо: {g['end_at']}\nID: {g['id']}",
-            reply_markup=kb
-        )
+    has_more = len(rows) > PAGE_SIZE
+    text = "🎁 Активные розыгрыши:\n\n"
+    buttons = []
+    for n, g in enumerate(rows[:PAGE_SIZE], offset + 1):
+        text += f"{n}. Приз: {fmt_num(g['amount'])} UWT\nДо: {g['end_at']}\nID: {g['id']}\n\n"
+        buttons.append([InlineKeyboardButton(text=f"✅ Участвовать {n}", callback_data=f"gw:join:{g['id']}")])
+    await send_page(cb, paged, text, page_kb(buttons, "gw:active", offset, has_more))
     await cb.answer()
 
-@router.callback_query(F.data.startswith("gw:join:"))
-async def gw_join(cb: CallbackQuery):
+async def gw_join(cb: CallbackQuery, state: FSMContext):
     gid = cb.data.split(":", 2)[2]
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT status FROM giveaways WHERE id=?", (gid,))
-    g = cur.fetchone()
-    if not g or g["status"] != "active":
-        con.close()
+    joined = await asyncio.to_thread(giveaway_join, gid, cb.from_user.id)
+    if joined is None:
         await cb.answer("Розыгрыш недоступен", show_alert=True)
-        return
-    try:
-        cur.execute("INSERT INTO giveaway_participants(giveaway_id, user_tg_id) VALUES(?,?)", (gid, cb.from_user.id))
-        con.commit(); con.close()
+    elif joined:
         await cb.answer("✅ Участвуете!", show_alert=True)
-    except sqlite3.IntegrityError:
-        con.close()
+    else:
         await cb.answer("⚠️ Уже участвуете", show_alert=True)
 
 # -------------------- CHANNELS --------------------
-@router.callback_query(F.data == "ch:list")
-async def ch_list(cb: CallbackQuery):
-    rows = channels_list(20)
+async def ch_list(cb: CallbackQuery, state: FSMContext):
+    offset = page_offset(cb.data, "ch:list")
+    paged = offset is not None
+    offset = offset or 0
+    rows = await asyncio.to_thread(channels_list, PAGE_SIZE + 1, offset)
     if not rows:
-        await cb.message.answer("Каналов пока нет. Добавьте свой через меню.")
+        if not paged:
+            await cb.message.answer("Каналов пока нет. Добавьте свой через меню.")
         await cb.answer(); return
-    for c in rows:
+    has_more = len(rows) > PAGE_SIZE
+    text = "📣 Каналы (подписка на 30 дней):\n\n"
+    buttons = []
+    for n, c in enumerate(rows[:PAGE_SIZE], offset + 1):
         title = c["title"] or (f"@{c['username']}" if c["username"] else str(c["chat_id"]))
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"✅ Подписаться (30 дней) за {fmt_num(float(c['price_uwt']))} UWT", callback_data=f"ch:sub:{c['id']}")]
-        ])
-        await cb.message.answer(f"📣 {title}\nЦена: {fmt_num(float(c['price_uwt']))} UWT / 30 дней", reply_markup=kb)
+        price = fmt_num(c["price_uwt"])
+        text += f"{n}. {title}\nЦена: {price} UWT / 30 дней\n\n"
+        buttons.append([InlineKeyboardButton(text=f"✅ {n}. Подписаться за {price} UWT", callback_data=f"ch:sub:{c['id']}")])
+    await send_page(cb, paged, text, page_kb(buttons, "ch:list", offset, has_more))
     await cb.answer()
 
-@router.callback_query(F.data == "ch:add")
 async def ch_add(cb: CallbackQuery, state: FSMContext):
     await state.set_state(ChannelAddFlow.chat)
     await cb.message.answer(
@@ -1533,7 +1878,7 @@ async def ch_add_price(m: Message, state: FSMContext):
     data = await state.get_data()
     raw = (m.text or "").strip().replace(",", ".")
     try:
-        price = float(raw)
+        price = to_units(float(raw))
         if price <= 0:
             raise ValueError
     except Exception:
@@ -1542,26 +1887,24 @@ async def ch_add_price(m: Message, state: FSMContext):
     chat_id = data.get("chat_id")
     chat_username = data.get("chat_username")
 
-    # Resolve chat
-    try:
-        chat = await m.bot.get_chat(chat_username if chat_username else chat_id)
-        cid = int(chat.id)
-        title = chat.title
-        username = chat.username
-    except Exception:
+    # Resolve chat and check bot admin in parallel (bot.id comes from the token, no me() call)
+    target = chat_username if chat_username else chat_id
+    chat, cm = await asyncio.gather(
+        m.bot.get_chat(target), m.bot.get_chat_member(target, m.bot.id), return_exceptions=True
+    )
+    if isinstance(chat, Exception):
         await m.answer("❌ Не смог получить чат. Проверьте @username/chat_id и что бот имеет доступ.")
         await state.clear(); return
+    cid = int(chat.id)
+    title = chat.title
+    username = chat.username
 
-    # Check bot admin
-    try:
-        me = await m.bot.me()
-        cm = await m.bot.get_chat_member(cid, me.id)
-        if cm.status not in ("administrator", "creator"):
-            await m.answer("❌ Бот не админ в канале. Дайте права администратора и повторите.")
-            await state.clear(); return
-    except Exception:
+    if isinstance(cm, Exception):
         await m.answer("❌ Не смог проверить админку. Добавьте бота админом и повторите.")
         await state.clear(); return
+    if cm.status not in ("administrator", "creator"):
+        await m.answer("❌ Бот не админ в канале. Дайте права администратора и повторите.")
+        await state.clear(); return
 
     # Create invite link if possible
     invite = None
@@ -1573,36 +1916,18 @@ async def ch_add_price(m: Message, state: FSMContext):
         if username:
             invite = f"https://t.me/{username}"
 
-    channel_upsert(m.from_user.id, cid, title, username, price, invite)
+    await asyncio.to_thread(channel_upsert, m.from_user.id, cid, title, username, price, invite)
     await m.answer(f"✅ Канал добавлен!\n{title or cid}\nЦена: {fmt_num(price)} UWT / 30 дней")
     await state.clear()
 
-@router.callback_query(F.data.startswith("ch:sub:"))
-async def ch_sub(cb: CallbackQuery):
+async def ch_sub(cb: CallbackQuery, state: FSMContext):
     cid = int(cb.data.split(":")[2])
-    c = channel_get(cid)
+    c = await asyncio.to_thread(channel_get, cid)
     if not c:
         await cb.answer("Канал не найден", show_alert=True); return
-    price = float(c["price_uwt"])
-    uwt, _ = get_balances(cb.from_user.id)
-    if uwt + 1e-12 < price:
-        await cb.answer("Недостаточно UWT", show_alert=True); return
-
-    # pay owner
-    owner = int(c["owner_tg_id"])
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (price, cb.from_user.id))
-    cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (price, owner))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (cb.from_user.id, "UWT", -price, "channel_sub_pay", f"channel_id={cid}", now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (owner, "UWT", price, "channel_sub_recv", f"channel_id={cid}", now_iso()))
-    con.commit(); con.close()
-
-    expires = iso(utcnow() + timedelta(days=30))
-    sub_upsert(cid, cb.from_user.id, expires)
+    ok, expires = await asyncio.to_thread(channel_sub_buy, c, cb.from_user.id)
+    if not ok:
+        await cb.answer(expires, show_alert=True); return
 
     invite = c["invite_link"]
     title = c["title"] or (f"@{c['username']}" if c["username"] else str(c["chat_id"]))
@@ -1620,15 +1945,13 @@ def rch_menu_kb():
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:channels")],
     ])
 
-@router.callback_query(F.data == "rch:menu")
-async def rch_menu(cb: CallbackQuery):
+async def rch_menu(cb: CallbackQuery, state: FSMContext):
     if not is_admin(cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     await cb.message.answer("⚙️ Обязательные подписки для получения чеков:", reply_markup=rch_menu_kb())
     await cb.answer()
 
-@router.callback_query(F.data == "rch:list")
-async def rch_list(cb: CallbackQuery):
+async def rch_list(cb: CallbackQuery, state: FSMContext):
     if not is_admin(cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     rows = req_channels_list()
@@ -1641,7 +1964,6 @@ async def rch_list(cb: CallbackQuery):
     await cb.message.answer(txt)
     await cb.answer()
 
-@router.callback_query(F.data == "rch:add")
 async def rch_add(cb: CallbackQuery, state: FSMContext):
     if not is_admin(cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
@@ -1662,14 +1984,13 @@ async def rch_add_chat(m: Message, state: FSMContext):
             await m.answer("❌ Введите @username или chat_id"); return
     try:
         chat = await m.bot.get_chat(target)
-        req_channels_add(int(chat.id), chat.title, chat.username)
+        await asyncio.to_thread(req_channels_add, int(chat.id), chat.title, chat.username)
         await m.answer(f"✅ Добавлено: {chat.title or chat.id}")
     except Exception:
         await m.answer("❌ Не удалось получить чат. Проверьте доступ и данные.")
     await state.clear()
 
-@router.callback_query(F.data == "rch:del")
-async def rch_del(cb: CallbackQuery):
+async def rch_del(cb: CallbackQuery, state: FSMContext):
     if not is_admin(cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     rows = req_channels_list()
@@ -1682,44 +2003,88 @@ async def rch_del(cb: CallbackQuery):
     await cb.message.answer("Выберите канал для удаления:", reply_markup=kb)
     await cb.answer()
 
-@router.callback_query(F.data.startswith("rch:del1:"))
-async def rch_del1(cb: CallbackQuery):
+async def rch_del1(cb: CallbackQuery, state: FSMContext):
     if not is_admin(cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     chat_id = int(cb.data.split(":")[2])
-    req_channels_remove(chat_id)
+    await asyncio.to_thread(req_channels_remove, chat_id)
     await cb.message.answer("✅ Удалено")
     await cb.answer()
 
+# -------------------- CALLBACK DISPATCH --------------------
+# One callback handler for the whole bot: "prefix:action[:payload]" is routed by
+# a dict lookup on "prefix:action", then on "prefix" alone (nav pages)
+CALLBACK_ROUTES = {
+    "nav": nav,
+    "ex:buy": ex_buy,
+    "ex:sell": ex_sell,
+    "ex:setrate": ex_setrate,
+    "p2p:send": p2p_send,
+    "ob:new": ob_new,
+    "ob:book": ob_book,
+    "ob:mine": ob_mine,
+    "ob:cancel": ob_cancel,
+    "gw:new": gw_new,
+    "gw:p": gw_pick_prize,
+    "gw:t": gw_pick_time,
+    "gw:active": gw_active,
+    "gw:join": gw_join,
+    "ch:list": ch_list,
+    "ch:add": ch_add,
+    "ch:sub": ch_sub,
+    "rch:menu": rch_menu,
+    "rch:list": rch_list,
+    "rch:add": rch_add,
+    "rch:del": rch_del,
+    "rch:del1": rch_del1,
+}
+
+@router.callback_query()
+async def on_callback(cb: CallbackQuery, state: FSMContext):
+    prefix, _, rest = (cb.data or "").partition(":")
+    handler = CALLBACK_ROUTES.get(f"{prefix}:{rest.partition(':')[0]}") or CALLBACK_ROUTES.get(prefix)
+    if handler:
+        await handler(cb, state)
+    else:
+        await cb.answer()
+
 # -------------------- INLINE MODE (Checks/Bills with URL buttons) --------------------
+NUM_RE = re.compile(r"\d+([.,]\d+)?")
+INT_RE = re.compile(r"\d+")
+_SHLEX_CHARS = frozenset("\"'\\")
+
 def parse_inline_query(q: str):
     q = q.strip()
     if not q:
         return None
-    if re.fullmatch(r"\d+([.,]\d+)?", q):
-        return {"kind": "simple", "amount": float(q.replace(",", "."))}
-    try:
-        parts = shlex.split(q)
-    except Exception:
-        return None
+    if NUM_RE.fullmatch(q):
+        return {"kind": "simple", "amount": to_units(float(q.replace(",", ".")))}
+    # shlex is only needed for quoted descriptions; without quotes or escapes it equals str.split
+    if _SHLEX_CHARS.isdisjoint(q):
+        parts = q.split()
+    else:
+        try:
+            parts = shlex.split(q)
+        except Exception:
+            return None
     if not parts:
         return None
     cmd = parts[0].lower()
 
     if cmd == "bill":
-        if len(parts) < 2 or not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        amount = float(parts[1].replace(",", "."))
+        if len(parts) < 2 or not NUM_RE.fullmatch(parts[1]): return None
+        amount = to_units(float(parts[1].replace(",", ".")))
         desc = safe_desc(parts[2]) if len(parts) >= 3 else None
         return {"kind": "bill", "amount": amount, "desc": desc}
 
     # multi-use check: mcheck total per_claim max_claims "desc" pass
     if cmd == "mcheck":
         if len(parts) < 4: return None
-        if not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        if not re.fullmatch(r"\d+([.,]\d+)?", parts[2]): return None
-        if not re.fullmatch(r"\d+", parts[3]): return None
-        total = float(parts[1].replace(",", "."))
-        per = float(parts[2].replace(",", "."))
+        if not NUM_RE.fullmatch(parts[1]): return None
+        if not NUM_RE.fullmatch(parts[2]): return None
+        if not INT_RE.fullmatch(parts[3]): return None
+        total = to_units(float(parts[1].replace(",", ".")))
+        per = to_units(float(parts[2].replace(",", ".")))
         maxc = int(parts[3])
         desc = safe_desc(parts[4]) if len(parts) >= 5 else None
         pwd = safe_pass(parts[5]) if len(parts) >= 6 else None
@@ -1727,15 +2092,15 @@ def parse_inline_query(q: str):
 
     # single-use check: check amount "desc" pass
     if cmd == "check":
-        if len(parts) < 2 or not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        amount = float(parts[1].replace(",", "."))
+        if len(parts) < 2 or not NUM_RE.fullmatch(parts[1]): return None
+        amount = to_units(float(parts[1].replace(",", ".")))
         desc = safe_desc(parts[2]) if len(parts) >= 3 else None
         pwd = safe_pass(parts[3]) if len(parts) >= 4 else None
         return {"kind": "mcheck", "total": amount, "per": amount, "maxc": 1, "desc": desc, "pwd": pwd}
 
     return None
 
-def make_check_text(total: float, per: float, maxc: int, desc: str | None, has_pass: bool) -> str:
+def make_check_text(total: int, per: int, maxc: int, desc: str | None, has_pass: bool) -> str:
     text = "🎁 *Чек UWT*\n\n"
     if maxc > 1:
         text += f"💰 За раз: *{fmt_num(per)} UWT*\n"
@@ -1752,7 +2117,7 @@ def make_check_text(total: float, per: float, maxc: int, desc: str | None, has_p
     text += "\nНажмите кнопку ниже 👇"
     return text
 
-def make_bill_text(amount: float, desc: str | None) -> str:
+def make_bill_text(amount: int, desc: str | None) -> str:
     text = "📩 *Счёт UWT*\n\n"
     text += f"💰 Сумма: *{fmt_num(amount)} UWT*\n"
     if desc:
@@ -1762,29 +2127,26 @@ def make_bill_text(amount: float, desc: str | None) -> str:
 
 @router.inline_query()
 async def inline_handler(i: InlineQuery):
-    global BOT_USERNAME
     if not i.from_user.username:
         await i.answer([], cache_time=1)
         return
-    ensure_user(i.from_user.id, i.from_user.username)
+    await asyncio.to_thread(ensure_user, i.from_user.id, i.from_user.username)
 
     parsed = parse_inline_query(i.query)
     if not parsed:
         await i.answer([], cache_time=1)
         return
 
-    bot_user = BOT_USERNAME or (await i.bot.me()).username
-    BOT_USERNAME = bot_user
-
+    start_url = START_URL
     results = []
     kind = parsed["kind"]
 
     if kind == "simple":
-        amount = float(parsed["amount"])
+        amount = parsed["amount"]
         # Single check
-        ok, token = create_check_multi(i.from_user.id, amount, amount, 1, None, None)
+        ok, token = await asyncio.to_thread(create_check_multi, i.from_user.id, amount, amount, 1, None, None)
         if ok:
-            url = f"https://t.me/{bot_user}?start=c_{token}"
+            url = f"{start_url}c_{token}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🎁 Забрать чек", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -1796,9 +2158,9 @@ async def inline_handler(i: InlineQuery):
                 reply_markup=kb
             ))
         # Bill
-        ok, tokenb = create_bill_uwt_by_token(i.from_user.id, amount, None)
+        ok, tokenb = await asyncio.to_thread(create_bill_uwt_by_token, i.from_user.id, amount, None)
         if ok:
-            url = f"https://t.me/{bot_user}?start=b_{tokenb}"
+            url = f"{start_url}b_{tokenb}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💳 Оплатить", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -1811,14 +2173,14 @@ async def inline_handler(i: InlineQuery):
             ))
 
     elif kind == "mcheck":
-        total = float(parsed["total"])
-        per = float(parsed["per"])
+        total = parsed["total"]
+        per = parsed["per"]
         maxc = int(parsed["maxc"])
         desc = parsed.get("desc")
         pwd = parsed.get("pwd")
-        ok, token = create_check_multi(i.from_user.id, total, per, maxc, desc, pwd)
+        ok, token = await asyncio.to_thread(create_check_multi, i.from_user.id, total, per, maxc, desc, pwd)
         if ok:
-            url = f"https://t.me/{bot_user}?start=c_{token}"
+            url = f"{start_url}c_{token}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🎁 Забрать чек", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -1839,11 +2201,11 @@ async def inline_handler(i: InlineQuery):
             ))
 
     elif kind == "bill":
-        amount = float(parsed["amount"])
+        amount = parsed["amount"]
         desc = parsed.get("desc")
-        ok, token = create_bill_uwt_by_token(i.from_user.id, amount, desc)
+        ok, token = await asyncio.to_thread(create_bill_uwt_by_token, i.from_user.id, amount, desc)
         if ok:
-            url = f"https://t.me/{bot_user}?start=b_{token}"
+            url = f"{start_url}b_{token}"
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💳 Оплатить", url=url)]])
             results.append(InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
@@ -1861,7 +2223,7 @@ async def inline_handler(i: InlineQuery):
 # -------------------- BACKGROUND WORKERS --------------------
 async def giveaways_worker(bot: Bot):
     while True:
-        finished = finish_due_giveaways()
+        finished = await asyncio.to_thread(finish_due_giveaways)
         for gid, winner, amount, creator in finished:
             msg = f"🎁 Розыгрыш {gid} завершён. "
             if winner is None:
@@ -1886,7 +2248,7 @@ async def subs_worker(bot: Bot):
     Если нет — просто оставляет запись (можно чистить вручную).
     """
     while True:
-        rows = due_subs()
+        rows = await asyncio.to_thread(due_subs)
         for r in rows:
             chat_id = int(r["chat_id"])
             user_id = int(r["user_tg_id"])
@@ -1897,20 +2259,36 @@ async def subs_worker(bot: Bot):
             except Exception:
                 pass
             # delete subscription row (stop repeating)
-            con = db()
-            cur = con.cursor()
-            cur.execute("DELETE FROM channel_subs WHERE id=?", (r["id"],))
-            con.commit(); con.close()
+            await asyncio.to_thread(sub_delete, r["id"])
         await asyncio.sleep(SUBS_POLL_SEC)
 
+def wal_checkpoint():
+    wal = Path(f"{DB_PATH}-wal")
+    size = wal.stat().st_size if wal.exists() else 0
+    with get_write_conn() as con:
+        busy, frames, done = con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    if size > WAL_WARN_BYTES:
+        log.warning("WAL was %d bytes before checkpoint", size)
+    if busy:
+        log.warning("WAL checkpoint incomplete: %d/%d frames", done, frames)
+
+async def wal_worker():
+    # SQLite's autocheckpoint would fire inside whichever commit crosses the limit;
+    # checkpointing here on a timer keeps that work off user-facing writes
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_SEC)
+        try:
+            await asyncio.to_thread(wal_checkpoint)
+        except Exception:
+            log.exception("WAL checkpoint failed")
+
 # -------------------- RUN --------------------
 async def main():
-    global BOT_USERNAME
     init_db()
     bot = Bot(BOT_TOKEN)
 
     me = await bot.me()
-    BOT_USERNAME = me.username
+    set_bot_username(me.username)
 
     dp = Dispatcher()
 
@@ -1925,8 +2303,12 @@ async def main():
 
     asyncio.create_task(giveaways_worker(bot))
     asyncio.create_task(subs_worker(bot))
+    asyncio.create_task(wal_worker())
 
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        close_pool()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -13,23 +13,30 @@
 #
 # Install:
 #   pip install -U aiogram==3.* python-dotenv
+#   pip install uvloop   (optional, faster event loop on Linux/macOS)
 # .env:
 #   BOT_TOKEN=123:ABC
 #   DB_PATH=uwallet.db
+#   WEBHOOK_URL=https://example.com/tg   (optional: webhook instead of long polling)
+#   WEBHOOK_PORT=8080                    (local port the webhook server listens on)
 #
 # Run:
 #   python3 uwallet_full_final.py
 # ============================================================
 
 import os
-import re
-import shlex
+import math
+import time
 import uuid
 import sqlite3
 import hashlib
 import asyncio
+import itertools
 import secrets
+from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import lru_cache
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
@@ -41,7 +48,9 @@ from aiogram.types import (
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 # -------------------- CONFIG --------------------
 load_dotenv()
@@ -51,6 +60,12 @@ if not BOT_TOKEN:
 
 DB_PATH = (os.getenv("DB_PATH") or "uwallet.db").strip() or "uwallet.db"
 
+# Webhook mode: Telegram pushes updates to WEBHOOK_URL instead of the bot long-polling
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip()
+WEBHOOK_HOST = (os.getenv("WEBHOOK_HOST") or "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8080)
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip() or None
+
 # Админы по username (без @)
 DEFAULT_ADMINS = {"enzekoin", "motidevch"}
 
@@ -58,6 +73,12 @@ DEFAULT_RATE_RUB_PER_UWT = 10.0
 MAX_DESC_LEN = 180
 MAX_PASS_LEN = 32
 
+# Inline mode: a repeated (user, query) within this window reuses the checks/bills already created
+INLINE_TOKEN_TTL = 3.0
+INLINE_CACHE_TIME = 5  # cache_time for personal inline results
+# required_channels is re-read at most this often (writes through the bot reset it at once)
+REQ_CHANNELS_TTL = 5.0
+
 # Background
 GIVEAWAY_POLL_SEC = 20
 SUBS_POLL_SEC = 120
@@ -65,7 +86,8 @@ SUBS_POLL_SEC = 120
 # Business rules
 CHECK_REQUIRE_SUBS = True  # обязательные подписки для получения чеков (админы добавляют в список)
 
-BOT_USERNAME: str | None = None  # set in main()
+BOT_USERNAME = ""  # set once in main(), before polling starts
+_START_URL_PREFIX = ""  # "https://t.me/<bot>?start=", set with BOT_USERNAME
 
 # -------------------- HELPERS --------------------
 def utcnow() -> datetime:
@@ -110,6 +132,10 @@ def require_username_text() -> str:
         "Потом вернитесь и нажмите /start"
     )
 
+async def _db(fn, *a, **kw):
+    # SQLite calls block: run them in a worker thread so the event loop keeps serving updates
+    return await asyncio.to_thread(fn, *a, **kw)
+
 async def safe_edit(message, text: str, **kwargs):
     try:
         await message.edit_text(text, **kwargs)
@@ -119,6 +145,10 @@ async def safe_edit(message, text: str, **kwargs):
         raise
 
 # -------------------- DB --------------------
+# debit guarded in the same statement: handlers run these in worker threads concurrently,
+# so a balance read earlier may be stale by the time the write lands
+SQL_DEBIT = {col: f"UPDATE users SET {col}={col}-? WHERE tg_id=? AND {col}+1e-12>=?" for col in ("uwt", "rub")}
+
 def db():
     con = sqlite3.connect(DB_PATH)
     con.row_factory = sqlite3.Row
@@ -267,15 +297,21 @@ def init_db():
     con.close()
 
 def ensure_user(tg_id: int, username: str):
+    u = username.lower()
     con = db()
     cur = con.cursor()
     cur.execute(
         "INSERT OR IGNORE INTO users(tg_id, username, uwt, rub, created_at) VALUES(?,?,?,?,?)",
-        (tg_id, username.lower(), 0.0, 0.0, now_iso())
+        (tg_id, u, 0.0, 0.0, now_iso())
     )
-    cur.execute("UPDATE users SET username=? WHERE tg_id=?", (username.lower(), tg_id))
+    changed = cur.rowcount
+    cur.execute("UPDATE users SET username=? WHERE tg_id=? AND username IS NOT ?", (u, tg_id, u))
+    changed += cur.rowcount
     con.commit()
     con.close()
+    if changed:
+        # new user or renamed: username -> tg_id lookups may be stale
+        _user_id_by_username.cache_clear()
 
 def is_admin(username: str | None) -> bool:
     u = clean_username(username or "")
@@ -343,14 +379,28 @@ def last_txs(tg_id: int, limit: int = 15):
     return rows
 
 # -------------------- REQUIRED CHANNELS (checks gate) --------------------
-def req_channels_list():
+def req_channels_list(limit: int = -1):
+    # limit -1: no limit (SQLite)
     con = db()
     cur = con.cursor()
-    cur.execute("SELECT * FROM required_channels ORDER BY added_at DESC")
+    cur.execute("SELECT * FROM required_channels ORDER BY added_at DESC LIMIT ?", (limit,))
     rows = cur.fetchall()
     con.close()
     return rows
 
+_req_channels_cache = {"v": None, "t": 0.0}
+
+def _cached_req_channels():
+    c = _req_channels_cache
+    now = time.monotonic()
+    if c["v"] is None or now - c["t"] > REQ_CHANNELS_TTL:
+        c["v"] = req_channels_list()
+        c["t"] = now
+    return c["v"]
+
+def _has_required_channels() -> bool:
+    return bool(_cached_req_channels())
+
 def req_channels_add(chat_id: int, title: str | None, username: str | None):
     con = db()
     cur = con.cursor()
@@ -358,6 +408,7 @@ def req_channels_add(chat_id: int, title: str | None, username: str | None):
                 (chat_id, title, username, now_iso()))
     con.commit()
     con.close()
+    _req_channels_cache["v"] = None
 
 def req_channels_remove(chat_id: int):
     con = db()
@@ -365,6 +416,7 @@ def req_channels_remove(chat_id: int):
     cur.execute("DELETE FROM required_channels WHERE chat_id=?", (chat_id,))
     con.commit()
     con.close()
+    _req_channels_cache["v"] = None
 
 async def user_in_required_channels(bot: Bot, user_id: int) -> tuple[bool, list[str]]:
     """
@@ -372,7 +424,7 @@ async def user_in_required_channels(bot: Bot, user_id: int) -> tuple[bool, list[
     """
     if not CHECK_REQUIRE_SUBS:
         return True, []
-    rows = req_channels_list()
+    rows = await _db(_cached_req_channels)
     missing = []
     for r in rows:
         chat_id = int(r["chat_id"])
@@ -396,10 +448,6 @@ def create_check_multi(creator_id: int, total_amount: float, per_claim: float, m
     if total_amount + 1e-12 < required:
         return (False, f"❌ Общая сумма меньше чем per_claim*max_claims ({fmt_num(required)})")
 
-    uwt, _ = get_balances(creator_id)
-    if uwt + 1e-12 < total_amount:
-        return (False, "❌ Недостаточно UWT")
-
     token = secrets.token_urlsafe(8)
     check_id = str(uuid.uuid4())
     ph = sha256(password) if password else None
@@ -407,7 +455,10 @@ def create_check_multi(creator_id: int, total_amount: float, per_claim: float, m
     con = db()
     cur = con.cursor()
     cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (total_amount, creator_id))
+    cur.execute(SQL_DEBIT["uwt"], (total_amount, creator_id, total_amount))
+    if cur.rowcount != 1:
+        con.rollback(); con.close()
+        return (False, "❌ Недостаточно UWT")
     cur.execute(
         "INSERT INTO checks(id, token, creator_tg_id, total_amount, per_claim, max_claims, claimed_count, description, passhash, status, created_at) "
         "VALUES(?,?,?,?,?,?,0,?,?,'active',?)",
@@ -527,10 +578,6 @@ def pay_bill_by_token(token: str, payer_id: int) -> tuple[bool, str]:
         return (False, "❌ Нельзя оплатить самому себе")
 
     amount = float(b["amount"])
-    uwt, _ = get_balances(payer_id)
-    if uwt + 1e-12 < amount:
-        con.close()
-        return (False, "❌ Недостаточно UWT")
 
     cur.execute("BEGIN IMMEDIATE")
     cur.execute("UPDATE bills_uwt SET status='paid', paid_by_tg_id=?, paid_at=? WHERE token=? AND status='active'",
@@ -539,7 +586,10 @@ def pay_bill_by_token(token: str, payer_id: int) -> tuple[bool, str]:
         con.rollback(); con.close()
         return (False, "❌ Уже оплачено/недоступно")
 
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (amount, payer_id))
+    cur.execute(SQL_DEBIT["uwt"], (amount, payer_id, amount))
+    if cur.rowcount != 1:
+        con.rollback(); con.close()
+        return (False, "❌ Недостаточно UWT")
     cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, creator))
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
                 (payer_id, "UWT", -amount, "bill_pay", f"token={token}", now_iso()))
@@ -554,14 +604,15 @@ def exchange_buy(uid: int, rub_amount: float) -> tuple[bool, str]:
     if rub_amount <= 0:
         return False, "Сумма должна быть > 0"
     rate = get_rate()
-    uwt, rub = get_balances(uid)
-    if rub + 1e-12 < rub_amount:
-        return False, "❌ Недостаточно RUB"
     uwt_get = rub_amount / rate
     con = db()
     cur = con.cursor()
     cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET rub=rub-?, uwt=uwt+? WHERE tg_id=?", (rub_amount, uwt_get, uid))
+    cur.execute(SQL_DEBIT["rub"], (rub_amount, uid, rub_amount))
+    if cur.rowcount != 1:
+        con.rollback(); con.close()
+        return False, "❌ Недостаточно RUB"
+    cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (uwt_get, uid))
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
                 (uid, "RUB", -rub_amount, "exchange_buy", f"rate={rate}", now_iso()))
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
@@ -573,14 +624,15 @@ def exchange_sell(uid: int, uwt_amount: float) -> tuple[bool, str]:
     if uwt_amount <= 0:
         return False, "Сумма должна быть > 0"
     rate = get_rate()
-    uwt, rub = get_balances(uid)
-    if uwt + 1e-12 < uwt_amount:
-        return False, "❌ Недостаточно UWT"
     rub_get = uwt_amount * rate
     con = db()
     cur = con.cursor()
     cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-?, rub=rub+? WHERE tg_id=?", (uwt_amount, rub_get, uid))
+    cur.execute(SQL_DEBIT["uwt"], (uwt_amount, uid, uwt_amount))
+    if cur.rowcount != 1:
+        con.rollback(); con.close()
+        return False, "❌ Недостаточно UWT"
+    cur.execute("UPDATE users SET rub=rub+? WHERE tg_id=?", (rub_get, uid))
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
                 (uid, "UWT", -uwt_amount, "exchange_sell", f"rate={rate}", now_iso()))
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
@@ -606,18 +658,14 @@ def p2p_transfer(from_id: int, to_username: str, asset: str, amount: float) -> t
         return False, "❌ Пользователь не найден (он должен хоть раз нажать /start у бота)", None
     to_id = int(row["tg_id"])
 
-    uwt, rub = get_balances(from_id)
-    bal = uwt if asset == "UWT" else rub
-    if bal + 1e-12 < amount:
-        con.close()
-        return False, f"❌ Недостаточно {asset}", None
-
     cur.execute("BEGIN IMMEDIATE")
+    cur.execute(SQL_DEBIT[asset.lower()], (amount, from_id, amount))
+    if cur.rowcount != 1:
+        con.rollback(); con.close()
+        return False, f"❌ Недостаточно {asset}", None
     if asset == "UWT":
-        cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (amount, from_id))
         cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (amount, to_id))
     else:
-        cur.execute("UPDATE users SET rub=rub-? WHERE tg_id=?", (amount, from_id))
         cur.execute("UPDATE users SET rub=rub+? WHERE tg_id=?", (amount, to_id))
 
     cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
@@ -631,19 +679,15 @@ def p2p_transfer(from_id: int, to_username: str, asset: str, amount: float) -> t
 def _order_lock_funds(cur: sqlite3.Cursor, uid: int, side: str, price: float, amount: float):
     if side == "buy":
         cost = price * amount
-        cur.execute("SELECT rub FROM users WHERE tg_id=?", (uid,))
-        rub = float(cur.fetchone()["rub"])
-        if rub + 1e-12 < cost:
+        cur.execute(SQL_DEBIT["rub"], (cost, uid, cost))
+        if cur.rowcount != 1:
             raise ValueError("Недостаточно RUB")
-        cur.execute("UPDATE users SET rub=rub-? WHERE tg_id=?", (cost, uid))
         cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
                     (uid, "RUB", -cost, "order_lock", f"buy cost={cost:g}", now_iso()))
     else:
-        cur.execute("SELECT uwt FROM users WHERE tg_id=?", (uid,))
-        uwt = float(cur.fetchone()["uwt"])
-        if uwt + 1e-12 < amount:
+        cur.execute(SQL_DEBIT["uwt"], (amount, uid, amount))
+        if cur.rowcount != 1:
             raise ValueError("Недостаточно UWT")
-        cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (amount, uid))
         cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
                     (uid, "UWT", -amount, "order_lock", f"sell amt={amount:g}", now_iso()))
 
@@ -849,6 +893,22 @@ def sub_get(channel_id: int, user_id: int):
     con.close()
     return r
 
+def channel_sub_pay(cid: int, user_id: int, owner: int, price: float) -> bool:
+    con = db()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute(SQL_DEBIT["uwt"], (price, user_id, price))
+    if cur.rowcount != 1:
+        con.rollback(); con.close()
+        return False
+    cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (price, owner))
+    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
+                (user_id, "UWT", -price, "channel_sub_pay", f"channel_id={cid}", now_iso()))
+    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
+                (owner, "UWT", price, "channel_sub_recv", f"channel_id={cid}", now_iso()))
+    con.commit(); con.close()
+    return True
+
 def sub_upsert(channel_id: int, user_id: int, expires_at: str):
     con = db()
     cur = con.cursor()
@@ -860,15 +920,65 @@ def sub_upsert(channel_id: int, user_id: int, expires_at: str):
     )
     con.commit(); con.close()
 
-def due_subs():
+def due_subs(cutoff: str):
     con = db()
     cur = con.cursor()
-    cur.execute("SELECT cs.*, c.chat_id FROM channel_subs cs JOIN channels c ON c.id=cs.channel_id WHERE cs.expires_at<=?", (now_iso(),))
+    cur.execute("SELECT cs.*, c.chat_id FROM channel_subs cs JOIN channels c ON c.id=cs.channel_id WHERE cs.expires_at<=?", (cutoff,))
     rows = cur.fetchall()
     con.close()
     return rows
 
+def subs_delete(sub_ids: list[str], cutoff: str):
+    # sub_upsert renews in place (same id): a row renewed since due_subs(cutoff) must survive
+    con = db()
+    con.executemany("DELETE FROM channel_subs WHERE id=? AND expires_at<=?", [(x, cutoff) for x in sub_ids])
+    con.commit()
+    con.close()
+
 # -------------------- GIVEAWAYS --------------------
+def giveaway_create(uid: int, prize: float, end_at: str) -> str | None:
+    # None: not enough UWT
+    gid = str(uuid.uuid4())
+    con = db()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute(SQL_DEBIT["uwt"], (prize, uid, prize))
+    if cur.rowcount != 1:
+        con.rollback(); con.close()
+        return None
+    cur.execute("INSERT INTO giveaways(id, creator_tg_id, amount, status, end_at, created_at) VALUES(?,?,?,?,?,?)",
+                (gid, uid, prize, "active", end_at, now_iso()))
+    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
+                (uid, "UWT", -prize, "giveaway_create", f"gid={gid}", now_iso()))
+    con.commit(); con.close()
+    return gid
+
+def active_giveaways(limit: int = 10):
+    con = db()
+    cur = con.cursor()
+    cur.execute("SELECT * FROM giveaways WHERE status='active' ORDER BY created_at DESC LIMIT ?", (limit,))
+    rows = cur.fetchall()
+    con.close()
+    return rows
+
+def giveaway_join(gid: str, uid: int) -> bool | None:
+    # None: no such active giveaway, False: already joined
+    con = db()
+    cur = con.cursor()
+    cur.execute("SELECT status FROM giveaways WHERE id=?", (gid,))
+    g = cur.fetchone()
+    if not g or g["status"] != "active":
+        con.close()
+        return None
+    try:
+        cur.execute("INSERT INTO giveaway_participants(giveaway_id, user_tg_id) VALUES(?,?)", (gid, uid))
+        con.commit()
+    except sqlite3.IntegrityError:
+        return False
+    finally:
+        con.close()
+    return True
+
 def finish_due_giveaways() -> list[tuple[str, int | None, float, int]]:
     con = db()
     cur = con.cursor()
@@ -907,73 +1017,97 @@ def finish_due_giveaways() -> list[tuple[str, int | None, float, int]]:
     return finished
 
 # -------------------- INLINE UI --------------------
-def main_menu_kb() -> InlineKeyboardMarkup:
-    def b(text, key): 
-        return InlineKeyboardButton(text=text, callback_data=f"nav:{key}")
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [b("👛 Кошелёк", "wallet"), b("🔄 Обмен", "exchange")],
-        [b("🤝 P2P", "p2p"), b("🐬 Биржа", "birza")],
-        [b("🎁 Чеки", "checks"), b("📩 Счета", "bills")],
-        [b("🎁 Розыгрыши", "giveaways"), b("📣 Каналы", "channels")],
-        [b("🧾 История", "history"), b("⚙️ Помощь", "help")],
-    ])
+# Menus carry no per-user state: built once at import, shared by every handler
+def _nav(text, key):
+    return InlineKeyboardButton(text=text, callback_data=f"nav:{key}")
 
-def home_text(uid: int) -> str:
-    uwt, rub = get_balances(uid)
-    return (
-        "👛 *UWallet*\n\n"
-        f"Баланс:\n"
-        f"• UWT: *{fmt_num(uwt)}*\n"
-        f"• RUB: *{rub:g}*\n\n"
-        "Выберите действие 👇"
-    )
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [_nav("👛 Кошелёк", "wallet"), _nav("🔄 Обмен", "exchange")],
+    [_nav("🤝 P2P", "p2p"), _nav("🐬 Биржа", "birza")],
+    [_nav("🎁 Чеки", "checks"), _nav("📩 Счета", "bills")],
+    [_nav("🎁 Розыгрыши", "giveaways"), _nav("📣 Каналы", "channels")],
+    [_nav("🧾 История", "history"), _nav("⚙️ Помощь", "help")],
+])
 
-def back_home_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")]])
+BACK_HOME_KB = InlineKeyboardMarkup(inline_keyboard=[[_nav("⬅️ Назад", "home")]])
 
-def exchange_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+def _build_exchange_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
     buttons = [
         [InlineKeyboardButton(text="Купить UWT (за RUB)", callback_data="ex:buy")],
         [InlineKeyboardButton(text="Продать UWT (за RUB)", callback_data="ex:sell")],
     ]
     if is_admin_user:
         buttons.append([InlineKeyboardButton(text="⚙️ Установить курс", callback_data="ex:setrate")])
-    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")])
+    buttons.append([_nav("⬅️ Назад", "home")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def p2p_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Отправить UWT", callback_data="p2p:send:UWT")],
-        [InlineKeyboardButton(text="Отправить RUB", callback_data="p2p:send:RUB")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
-    ])
-
-def birza_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Buy", callback_data="ob:new:buy"),
-         InlineKeyboardButton(text="➕ Sell", callback_data="ob:new:sell")],
-        [InlineKeyboardButton(text="📊 Стакан", callback_data="ob:book"),
-         InlineKeyboardButton(text="🧾 Мои ордера", callback_data="ob:mine")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
-    ])
-
-def giveaways_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Создать", callback_data="gw:new"),
-         InlineKeyboardButton(text="📄 Активные", callback_data="gw:active")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
-    ])
-
-def channels_menu_kb(is_admin_user: bool):
+EXCHANGE_KB_ADMIN = _build_exchange_kb(True)
+EXCHANGE_KB_USER = _build_exchange_kb(False)
+
+P2P_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Отправить UWT", callback_data="p2p:send:UWT")],
+    [InlineKeyboardButton(text="Отправить RUB", callback_data="p2p:send:RUB")],
+    [_nav("⬅️ Назад", "home")],
+])
+
+BIRZA_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Buy", callback_data="ob:new:buy"),
+     InlineKeyboardButton(text="➕ Sell", callback_data="ob:new:sell")],
+    [InlineKeyboardButton(text="📊 Стакан", callback_data="ob:book"),
+     InlineKeyboardButton(text="🧾 Мои ордера", callback_data="ob:mine")],
+    [_nav("⬅️ Назад", "home")],
+])
+
+GIVEAWAYS_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Создать", callback_data="gw:new"),
+     InlineKeyboardButton(text="📄 Активные", callback_data="gw:active")],
+    [_nav("⬅️ Назад", "home")],
+])
+
+def _build_channels_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(text="📣 Список каналов", callback_data="ch:list")],
         [InlineKeyboardButton(text="➕ Добавить мой канал", callback_data="ch:add")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:home")],
+        [_nav("⬅️ Назад", "home")],
     ]
     if is_admin_user:
         rows.insert(0, [InlineKeyboardButton(text="⚙️ Обяз. подписки (чеки)", callback_data="rch:menu")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+CHANNELS_MENU_KB_ADMIN = _build_channels_menu_kb(True)
+CHANNELS_MENU_KB_USER = _build_channels_menu_kb(False)
+
+def main_menu_kb() -> InlineKeyboardMarkup:
+    return MAIN_MENU_KB
+
+async def home_text(uid: int) -> str:
+    uwt, rub = await _db(get_balances, uid)
+    return (
+        "👛 *UWallet*\n\n"
+        f"Баланс:\n"
+        f"• UWT: *{fmt_num(uwt)}*\n"
+        f"• RUB: *{rub:g}*\n\n"
+        "Выберите действие 👇"
+    )
+
+def back_home_kb() -> InlineKeyboardMarkup:
+    return BACK_HOME_KB
+
+def exchange_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+    return EXCHANGE_KB_ADMIN if is_admin_user else EXCHANGE_KB_USER
+
+def p2p_kb() -> InlineKeyboardMarkup:
+    return P2P_KB
+
+def birza_kb() -> InlineKeyboardMarkup:
+    return BIRZA_KB
+
+def giveaways_menu_kb() -> InlineKeyboardMarkup:
+    return GIVEAWAYS_MENU_KB
+
+def channels_menu_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
+    return CHANNELS_MENU_KB_ADMIN if is_admin_user else CHANNELS_MENU_KB_USER
+
 # -------------------- FSM --------------------
 class ClaimPassFlow(StatesGroup):
     waiting_pass = State()
@@ -1007,11 +1141,10 @@ router = Router()
 
 @router.message(F.text.startswith("/start"))
 async def cmd_start(m: Message, state: FSMContext):
-    global BOT_USERNAME
     if not m.from_user.username:
         await m.answer(require_username_text())
         return
-    ensure_user(m.from_user.id, m.from_user.username)
+    await _db(ensure_user, m.from_user.id, m.from_user.username)
 
     parts = m.text.split(maxsplit=1)
     payload = parts[1].strip() if len(parts) > 1 else ""
@@ -1019,7 +1152,7 @@ async def cmd_start(m: Message, state: FSMContext):
     # deep link: check claim
     if payload.startswith("c_"):
         token = payload[2:]
-        info = check_info(token)
+        info = await _db(check_info, token)
         if not info:
             await m.answer("❌ Чек не найден.")
             return
@@ -1034,19 +1167,18 @@ async def cmd_start(m: Message, state: FSMContext):
             await state.update_data(token=token, tries=0)
             await m.answer("🔐 Этот чек защищён паролем.\nВведите пароль сообщением:")
             return
-        ok, msg, _ = claim_check_by_token(token, m.from_user.id, None)
+        ok, msg, _ = await _db(claim_check_by_token, token, m.from_user.id, None)
         await m.answer(msg)
         return
 
     # deep link: bill pay
     if payload.startswith("b_"):
         token = payload[2:]
-        ok, msg = pay_bill_by_token(token, m.from_user.id)
+        ok, msg = await _db(pay_bill_by_token, token, m.from_user.id)
         await m.answer(msg)
         return
 
-    BOT_USERNAME = BOT_USERNAME or (await m.bot.me()).username
-    await m.answer(home_text(m.from_user.id), parse_mode="Markdown", reply_markup=main_menu_kb())
+    await m.answer(await home_text(m.from_user.id), parse_mode="Markdown", reply_markup=main_menu_kb())
 
 @router.message(ClaimPassFlow.waiting_pass)
 async def claim_pass(m: Message, state: FSMContext):
@@ -1061,7 +1193,7 @@ async def claim_pass(m: Message, state: FSMContext):
         await state.clear()
         return
 
-    ok, msg, _ = claim_check_by_token(token, m.from_user.id, pwd)
+    ok, msg, _ = await _db(claim_check_by_token, token, m.from_user.id, pwd)
     if ok:
         await m.answer(msg)
         await state.clear()
@@ -1078,19 +1210,16 @@ async def claim_pass(m: Message, state: FSMContext):
 # -------------------- NAVIGATION --------------------
 @router.callback_query(F.data.startswith("nav:"))
 async def nav(cb: CallbackQuery, state: FSMContext):
-    global BOT_USERNAME
-    BOT_USERNAME = BOT_USERNAME or (await cb.bot.me()).username
-
     key = cb.data.split(":", 1)[1]
     uid = cb.from_user.id
-    is_admin_user = is_admin(cb.from_user.username)
+    is_admin_user = await _db(is_admin, cb.from_user.username)
 
     if key == "home":
-        await safe_edit(cb.message, home_text(uid), parse_mode="Markdown", reply_markup=main_menu_kb())
+        await safe_edit(cb.message, await home_text(uid), parse_mode="Markdown", reply_markup=main_menu_kb())
         await cb.answer(); return
 
     if key == "wallet":
-        uwt, rub = get_balances(uid)
+        uwt, rub = await _db(get_balances, uid)
         text = (
             "👛 *Кошелёк*\n\n"
             f"• UWT: *{fmt_num(uwt)}*\n"
@@ -1100,8 +1229,8 @@ async def nav(cb: CallbackQuery, state: FSMContext):
         await cb.answer(); return
 
     if key == "exchange":
-        rate = get_rate()
-        uwt, rub = get_balances(uid)
+        rate = await _db(get_rate)
+        uwt, rub = await _db(get_balances, uid)
         text = (
             "🔄 *Обмен*\n\n"
             f"Курс: *1 UWT = {rate:g} ₽*\n\n"
@@ -1152,7 +1281,7 @@ async def nav(cb: CallbackQuery, state: FSMContext):
         await cb.answer(); return
 
     if key == "history":
-        rows = last_txs(uid, 15)
+        rows = await _db(last_txs, uid, 15)
         if not rows:
             text = "🧾 История пуста."
         else:
@@ -1197,15 +1326,16 @@ async def ex_sell(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "ex:setrate")
 async def ex_setrate(cb: CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user.username):
+    if not await _db(is_admin, cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     await state.set_state(AdminSetRateFlow.rate)
-    await cb.message.answer(f"Текущий курс: {get_rate():g} ₽ за 1 UWT.\nВведите новый курс числом:")
+    rate = await _db(get_rate)
+    await cb.message.answer(f"Текущий курс: {rate:g} ₽ за 1 UWT.\nВведите новый курс числом:")
     await cb.answer()
 
 @router.message(AdminSetRateFlow.rate)
 async def admin_rate(m: Message, state: FSMContext):
-    if not is_admin(m.from_user.username):
+    if not await _db(is_admin, m.from_user.username):
         await m.answer("Нет прав"); await state.clear(); return
     raw = (m.text or "").strip().replace(",", ".")
     try:
@@ -1214,7 +1344,7 @@ async def admin_rate(m: Message, state: FSMContext):
             raise ValueError
     except Exception:
         await m.answer("❌ Введите число > 0"); return
-    set_rate(v)
+    await _db(set_rate, v)
     await m.answer(f"✅ Курс установлен: 1 UWT = {v:g} ₽")
     await state.clear()
 
@@ -1231,9 +1361,9 @@ async def ex_amount(m: Message, state: FSMContext):
         await m.answer("❌ Введите число > 0"); return
 
     if kind == "buy":
-        ok, msg = exchange_buy(m.from_user.id, val)
+        ok, msg = await _db(exchange_buy, m.from_user.id, val)
     else:
-        ok, msg = exchange_sell(m.from_user.id, val)
+        ok, msg = await _db(exchange_sell, m.from_user.id, val)
     await m.answer(msg)
     await state.clear()
 
@@ -1267,7 +1397,7 @@ async def p2p_amount(m: Message, state: FSMContext):
             raise ValueError
     except Exception:
         await m.answer("❌ Введите число > 0"); return
-    ok, msg, to_id = p2p_transfer(m.from_user.id, to_u, asset, amt)
+    ok, msg, to_id = await _db(p2p_transfer, m.from_user.id, to_u, asset, amt)
     await m.answer(msg)
     if ok and to_id:
         try:
@@ -1310,13 +1440,13 @@ async def ob_amount(m: Message, state: FSMContext):
             raise ValueError
     except Exception:
         await m.answer("❌ Введите количество > 0"); return
-    ok, msg = place_order(m.from_user.id, side, price, amt)
+    ok, msg = await _db(place_order, m.from_user.id, side, price, amt)
     await m.answer(msg)
     await state.clear()
 
 @router.callback_query(F.data == "ob:book")
 async def ob_book(cb: CallbackQuery):
-    buys, sells = top_book()
+    buys, sells = await _db(top_book)
     txt = "📊 *Стакан UWT/RUB*\n\n*BUY:*\n"
     if buys:
         for r in buys:
@@ -1334,7 +1464,7 @@ async def ob_book(cb: CallbackQuery):
 
 @router.callback_query(F.data == "ob:mine")
 async def ob_mine(cb: CallbackQuery):
-    rows = my_orders(cb.from_user.id, 10)
+    rows = await _db(my_orders, cb.from_user.id, 10)
     if not rows:
         await cb.message.answer("У вас нет ордеров.")
         await cb.answer(); return
@@ -1353,29 +1483,33 @@ async def ob_mine(cb: CallbackQuery):
 @router.callback_query(F.data.startswith("ob:cancel:"))
 async def ob_cancel(cb: CallbackQuery):
     oid = cb.data.split(":")[2]
-    ok, msg = cancel_order(cb.from_user.id, oid)
+    ok, msg = await _db(cancel_order, cb.from_user.id, oid)
     await cb.message.answer(msg)
     await cb.answer()
 
 # -------------------- GIVEAWAYS --------------------
+GW_PRIZE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="50 UWT", callback_data="gw:p:50"),
+     InlineKeyboardButton(text="100 UWT", callback_data="gw:p:100"),
+     InlineKeyboardButton(text="500 UWT", callback_data="gw:p:500")],
+    [InlineKeyboardButton(text="1000 UWT", callback_data="gw:p:1000"),
+     InlineKeyboardButton(text="✍️ Другая сумма", callback_data="gw:p:custom")],
+    [_nav("⬅️ Назад", "giveaways")],
+])
+
+GW_TIME_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="30 минут", callback_data="gw:t:30"),
+     InlineKeyboardButton(text="1 час", callback_data="gw:t:60"),
+     InlineKeyboardButton(text="6 часов", callback_data="gw:t:360")],
+    [InlineKeyboardButton(text="24 часа", callback_data="gw:t:1440")],
+    [_nav("⬅️ Назад", "giveaways")],
+])
+
 def gw_prize_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="50 UWT", callback_data="gw:p:50"),
-         InlineKeyboardButton(text="100 UWT", callback_data="gw:p:100"),
-         InlineKeyboardButton(text="500 UWT", callback_data="gw:p:500")],
-        [InlineKeyboardButton(text="1000 UWT", callback_data="gw:p:1000"),
-         InlineKeyboardButton(text="✍️ Другая сумма", callback_data="gw:p:custom")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:giveaways")],
-    ])
+    return GW_PRIZE_KB
 
 def gw_time_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="30 минут", callback_data="gw:t:30"),
-         InlineKeyboardButton(text="1 час", callback_data="gw:t:60"),
-         InlineKeyboardButton(text="6 часов", callback_data="gw:t:360")],
-        [InlineKeyboardButton(text="24 часа", callback_data="gw:t:1440")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:giveaways")],
-    ])
+    return GW_TIME_KB
 
 class GiveawayCreateFlow(StatesGroup):
     prize_custom = State()
@@ -1419,22 +1553,10 @@ async def gw_pick_time(cb: CallbackQuery, state: FSMContext):
     prize = float(data.get("gw_prize") or 0)
     if prize <= 0:
         await cb.answer("Сначала выберите приз", show_alert=True); return
-    uwt, _ = get_balances(cb.from_user.id)
-    if uwt + 1e-12 < prize:
-        await cb.answer("Недостаточно UWT", show_alert=True); return
-
-    gid = str(uuid.uuid4())
     end_at = iso(utcnow() + timedelta(minutes=minutes))
-
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (prize, cb.from_user.id))
-    cur.execute("INSERT INTO giveaways(id, creator_tg_id, amount, status, end_at, created_at) VALUES(?,?,?,?,?,?)",
-                (gid, cb.from_user.id, prize, "active", end_at, now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (cb.from_user.id, "UWT", -prize, "giveaway_create", f"gid={gid}", now_iso()))
-    con.commit(); con.close()
+    gid = await _db(giveaway_create, cb.from_user.id, prize, end_at)
+    if gid is None:
+        await cb.answer("Недостаточно UWT", show_alert=True); return
 
     join_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Участвовать", callback_data=f"gw:join:{gid}")],
@@ -1448,11 +1570,7 @@ async def gw_pick_time(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "gw:active")
 async def gw_active(cb: CallbackQuery):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM giveaways WHERE status='active' ORDER BY created_at DESC LIMIT 10")
-    rows = cur.fetchall()
-    con.close()
+    rows = await _db(active_giveaways, 10)
     if not rows:
         await cb.message.answer("Активных розыгрышей нет.")
         await cb.answer(); return
@@ -1469,26 +1587,18 @@ async def gw_active(cb: CallbackQuery):
 @router.callback_query(F.data.startswith("gw:join:"))
 async def gw_join(cb: CallbackQuery):
     gid = cb.data.split(":", 2)[2]
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT status FROM giveaways WHERE id=?", (gid,))
-    g = cur.fetchone()
-    if not g or g["status"] != "active":
-        con.close()
+    joined = await _db(giveaway_join, gid, cb.from_user.id)
+    if joined is None:
         await cb.answer("Розыгрыш недоступен", show_alert=True)
-        return
-    try:
-        cur.execute("INSERT INTO giveaway_participants(giveaway_id, user_tg_id) VALUES(?,?)", (gid, cb.from_user.id))
-        con.commit(); con.close()
+    elif joined:
         await cb.answer("✅ Участвуете!", show_alert=True)
-    except sqlite3.IntegrityError:
-        con.close()
+    else:
         await cb.answer("⚠️ Уже участвуете", show_alert=True)
 
 # -------------------- CHANNELS --------------------
 @router.callback_query(F.data == "ch:list")
 async def ch_list(cb: CallbackQuery):
-    rows = channels_list(20)
+    rows = await _db(channels_list, 20)
     if not rows:
         await cb.message.answer("Каналов пока нет. Добавьте свой через меню.")
         await cb.answer(); return
@@ -1573,36 +1683,25 @@ async def ch_add_price(m: Message, state: FSMContext):
         if username:
             invite = f"https://t.me/{username}"
 
-    channel_upsert(m.from_user.id, cid, title, username, price, invite)
+    await _db(channel_upsert, m.from_user.id, cid, title, username, price, invite)
     await m.answer(f"✅ Канал добавлен!\n{title or cid}\nЦена: {fmt_num(price)} UWT / 30 дней")
     await state.clear()
 
 @router.callback_query(F.data.startswith("ch:sub:"))
 async def ch_sub(cb: CallbackQuery):
     cid = int(cb.data.split(":")[2])
-    c = channel_get(cid)
+    c = await _db(channel_get, cid)
     if not c:
         await cb.answer("Канал не найден", show_alert=True); return
     price = float(c["price_uwt"])
-    uwt, _ = get_balances(cb.from_user.id)
-    if uwt + 1e-12 < price:
-        await cb.answer("Недостаточно UWT", show_alert=True); return
 
     # pay owner
     owner = int(c["owner_tg_id"])
-    con = db()
-    cur = con.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute("UPDATE users SET uwt=uwt-? WHERE tg_id=?", (price, cb.from_user.id))
-    cur.execute("UPDATE users SET uwt=uwt+? WHERE tg_id=?", (price, owner))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (cb.from_user.id, "UWT", -price, "channel_sub_pay", f"channel_id={cid}", now_iso()))
-    cur.execute("INSERT INTO tx(tg_id, asset, delta, kind, meta, created_at) VALUES(?,?,?,?,?,?)",
-                (owner, "UWT", price, "channel_sub_recv", f"channel_id={cid}", now_iso()))
-    con.commit(); con.close()
+    if not await _db(channel_sub_pay, cid, cb.from_user.id, owner, price):
+        await cb.answer("Недостаточно UWT", show_alert=True); return
 
     expires = iso(utcnow() + timedelta(days=30))
-    sub_upsert(cid, cb.from_user.id, expires)
+    await _db(sub_upsert, cid, cb.from_user.id, expires)
 
     invite = c["invite_link"]
     title = c["title"] or (f"@{c['username']}" if c["username"] else str(c["chat_id"]))
@@ -1612,38 +1711,43 @@ async def ch_sub(cb: CallbackQuery):
     await cb.answer()
 
 # -------------------- REQUIRED CHANNELS ADMIN UI --------------------
-def rch_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📃 Список", callback_data="rch:list"),
-         InlineKeyboardButton(text="➕ Добавить", callback_data="rch:add")],
-        [InlineKeyboardButton(text="➖ Удалить", callback_data="rch:del")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:channels")],
-    ])
+RCH_DEL_MAX = 25  # delete buttons shown at once
+_RCH_BACK_ROW = [InlineKeyboardButton(text="⬅️ Назад", callback_data="rch:menu")]
+
+_RCH_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📃 Список", callback_data="rch:list"),
+     InlineKeyboardButton(text="➕ Добавить", callback_data="rch:add")],
+    [InlineKeyboardButton(text="➖ Удалить", callback_data="rch:del")],
+    [_nav("⬅️ Назад", "channels")],
+])
+
+def rch_menu_kb() -> InlineKeyboardMarkup:
+    return _RCH_MENU_KB
 
 @router.callback_query(F.data == "rch:menu")
 async def rch_menu(cb: CallbackQuery):
-    if not is_admin(cb.from_user.username):
+    if not await _db(is_admin, cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     await cb.message.answer("⚙️ Обязательные подписки для получения чеков:", reply_markup=rch_menu_kb())
     await cb.answer()
 
 @router.callback_query(F.data == "rch:list")
 async def rch_list(cb: CallbackQuery):
-    if not is_admin(cb.from_user.username):
+    if not await _db(is_admin, cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
-    rows = req_channels_list()
+    rows = await _db(_cached_req_channels)
     if not rows:
         await cb.message.answer("Список пуст."); await cb.answer(); return
-    txt = "📃 Обязательные каналы:\n\n"
+    lines = ["📃 Обязательные каналы:", ""]
     for r in rows:
         name = r["title"] or (f"@{r['username']}" if r["username"] else str(r["chat_id"]))
-        txt += f"• {name} ({r['chat_id']})\n"
-    await cb.message.answer(txt)
+        lines.append(f"• {name} ({r['chat_id']})")
+    await cb.message.answer("\n".join(lines))
     await cb.answer()
 
 @router.callback_query(F.data == "rch:add")
 async def rch_add(cb: CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user.username):
+    if not await _db(is_admin, cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     await state.set_state(ReqChAddFlow.chat)
     await cb.message.answer("Отправьте @username канала или chat_id (бот должен иметь доступ для проверки).")
@@ -1651,18 +1755,16 @@ async def rch_add(cb: CallbackQuery, state: FSMContext):
 
 @router.message(ReqChAddFlow.chat)
 async def rch_add_chat(m: Message, state: FSMContext):
-    if not is_admin(m.from_user.username):
+    if not await _db(is_admin, m.from_user.username):
         await m.answer("Нет прав"); await state.clear(); return
     raw = (m.text or "").strip()
-    target = raw
-    if not raw.startswith("@"):
-        try:
-            target = int(raw)
-        except Exception:
-            await m.answer("❌ Введите @username или chat_id"); return
+    try:
+        target = raw if raw.startswith("@") else int(raw)
+    except ValueError:
+        await m.answer("❌ Введите @username или chat_id"); return
     try:
         chat = await m.bot.get_chat(target)
-        req_channels_add(int(chat.id), chat.title, chat.username)
+        await _db(req_channels_add, int(chat.id), chat.title, chat.username)
         await m.answer(f"✅ Добавлено: {chat.title or chat.id}")
     except Exception:
         await m.answer("❌ Не удалось получить чат. Проверьте доступ и данные.")
@@ -1670,56 +1772,90 @@ async def rch_add_chat(m: Message, state: FSMContext):
 
 @router.callback_query(F.data == "rch:del")
 async def rch_del(cb: CallbackQuery):
-    if not is_admin(cb.from_user.username):
+    if not await _db(is_admin, cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
-    rows = req_channels_list()
+    rows = await _db(req_channels_list, RCH_DEL_MAX)
     if not rows:
         await cb.message.answer("Список пуст."); await cb.answer(); return
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"❌ {r['title'] or r['chat_id']}", callback_data=f"rch:del1:{r['chat_id']}")]
-        for r in rows[:25]
-    ] + [[InlineKeyboardButton(text="⬅️ Назад", callback_data="rch:menu")]])
+        for r in rows
+    ] + [_RCH_BACK_ROW])
     await cb.message.answer("Выберите канал для удаления:", reply_markup=kb)
     await cb.answer()
 
 @router.callback_query(F.data.startswith("rch:del1:"))
 async def rch_del1(cb: CallbackQuery):
-    if not is_admin(cb.from_user.username):
+    if not await _db(is_admin, cb.from_user.username):
         await cb.answer("Нет прав", show_alert=True); return
     chat_id = int(cb.data.split(":")[2])
-    req_channels_remove(chat_id)
+    await _db(req_channels_remove, chat_id)
     await cb.message.answer("✅ Удалено")
     await cb.answer()
 
 # -------------------- INLINE MODE (Checks/Bills with URL buttons) --------------------
+def _try_num(s: str) -> float | None:
+    # one float() pass instead of a regex check plus float(); "1,5" is accepted,
+    # negative / inf / nan are not
+    try:
+        v = float(s.replace(",", "."))
+    except ValueError:
+        return None
+    return v if 0 <= v < math.inf else None
+
+def _fast_split(q: str) -> list[str] | None:
+    """
+    Whitespace split that keeps "double-quoted" parts together (the only quoting
+    the inline commands use). None on an unterminated quote.
+    """
+    if '"' not in q:
+        return q.split()
+    parts = []
+    buf = []
+    in_quote = False
+    has_tok = False  # "" is still a token
+    for ch in q:
+        if ch == '"':
+            in_quote = not in_quote
+            has_tok = True
+        elif in_quote or not ch.isspace():
+            buf.append(ch)
+            has_tok = True
+        elif has_tok:
+            parts.append("".join(buf))
+            buf = []
+            has_tok = False
+    if in_quote:
+        return None
+    if has_tok:
+        parts.append("".join(buf))
+    return parts
+
 def parse_inline_query(q: str):
     q = q.strip()
     if not q:
         return None
-    if re.fullmatch(r"\d+([.,]\d+)?", q):
-        return {"kind": "simple", "amount": float(q.replace(",", "."))}
-    try:
-        parts = shlex.split(q)
-    except Exception:
-        return None
+    amount = _try_num(q)
+    if amount is not None:
+        return {"kind": "simple", "amount": amount}
+    parts = _fast_split(q)
     if not parts:
         return None
     cmd = parts[0].lower()
 
     if cmd == "bill":
-        if len(parts) < 2 or not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        amount = float(parts[1].replace(",", "."))
+        amount = _try_num(parts[1]) if len(parts) >= 2 else None
+        if amount is None: return None
         desc = safe_desc(parts[2]) if len(parts) >= 3 else None
         return {"kind": "bill", "amount": amount, "desc": desc}
 
     # multi-use check: mcheck total per_claim max_claims "desc" pass
     if cmd == "mcheck":
         if len(parts) < 4: return None
-        if not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        if not re.fullmatch(r"\d+([.,]\d+)?", parts[2]): return None
-        if not re.fullmatch(r"\d+", parts[3]): return None
-        total = float(parts[1].replace(",", "."))
-        per = float(parts[2].replace(",", "."))
+        total = _try_num(parts[1])
+        per = _try_num(parts[2])
+        if total is None or per is None: return None
+        if not parts[3].isdecimal(): return None
         maxc = int(parts[3])
         desc = safe_desc(parts[4]) if len(parts) >= 5 else None
         pwd = safe_pass(parts[5]) if len(parts) >= 6 else None
@@ -1727,85 +1863,123 @@ def parse_inline_query(q: str):
 
     # single-use check: check amount "desc" pass
     if cmd == "check":
-        if len(parts) < 2 or not re.fullmatch(r"\d+([.,]\d+)?", parts[1]): return None
-        amount = float(parts[1].replace(",", "."))
+        amount = _try_num(parts[1]) if len(parts) >= 2 else None
+        if amount is None: return None
         desc = safe_desc(parts[2]) if len(parts) >= 3 else None
         pwd = safe_pass(parts[3]) if len(parts) >= 4 else None
         return {"kind": "mcheck", "total": amount, "per": amount, "maxc": 1, "desc": desc, "pwd": pwd}
 
     return None
 
-def make_check_text(total: float, per: float, maxc: int, desc: str | None, has_pass: bool) -> str:
-    text = "🎁 *Чек UWT*\n\n"
+_inline_token_cache: dict[tuple[int, str, str], tuple[float, tuple]] = {}
+_inline_calls = 0
+# result ids only need to be unique within one answer
+_inline_id_ctr = itertools.count()
+
+def inline_tokens(uid: int, query: str, create, part: str = ""):
+    """
+    Returns create()'s (ok, token) for (uid, query, part), reusing it for INLINE_TOKEN_TTL seconds
+    so Telegram re-sending the same query doesn't create another check/bill each time.
+    Failures are not kept: the next keystroke retries (e.g. after a top-up).
+    """
+    global _inline_calls
+    now = time.monotonic()
+    _inline_calls += 1
+    if _inline_calls % 256 == 0:
+        for k, (t, _) in list(_inline_token_cache.items()):
+            if now - t > 30:
+                _inline_token_cache.pop(k, None)
+    key = (uid, query, part)
+    hit = _inline_token_cache.get(key)
+    if hit and now - hit[0] < INLINE_TOKEN_TTL:
+        return hit[1]
+    val = create()
+    if val[0]:
+        _inline_token_cache[key] = (now, val)
+    return val
+
+def _needs_md(text: str | None) -> bool:
+    # Markdown is only worth sending when the user's description uses it
+    return bool(text) and ("*" in text or "_" in text)
+
+def make_check_text(total: float, per: float, maxc: int, desc: str | None, has_pass: bool,
+                    has_req_subs: bool, md: bool = True) -> str:
+    b = "*" if md else ""
+    subs = "\n📣 Требуются подписки (для получения)\n" if has_req_subs else ""
+    if maxc <= 1 and not desc and not has_pass:
+        # plain single check: what "@bot 100" produces
+        return f"🎁 {b}Чек UWT{b}\n\n💰 Сумма: {b}{fmt_num(per)} UWT{b}\n{subs}\nНажмите кнопку ниже 👇"
+    parts = [f"🎁 {b}Чек UWT{b}\n\n"]
     if maxc > 1:
-        text += f"💰 За раз: *{fmt_num(per)} UWT*\n"
-        text += f"👥 Лимит получений: *{maxc}*\n"
-        text += f"📦 Общая сумма: *{fmt_num(total)} UWT*\n"
+        parts.append(f"💰 За раз: {b}{fmt_num(per)} UWT{b}\n"
+                     f"👥 Лимит получений: {b}{maxc}{b}\n"
+                     f"📦 Общая сумма: {b}{fmt_num(total)} UWT{b}\n")
     else:
-        text += f"💰 Сумма: *{fmt_num(per)} UWT*\n"
+        parts.append(f"💰 Сумма: {b}{fmt_num(per)} UWT{b}\n")
     if desc:
-        text += f"\n📝 {desc}\n"
+        parts.append(f"\n📝 {desc}\n")
     if has_pass:
-        text += "\n🔐 Защищён паролем\n"
-    if CHECK_REQUIRE_SUBS and req_channels_list():
-        text += "\n📣 Требуются подписки (для получения)\n"
-    text += "\nНажмите кнопку ниже 👇"
-    return text
-
-def make_bill_text(amount: float, desc: str | None) -> str:
-    text = "📩 *Счёт UWT*\n\n"
-    text += f"💰 Сумма: *{fmt_num(amount)} UWT*\n"
-    if desc:
-        text += f"\n📝 {desc}\n"
-    text += "\nНажмите кнопку ниже 👇"
-    return text
+        parts.append("\n🔐 Защищён паролем\n")
+    parts.append(subs)
+    parts.append("\nНажмите кнопку ниже 👇")
+    return "".join(parts)
+
+def make_bill_text(amount: float, desc: str | None, md: bool = True) -> str:
+    b = "*" if md else ""
+    note = f"\n📝 {desc}\n" if desc else ""
+    return f"📩 {b}Счёт UWT{b}\n\n💰 Сумма: {b}{fmt_num(amount)} UWT{b}\n{note}\nНажмите кнопку ниже 👇"
 
 @router.inline_query()
 async def inline_handler(i: InlineQuery):
-    global BOT_USERNAME
     if not i.from_user.username:
         await i.answer([], cache_time=1)
         return
-    ensure_user(i.from_user.id, i.from_user.username)
+    await _db(ensure_user, i.from_user.id, i.from_user.username)
 
     parsed = parse_inline_query(i.query)
     if not parsed:
         await i.answer([], cache_time=1)
         return
 
-    bot_user = BOT_USERNAME or (await i.bot.me()).username
-    BOT_USERNAME = bot_user
+    start_url = _START_URL_PREFIX
 
     results = []
     kind = parsed["kind"]
+    failed = False
+    # checked once per query rather than once per rendered check
+    has_req = kind != "bill" and CHECK_REQUIRE_SUBS and await _db(_has_required_channels)
 
     if kind == "simple":
         amount = float(parsed["amount"])
+        uid = i.from_user.id
+        (ok, token), (okb, tokenb) = await _db(lambda: (
+            inline_tokens(uid, i.query, lambda: create_check_multi(uid, amount, amount, 1, None, None), "c"),
+            inline_tokens(uid, i.query, lambda: create_bill_uwt_by_token(uid, amount, None), "b"),
+        ))
+        failed = not (ok and okb)
         # Single check
-        ok, token = create_check_multi(i.from_user.id, amount, amount, 1, None, None)
         if ok:
-            url = f"https://t.me/{bot_user}?start=c_{token}"
+            url = start_url + "c_" + token
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🎁 Забрать чек", url=url)]])
             results.append(InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
+                id=f"{i.id}_{next(_inline_id_ctr)}",
                 title=f"🎁 Чек на {fmt_num(amount)} UWT",
                 input_message_content=InputTextMessageContent(
-                    message_text=make_check_text(amount, amount, 1, None, False),
-                    parse_mode="Markdown"
+                    message_text=make_check_text(amount, amount, 1, None, False, has_req, md=False),
+                    parse_mode=None
                 ),
                 reply_markup=kb
             ))
         # Bill
-        ok, tokenb = create_bill_uwt_by_token(i.from_user.id, amount, None)
-        if ok:
-            url = f"https://t.me/{bot_user}?start=b_{tokenb}"
+        if okb:
+            url = start_url + "b_" + tokenb
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💳 Оплатить", url=url)]])
             results.append(InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
+                id=f"{i.id}_{next(_inline_id_ctr)}",
                 title=f"📩 Счёт на {fmt_num(amount)} UWT",
                 input_message_content=InputTextMessageContent(
-                    message_text=make_bill_text(amount, None),
-                    parse_mode="Markdown"
+                    message_text=make_bill_text(amount, None, md=False),
+                    parse_mode=None
                 ),
                 reply_markup=kb
             ))
@@ -1816,23 +1990,26 @@ async def inline_handler(i: InlineQuery):
         maxc = int(parsed["maxc"])
         desc = parsed.get("desc")
         pwd = parsed.get("pwd")
-        ok, token = create_check_multi(i.from_user.id, total, per, maxc, desc, pwd)
+        md = _needs_md(desc)
+        ok, token = await _db(inline_tokens, i.from_user.id, i.query,
+                              lambda: create_check_multi(i.from_user.id, total, per, maxc, desc, pwd))
+        failed = not ok
         if ok:
-            url = f"https://t.me/{bot_user}?start=c_{token}"
+            url = start_url + "c_" + token
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🎁 Забрать чек", url=url)]])
             results.append(InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
+                id=f"{i.id}_{next(_inline_id_ctr)}",
                 title=("🎁 Многоразовый чек" if maxc > 1 else "🎁 Чек") + f" ({fmt_num(per)} UWT)",
                 description=(desc or "UWallet чек")[:60],
                 input_message_content=InputTextMessageContent(
-                    message_text=make_check_text(total, per, maxc, desc, bool(pwd)),
-                    parse_mode="Markdown"
+                    message_text=make_check_text(total, per, maxc, desc, bool(pwd), has_req, md=md),
+                    parse_mode="Markdown" if md else None
                 ),
                 reply_markup=kb
             ))
         else:
             results.append(InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
+                id=f"{i.id}_{next(_inline_id_ctr)}",
                 title="❌ Нельзя создать чек",
                 description=token[:80],
                 input_message_content=InputTextMessageContent(message_text=f"❌ {token}")
@@ -1841,27 +2018,33 @@ async def inline_handler(i: InlineQuery):
     elif kind == "bill":
         amount = float(parsed["amount"])
         desc = parsed.get("desc")
-        ok, token = create_bill_uwt_by_token(i.from_user.id, amount, desc)
+        md = _needs_md(desc)
+        ok, token = await _db(inline_tokens, i.from_user.id, i.query,
+                              lambda: create_bill_uwt_by_token(i.from_user.id, amount, desc))
+        failed = not ok
         if ok:
-            url = f"https://t.me/{bot_user}?start=b_{token}"
+            url = start_url + "b_" + token
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💳 Оплатить", url=url)]])
             results.append(InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
+                id=f"{i.id}_{next(_inline_id_ctr)}",
                 title=f"📩 Счёт на {fmt_num(amount)} UWT",
                 description=(desc or "Оплата")[:60],
                 input_message_content=InputTextMessageContent(
-                    message_text=make_bill_text(amount, desc),
-                    parse_mode="Markdown"
+                    message_text=make_bill_text(amount, desc, md=md),
+                    parse_mode="Markdown" if md else None
                 ),
                 reply_markup=kb
             ))
 
-    await i.answer(results, cache_time=0, is_personal=True)
+    # results are fixed for (user, query) for a few seconds (see inline_tokens), so
+    # Telegram may serve repeats itself instead of calling us again; errors are never cached
+    await i.answer(results, cache_time=0 if failed else INLINE_CACHE_TIME, is_personal=True)
 
 # -------------------- BACKGROUND WORKERS --------------------
 async def giveaways_worker(bot: Bot):
     while True:
-        finished = finish_due_giveaways()
+        finished = await _db(finish_due_giveaways)
+        msgs_by_user: dict[int, list[str]] = defaultdict(list)
         for gid, winner, amount, creator in finished:
             msg = f"🎁 Розыгрыш {gid} завершён. "
             if winner is None:
@@ -1869,15 +2052,12 @@ async def giveaways_worker(bot: Bot):
             else:
                 msg += f"Победитель: {winner}. Приз: {fmt_num(amount)} UWT"
             # notify creator and winner (and participants if possible)
-            try:
-                await bot.send_message(creator, msg)
-            except Exception:
-                pass
-            if winner:
-                try:
-                    await bot.send_message(winner, msg)
-                except Exception:
-                    pass
+            msgs_by_user[creator].append(msg)
+            if winner and winner != creator:
+                msgs_by_user[winner].append(msg)
+        # one combined message per recipient, all sent together; a failed send doesn't stop the others
+        await asyncio.gather(*(bot.send_message(uid, "\n\n".join(parts)) for uid, parts in msgs_by_user.items()),
+                             return_exceptions=True)
         await asyncio.sleep(GIVEAWAY_POLL_SEC)
 
 async def subs_worker(bot: Bot):
@@ -1885,44 +2065,57 @@ async def subs_worker(bot: Bot):
     Если бот админ в канале и имеет права ban, попробует кикнуть просроченных.
     Если нет — просто оставляет запись (можно чистить вручную).
     """
-    while True:
-        rows = due_subs()
-        for r in rows:
-            chat_id = int(r["chat_id"])
-            user_id = int(r["user_tg_id"])
+    async def kick(chat_id: int, user_id: int) -> bool:
+        # True when the row is done with: kicked, or Telegram refused for good (no rights, etc.)
+        while True:
             try:
                 # kick: ban then unban to remove
                 await bot.ban_chat_member(chat_id, user_id)
                 await bot.unban_chat_member(chat_id, user_id)
+                return True
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except (TelegramBadRequest, TelegramForbiddenError):
+                return True
             except Exception:
-                pass
-            # delete subscription row (stop repeating)
-            con = db()
-            cur = con.cursor()
-            cur.execute("DELETE FROM channel_subs WHERE id=?", (r["id"],))
-            con.commit(); con.close()
+                return False  # network trouble: keep the row for the next poll
+
+    while True:
+        cutoff = now_iso()
+        rows = await _db(due_subs, cutoff)
+        if rows:
+            # one kick at a time to stay under the flood limit
+            done = [r["id"] for r in rows if await kick(int(r["chat_id"]), int(r["user_tg_id"]))]
+            # delete processed subscription rows (stop repeating), one commit for the batch
+            if done:
+                await _db(subs_delete, done, cutoff)
         await asyncio.sleep(SUBS_POLL_SEC)
 
 
 # -------------------- ADMIN GIVE COMMANDS --------------------
-def get_user_by_username(username: str):
+@lru_cache(maxsize=2048)
+def _user_id_by_username(u: str) -> int | None:
+    # users.username is UNIQUE, so this is an index lookup; ensure_user clears the cache
     con = db()
     cur = con.cursor()
-    cur.execute("SELECT tg_id FROM users WHERE username=?", (clean_username(username),))
+    cur.execute("SELECT tg_id FROM users WHERE username=?", (u,))
     row = cur.fetchone()
     con.close()
     return int(row["tg_id"]) if row else None
 
+def get_user_by_username(username: str):
+    return _user_id_by_username(clean_username(username))
+
 @router.message(F.text.startswith("/give "))
 async def cmd_give(m: Message):
-    if not is_admin(m.from_user.username):
+    if not await _db(is_admin, m.from_user.username):
         await m.answer("❌ Нет прав")
         return
     parts = m.text.split()
     if len(parts) != 3:
         await m.answer("Использование: /give @username сумма")
         return
-    uid = get_user_by_username(parts[1])
+    uid = await _db(get_user_by_username, parts[1])
     if not uid:
         await m.answer("❌ Пользователь не найден")
         return
@@ -1932,7 +2125,8 @@ async def cmd_give(m: Message):
     except:
         await m.answer("❌ Сумма должна быть > 0")
         return
-    add_asset(uid, "UWT", amt, "admin_give", f"by @{clean_username(m.from_user.username)}")
+    by = clean_username(m.from_user.username)
+    await _db(add_asset, uid, "UWT", amt, "admin_give", f"by @{by}")
     await m.answer(f"✅ Начислено {fmt_num(amt)} UWT пользователю {parts[1]}")
     try:
         await m.bot.send_message(uid, f"💸 Вам начислено {fmt_num(amt)} UWT от администратора")
@@ -1941,14 +2135,14 @@ async def cmd_give(m: Message):
 
 @router.message(F.text.startswith("/giverub "))
 async def cmd_giverub(m: Message):
-    if not is_admin(m.from_user.username):
+    if not await _db(is_admin, m.from_user.username):
         await m.answer("❌ Нет прав")
         return
     parts = m.text.split()
     if len(parts) != 3:
         await m.answer("Использование: /giverub @username сумма")
         return
-    uid = get_user_by_username(parts[1])
+    uid = await _db(get_user_by_username, parts[1])
     if not uid:
         await m.answer("❌ Пользователь не найден")
         return
@@ -1958,7 +2152,8 @@ async def cmd_giverub(m: Message):
     except:
         await m.answer("❌ Сумма должна быть > 0")
         return
-    add_asset(uid, "RUB", amt, "admin_give", f"by @{clean_username(m.from_user.username)}")
+    by = clean_username(m.from_user.username)
+    await _db(add_asset, uid, "RUB", amt, "admin_give", f"by @{by}")
     await m.answer(f"✅ Начислено {amt:g} RUB пользователю {parts[1]}")
     try:
         await m.bot.send_message(uid, f"💸 Вам начислено {amt:g} RUB от администратора")
@@ -1966,13 +2161,32 @@ async def cmd_giverub(m: Message):
         pass
 
 # -------------------- RUN --------------------
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    app = web.Application()
+    # updates are acknowledged at once and handled as tasks
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True,
+                         secret_token=WEBHOOK_SECRET).register(app, path=urlsplit(WEBHOOK_URL).path or "/")
+    setup_application(app, dp, bot=bot)
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
-    global BOT_USERNAME
+    global BOT_USERNAME, _START_URL_PREFIX
     init_db()
     bot = Bot(BOT_TOKEN)
 
     me = await bot.me()
+    if not me.username:
+        raise RuntimeError("Bot has no username (required for inline mode and deep links)")
     BOT_USERNAME = me.username
+    _START_URL_PREFIX = f"https://t.me/{BOT_USERNAME}?start="
 
     dp = Dispatcher()
 
@@ -1988,7 +2202,16 @@ async def main():
     asyncio.create_task(giveaways_worker(bot))
     asyncio.create_task(subs_worker(bot))
 
-    await dp.start_polling(bot)
+    if WEBHOOK_URL:
+        await run_webhook(bot, dp)
+    else:
+        await bot.delete_webhook()  # getUpdates is refused while a webhook is set
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
+    try:
+        import uvloop  # optional: pip install uvloop (not available on Windows)
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())